@@ -4,11 +4,13 @@ import requests
 import json
 import urllib
 import urllib.request        
-from flask import Flask, request, render_template
+from flask import Flask, Response, request, render_template
 from flask_restful import Resource, Api, reqparse
 from marshmallow import Schema, fields
 import ast
 import re
+import time
+from concurrent.futures import CancelledError
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
@@ -20,36 +22,125 @@ except ImportError:
 
 from FeatureEngineering import create_time_matrix
 from MatchingAlgorithm import run_algorithm
+from JobQueue import JobQueue
+from ResultCache import ResultCache, problem_fingerprint
+from ApiPayloads import parse_routes_args, parse_routes_body
 
 ###
 app = Flask(__name__)
 api = Api(app)
 
-@app.route('/routes')
+jobs = JobQueue(result_cache=ResultCache()) # concurrency set by the ROUTES_MAX_WORKERS environment variable, results cached under Cache/routes
+
+EVENTS_POLL_INTERVAL = 0.5 # seconds between two checks of a job's progress in /jobs/<id>/events
+
+def parse_routes_request(request):
+    """
+    Arguments of run_algorithm from a /routes request: the tables as CSV text in the query string or form (as in the GET /routes),
+    or a POST body with gzip JSON, Arrow or Parquet tables (see ApiPayloads.parse_routes_body). Raises ValueError if they are invalid.
+    """
+    if request.method == 'GET' or (not request.files and request.form):
+        return parse_routes_args(request.values)
+    return parse_routes_body(request.content_type, request.content_encoding, request.get_data(), request.files, request.form)
+
+def submit_routes(routes_args):
+    """
+    Job solving a /routes problem, keyed by its problem_fingerprint (travel times from Google Maps): a job already done if
+    the same problem was solved recently, the queued or running job of the same problem if there is one, or else a new job.
+    """
+    key = problem_fingerprint(routes_args['orders_df'], routes_args['catchments_df'], routes_args['phlebs_df'],
+                              routes_args['profile'], routes_args['isMultiEnds'], 'google')
+    return jobs.submit(run_algorithm, description='routes', track_progress=True, key=key, **routes_args)
+
+@app.route('/routes', methods=['GET', 'POST'])
 def get_routes():
-    args = request.args
-    orders = args.get('orders')
-    ordersIO = StringIO(orders)
-    orders_df = pd.read_csv(ordersIO, index_col=None)
-    
-    catchment = args.get('catchment')
-    catchmentIO = StringIO(catchment)
-    catchment_df = pd.read_csv(catchmentIO, index_col=None)
-    if 'Unnamed: 0' in catchment_df.columns.tolist():
-        catchment_df.drop(columns=['Unnamed: 0'], inplace=True)
-
-    phleb = args.get('phleb')
-    phlebIO = StringIO(phleb)
-    phleb_df = pd.read_csv(phlebIO, index_col=None)
-    if 'Unnamed: 0' in phleb_df.columns.tolist():
-        phleb_df.drop(columns=['Unnamed: 0'], inplace=True)
-    
-    API_key = args.get('API_key')
-    isMultiEnds = args.get('isMultiEnds')
-    
-    result = run_algorithm(orders_df, catchment_df, phleb_df, API_key, isMultiEnds = False)
+    try:
+        routes_args = parse_routes_request(request)
+    except ValueError as e:
+        return {'message': str(e)}, 400
+
+    # Solved in the job queue, so that identical concurrent requests share one solve and repeated ones return the cached result
+    try:
+        result = jobs.wait(submit_routes(routes_args))
+    except CancelledError:
+        return {'message': 'The solve was cancelled'}, 410
     
     return {'route': result}, 200
 
+@app.route('/jobs', methods=['POST'])
+def post_job():
+    """Queues a /routes problem (same arguments or body as /routes) and returns its job straight away."""
+    try:
+        routes_args = parse_routes_request(request)
+    except ValueError as e:
+        return {'message': str(e)}, 400
+
+    job_id = submit_routes(routes_args)
+    return {'job': jobs.status(job_id)}, 202, {'Location': '/jobs/{}'.format(job_id)}
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    return {'jobs': jobs.list()}, 200
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    status = jobs.status(job_id)
+    if status is None:
+        return {'message': "Unknown job '{}'".format(job_id)}, 404
+    return {'job': status}, 200
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    status = jobs.status(job_id)
+    if status is None:
+        return {'message': "Unknown job '{}'".format(job_id)}, 404
+    if status['status'] in ('queued', 'running'):
+        return {'job': status}, 202
+    if status['status'] == 'cancelled':
+        return {'job': status}, 410
+    if status['status'] == 'failed':
+        return {'job': status, 'message': status['error']}, 500
+    return {'route': jobs.result(job_id)}, 200
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def get_job_events(job_id):
+    """
+    Server-sent events of the job: a 'solution' event with each improving solution (objective, nodes dropped, elapsed seconds)
+    as soon as it is found, then a 'status' event with the job once it is finished, which ends the stream.
+    """
+    if jobs.status(job_id) is None:
+        return {'message': "Unknown job '{}'".format(job_id)}, 404
+
+    def events():
+        sent = 0
+        while True:
+            status = jobs.status(job_id)
+            for solution in jobs.progress(job_id, sent) or []:
+                sent += 1
+                yield 'event: solution\ndata: {}\n\n'.format(json.dumps(solution))
+            if status is None or status['status'] not in ('queued', 'running'):
+                yield 'event: status\ndata: {}\n\n'.format(json.dumps(status))
+                return
+            time.sleep(EVENTS_POLL_INTERVAL)
+
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@app.route('/jobs/<job_id>/stop', methods=['POST'])
+def stop_job(job_id):
+    """Accepts the best solution found so far: the solve stops and the job finishes with that plan as its result."""
+    if jobs.status(job_id) is None:
+        return {'message': "Unknown job '{}'".format(job_id)}, 404
+    if not jobs.stop(job_id):
+        return {'job': jobs.status(job_id), 'message': 'Job is not running'}, 409
+    return {'job': jobs.status(job_id)}, 200
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    if jobs.status(job_id) is None:
+        return {'message': "Unknown job '{}'".format(job_id)}, 404
+    if not jobs.cancel(job_id):
+        return {'job': jobs.status(job_id), 'message': 'Job already finished'}, 409
+    return {'job': jobs.status(job_id)}, 200
+
 if __name__ == "__main__":
     app.run(port=8000)
\ No newline at end of file
@@ -0,0 +1,175 @@
+import gzip
+import io
+import json
+import zlib
+
+import pandas as pd
+
+from MatchingAlgorithm import SOLVER_PROFILES
+
+try:
+    import pyarrow as pa # optional, Arrow IPC and Parquet payloads
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Columns read by the Matching Algorithm from each table: 'integer' and 'number' columns are converted to numeric types,
+# None columns (the ids) are kept as they are. Orders also need at least one service_* column, and phlebotomists at least
+# one expertise_* column, holding 0 or 1.
+ORDERS_SCHEMA = {'order_id': None, 'order_start': 'integer', 'duration': 'integer', 'buffer': 'integer', 'price': 'number',
+                 'capacity_needed': 'integer', 'lat': 'number', 'long': 'number'}
+PHLEBS_SCHEMA = {'phleb_id': None, 'shift_start': 'integer', 'cost': 'number', 'capacity': 'integer', 'service_rating': 'number',
+                 'lat': 'number', 'long': 'number'}
+CATCHMENTS_SCHEMA = {'lat': 'number', 'long': 'number'}
+
+# Name of each table in the requests, with its schema and flag columns
+TABLES = {'orders': (ORDERS_SCHEMA, 'service_'), 'catchment': (CATCHMENTS_SCHEMA, None), 'phleb': (PHLEBS_SCHEMA, 'expertise_')}
+
+GZIP_MAGIC = b'\x1f\x8b'
+PARQUET_MAGIC = b'PAR1'
+ARROW_FILE_MAGIC = b'ARROW1'
+ARROW_STREAM_MAGIC = b'\xff\xff\xff\xff'
+
+
+def validate_table(df, name):
+    """
+    Checks a table of a /routes request against its schema (see TABLES) in a single pass, and returns it with typed columns.
+    Raises ValueError with the name of the table and of the offending columns.
+    """
+    schema, flag_prefix = TABLES[name]
+    df = df.drop(columns=['Unnamed: 0'], errors='ignore') #index written by DataFrame.to_csv()
+    if len(df) == 0:
+        raise ValueError("'{}' is empty".format(name))
+
+    missing = [column for column in schema if column not in df.columns]
+    if missing:
+        raise ValueError("'{}' is missing the columns {}".format(name, missing))
+
+    typed = {}
+    for column, kind in schema.items():
+        if kind is None:
+            continue
+        values = pd.to_numeric(df[column], errors='coerce')
+        if values.isna().any():
+            raise ValueError("'{}' has missing or non-numeric values in '{}'".format(name, column))
+        if kind == 'integer':
+            if (values != values.round()).any():
+                raise ValueError("'{}' has non-integer values in '{}'".format(name, column))
+            values = values.astype('int64')
+        typed[column] = values
+
+    if flag_prefix is not None:
+        flag_columns = [column for column in df.columns if str(column).startswith(flag_prefix)]
+        if not flag_columns:
+            raise ValueError("'{}' needs at least one {}* column".format(name, flag_prefix))
+        for column in flag_columns:
+            values = pd.to_numeric(df[column], errors='coerce').fillna(0)
+            if not values.isin([0, 1]).all():
+                raise ValueError("'{}' has values other than 0 and 1 in '{}'".format(name, column))
+            typed[column] = values.astype('int64')
+
+    return df.assign(**typed)
+
+
+def read_table(payload):
+    """
+    DataFrame from the bytes of one table, whose format is recognised from its first bytes: gzip (decompressed first),
+    Parquet, Arrow IPC (file or stream), JSON (records, or a {'columns', 'data'} object as from DataFrame.to_json(orient='split'))
+    or CSV otherwise.
+    """
+    if payload[:2] == GZIP_MAGIC:
+        payload = decompress(payload)
+
+    if payload[:4] == PARQUET_MAGIC or payload[:6] == ARROW_FILE_MAGIC or payload[:4] == ARROW_STREAM_MAGIC:
+        if pa is None:
+            raise ValueError('pyarrow is required for Arrow and Parquet payloads')
+        try:
+            if payload[:4] == PARQUET_MAGIC:
+                return pq.read_table(pa.BufferReader(payload)).to_pandas()
+            if payload[:6] == ARROW_FILE_MAGIC:
+                return pa.ipc.open_file(pa.BufferReader(payload)).read_pandas()
+            return pa.ipc.open_stream(pa.BufferReader(payload)).read_pandas()
+        except pa.ArrowInvalid as e:
+            raise ValueError('Invalid Arrow or Parquet payload: {}'.format(e))
+
+    if payload.lstrip()[:1] in (b'{', b'['):
+        return json_table(json.loads(payload))
+    return pd.read_csv(io.BytesIO(payload), index_col=None)
+
+
+def decompress(payload):
+    # gzip errors (BadGzipFile, EOFError, zlib.error) are not ValueErrors, they are re-raised as such for a 400
+    try:
+        return gzip.decompress(payload)
+    except (OSError, EOFError, zlib.error) as e:
+        raise ValueError('Invalid gzip payload: {}'.format(e))
+
+
+def parse_flag(value, name):
+    # Boolean option, either from JSON or as text from a query string or form
+    if isinstance(value, str):
+        if value.strip().lower() not in ('true', 'false', '1', '0', ''):
+            raise ValueError("Expected true or false for '{}', got '{}'".format(name, value))
+        return value.strip().lower() in ('true', '1')
+    return bool(value)
+
+
+def json_table(value):
+    # Table given inside a JSON body: records, split orient or CSV text
+    if isinstance(value, str):
+        return pd.read_csv(io.StringIO(value), index_col=None)
+    if isinstance(value, dict) and 'columns' in value and 'data' in value:
+        return pd.DataFrame(value['data'], columns=value['columns'])
+    if isinstance(value, list):
+        return pd.DataFrame.from_records(value)
+    raise ValueError('Tables must be given as records, a {"columns", "data"} object or CSV text')
+
+
+def routes_args(tables, options):
+    """Arguments of run_algorithm from the 3 tables (DataFrames, validated here) and the options of a /routes request."""
+    for name in TABLES:
+        if name not in tables:
+            raise ValueError("Missing '{}'".format(name))
+    profile = options.get('profile', 'balanced')
+    if profile not in SOLVER_PROFILES:
+        raise ValueError("Unknown profile '{}', expected one of {}".format(profile, list(SOLVER_PROFILES)))
+    return {'orders_df': validate_table(tables['orders'], 'orders'), 'catchments_df': validate_table(tables['catchment'], 'catchment'),
+            'phlebs_df': validate_table(tables['phleb'], 'phleb'), 'api_key': options.get('API_key'),
+            'isMultiEnds': parse_flag(options.get('isMultiEnds', False), 'isMultiEnds'), 'profile': profile}
+
+
+def parse_routes_args(args):
+    """run_algorithm arguments from the query string or form of a /routes request, with the tables as CSV text."""
+    tables = {name: pd.read_csv(io.StringIO(args[name]), index_col=None) for name in TABLES if args.get(name) is not None}
+    return routes_args(tables, args)
+
+
+def parse_routes_body(content_type, content_encoding, body, files, form):
+    """
+    run_algorithm arguments from the body of a POST /routes request, either:
+    - a JSON object (gzip-compressed if content_encoding is 'gzip') with the 3 tables and the options, or
+    - a multipart form with the 3 tables as files, each in any format read by read_table, and the options as form fields.
+    """
+    if files:
+        tables = {name: read_table(files[name].read()) for name in TABLES if name in files}
+        return routes_args(tables, form)
+
+    if content_encoding == 'gzip':
+        body = decompress(body)
+    if not (content_type or '').startswith('application/json'):
+        raise ValueError("Expected a JSON body or a multipart form, got '{}'".format(content_type))
+    try:
+        payload = json.loads(body)
+    except ValueError as e:
+        raise ValueError('Invalid JSON body: {}'.format(e))
+    tables = {name: json_table(payload[name]) for name in TABLES if name in payload}
+    return routes_args(tables, payload)
+
+
+def encode_routes_payload(orders_df, catchment_df, phleb_df, API_key, isMultiEnds=False, profile='balanced'):
+    """Body and headers of a POST /routes request: gzip-compressed JSON with each table in the split orient."""
+    tables = ','.join('"{}":{}'.format(name, df.to_json(orient='split', index=False, double_precision=15))
+                      for name, df in (('orders', orders_df), ('catchment', catchment_df), ('phleb', phleb_df)))
+    options = json.dumps({'API_key': API_key, 'isMultiEnds': isMultiEnds, 'profile': profile})
+    body = gzip.compress('{{{},{}'.format(tables, options[1:]).encode('utf-8'))
+    return body, {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
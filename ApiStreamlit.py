@@ -17,8 +17,9 @@ import matplotlib.pyplot as plt
 import io
 import streamlit as st
 from FeatureEngineering import create_time_matrix
-from MatchingAlgorithm import run_algorithm, reverse_getVacancy_algorithm
+from MatchingAlgorithm import run_algorithm, reverse_getVacancy_algorithm, SlotIndex
 from ApiFirebase import upload_phleb
+from ApiPayloads import encode_routes_payload
 import copy
 import firebase_admin
 from firebase_admin import firestore
@@ -90,9 +91,30 @@ def convert_to_df(csv):
     df = pd.read_csv(csv)
     return df
 
-def get_routes_api(orders, catchment, phleb, API_key, isMultiEnds):
-    result = requests.get("http://127.0.0.1:8000/routes", 
-                          params={'orders':orders, 'catchment':catchment, 'phleb':phleb, 'API_key':API_key, 'isMultiEnds':isMultiEnds})
+@st.cache_resource
+def get_slot_index(routes):
+    # Built once per uploaded routes, then reused for every availability query
+    return SlotIndex(routes)
+
+def get_routes_api(orders_df, catchment_df, phleb_df, API_key, isMultiEnds):
+    # Tables are sent as gzip JSON in the body of a POST, instead of CSV text in the URL
+    body, headers = encode_routes_payload(orders_df, catchment_df, phleb_df, API_key, isMultiEnds)
+    job = requests.post("http://127.0.0.1:8000/jobs", data=body, headers=headers).json()['job']
+
+    # Shows each improving solution while the job is solving, until its final status event
+    progress = st.empty()
+    events = requests.get("http://127.0.0.1:8000/jobs/{}/events".format(job['id']), stream=True)
+    event = None
+    for line in events.iter_lines(decode_unicode=True):
+        if line.startswith('event: '):
+            event = line[len('event: '):]
+        elif line.startswith('data: ') and event == 'solution':
+            solution = json.loads(line[len('data: '):])
+            progress.text("Best plan so far: objective {}, {} orders dropped ({:.0f}s)".format(
+                solution['Objective Number'], solution['Total Number of Nodes Dropped'], solution['Elapsed']))
+    progress.empty()
+
+    result = requests.get("http://127.0.0.1:8000/jobs/{}/result".format(job['id']))
     return result.json()['route']
 
 st.title('TATA 1mg Matching Algorithm API')
@@ -130,7 +152,7 @@ with tab1:
             else:
                 service_time = 4
                 required_expertise.append('expertise_special')
-            string_result = reverse_getVacancy_algorithm(order_coord, service_time, required_expertise, routes, API_key)
+            string_result = reverse_getVacancy_algorithm(order_coord, service_time, required_expertise, routes, API_key, slot_index=get_slot_index(routes))
             json_result = json.loads(string_result)
             df_result = pd.DataFrame.from_dict(json_result)
             st.write(df_result)
@@ -146,17 +168,12 @@ with tab2:
         API_key = API_key
         
         orders_df = pd.read_csv(orders)
-        orders = orders_df.to_csv()
-        
-        catchment = get_catchment()
-        catchment = catchment.to_csv()
-        
-        phleb = get_phleb()
-        phleb = phleb.to_csv()
+        catchment_df = get_catchment()
+        phleb_df = get_phleb()
         
         st.download_button(
             label="Get Optimal Routes",
-            data=get_routes_api(orders, catchment, phleb, API_key, False),
+            data=get_routes_api(orders_df, catchment_df, phleb_df, API_key, False),
             file_name="routes.json",
             mime="text",
             key="routes_download",
@@ -172,17 +189,12 @@ with tab3:
     if (len(API_key) != 0) and (phleb is not None) and (catchment is not None) and (orders is not None):
         
         orders_df = pd.read_csv(orders)
-        orders = orders_df.to_csv()
-        
         catchment_df = pd.read_csv(catchment)
-        catchment = catchment_df.to_csv()
-        
         phleb_df = pd.read_csv(phleb)
-        phleb = phleb_df.to_csv()
         
         st.download_button(
             label="Get Optimal Routes",
-            data=get_routes_api(orders, catchment, phleb, API_key, False),
+            data=get_routes_api(orders_df, catchment_df, phleb_df, API_key, False),
             file_name="routes.json",
             mime="text",
             key="routes_download_3",
@@ -0,0 +1,273 @@
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.cluster.vq import kmeans2
+
+import FeatureEngineering as FE
+import MatchingAlgorithm as MA
+
+ORDERS_PER_ZONE = 300 # default zone size, small enough for OR-tools to reach good solutions within the solver profile
+
+BOUNDARY_RATIO = 1.5 # an order is near a zone boundary if another zone's centre is at most this many times further than its own
+
+
+def cluster_zones(orders_df, phlebs_df, n_zones, seed=0):
+    """
+    Splits the city into zones with k-means on the orders' (lat, long), then gives each zone a number of phlebotomists
+    proportional to its number of orders (at least 1), picking the phlebotomists whose homes are closest to the zone's centre.
+    Output is a tuple of (order_zones, phleb_zones), the zone of each order and each phlebotomist.
+    """
+    order_coords = orders_df[['lat', 'long']].to_numpy(dtype=float)
+    phleb_coords = phlebs_df[['lat', 'long']].to_numpy(dtype=float)
+    n_zones = max(1, min(n_zones, len(orders_df), len(phlebs_df)))
+
+    centroids, order_zones = kmeans2(order_coords, n_zones, minit='++', seed=seed)
+    zones, order_zones = np.unique(order_zones, return_inverse=True) #k-means may leave some clusters empty
+    centroids = centroids[zones]
+    n_zones = len(zones)
+
+    # Number of phlebotomists of each zone, proportional to its orders (largest remainder), at least 1 per zone
+    order_counts = np.bincount(order_zones, minlength=n_zones)
+    shares = 1 + order_counts / order_counts.sum() * (len(phlebs_df) - n_zones)
+    quotas = np.floor(shares).astype(int)
+    remainders = np.argsort(quotas - shares, kind='stable')
+    quotas[remainders[:len(phlebs_df) - quotas.sum()]] += 1
+
+    # Closest (phlebotomist, zone) pairs first, until every quota is filled
+    distances = np.linalg.norm(phleb_coords[:, None, :] - centroids[None, :, :], axis=2)
+    phleb_zones = np.full(len(phlebs_df), -1)
+    for flat in np.argsort(distances, axis=None, kind='stable'):
+        phleb, zone = divmod(int(flat), n_zones)
+        if phleb_zones[phleb] == -1 and quotas[zone] > 0:
+            phleb_zones[phleb] = zone
+            quotas[zone] -= 1
+    return order_zones, phleb_zones
+
+
+def _solve_zone(zone_args):
+    # Runs in a worker process: solves one zone as an independent sub-problem
+    zone, orders_df, catchments_df, phlebs_df, api_key, provider, profile = zone_args
+    start = time.monotonic()
+    result = MA.run_algorithm(orders_df, catchments_df, phlebs_df, api_key, provider=provider, profile=profile)
+    return zone, result, time.monotonic() - start
+
+
+def empty_route(phleb_idx, features, provider):
+    """
+    Route of a phlebotomist without any order, from the starting location straight to the ending location (the closest
+    catchment area in multi-ends), in the format of the Optimal Routes, so that orders can still be inserted into it.
+    """
+    num_catchments = features.num_catchments
+    start = 1 + phleb_idx
+    start_coord = features.addresses[num_catchments + phleb_idx]
+    end_times = np.asarray(provider.get_time_matrix([start_coord], features.addresses[:num_catchments]), dtype=np.int64)[0]
+    if num_catchments > 1:
+        catchment = int(np.argmin(end_times))
+        end, travel_time = 1 + features.num_phlebs + features.num_orders + catchment, int(end_times[catchment])
+    else:
+        end, travel_time = 0, int(end_times[0])
+
+    # Same bounds as the solver: the start is within both the ending location's and the phlebotomist's time windows
+    time_windows = features.time_windows
+    earliest_bounds = np.array([max(time_windows[0][0], time_windows[start][0]), 0], dtype=np.int64)
+    latest_bounds = np.array([min(time_windows[0][1], time_windows[start][1]), MA.MAX_TIME], dtype=np.int64)
+    servicing_times = np.zeros(2, dtype=np.int64)
+    travel_times = np.array([travel_time], dtype=np.int64)
+
+    phleb_route = {'Phlebotomist Index': phleb_idx, 'Total Travel Time': travel_time, 'Total Loads': 0, 'Locations Sequence': [start, end]}
+    MA.set_route_times(phleb_route, earliest_bounds, latest_bounds, servicing_times, travel_times,
+                       MA.schedule_route(earliest_bounds, latest_bounds, servicing_times, travel_times))
+    return MA.with_printable_route(phleb_route)
+
+
+def failed_zone_model(status, zone_phlebs, zone_orders, features):
+    # Model of a zone without a solution: every order is dropped, to be repaired into other routes by repair_boundaries
+    first_order = 1 + features.num_phlebs
+    revenues = features.revenues[first_order + zone_orders].tolist()
+    return {'Objective Number': None, 'Status': status, 'Total Revenue Lost': sum(revenues), 'Total Number of Nodes Dropped': len(zone_orders),
+            'Nodes Dropped': (1 + len(zone_phlebs) + np.arange(len(zone_orders))).tolist(), 'Revenues Dropped': revenues,
+            'Total Travel Time': 0, 'Total Loads': 0}
+
+
+def merge_zone_routes(zone_results, order_zones, phleb_zones, features, provider=None):
+    """
+    Merges the Optimal Routes of every zone into a single Optimal Routes JSON (as a dictionary) for the whole city,
+    mapping each zone's location and phlebotomist indices back to the indices of the full problem.
+
+    A zone without a solution is given as its 'Routing Status: ...' instead of its Optimal Routes: its orders are then dropped
+    and its phlebotomists given empty routes (see empty_route, which needs the provider), so that repair_boundaries can
+    insert the orders into any route, including the routes of that zone.
+
+    The objectives of the zones are in different units (each zone scales its revenues by its own travel times), so the merged plan
+    has no single objective: its 'Objective Number' is None, and 'Zone Objectives Sum' is the sum of the objectives of the solved zones
+    before any repair or relocation (failed zones are left out), only comparable between runs with the same zones.
+    """
+    num_phlebs, num_orders, num_catchments = features.num_phlebs, features.num_orders, features.num_catchments
+    num_locations = 1 + num_phlebs + num_orders
+
+    model = {'Objective Number': None, 'Zone Objectives Sum': 0, 'Status': None, 'Total Revenue Lost': 0, 'Total Number of Nodes Dropped': 0,
+             'Nodes Dropped': [], 'Revenues Dropped': [], 'Total Travel Time': 0, 'Total Loads': 0, 'Zones': []}
+    routes = [None] * num_phlebs
+    statuses = []
+
+    for zone, zone_json, solve_time in zone_results:
+        zone_phlebs = np.flatnonzero(phleb_zones == zone)
+        zone_orders = np.flatnonzero(order_zones == zone)
+        if isinstance(zone_json, str):
+            zone_model, zone_routes = failed_zone_model(zone_json, zone_phlebs, zone_orders, features), []
+            for phleb_idx in zone_phlebs:
+                routes[phleb_idx] = empty_route(int(phleb_idx), features, provider)
+                zone_model['Total Travel Time'] += routes[phleb_idx]['Total Travel Time']
+        else:
+            zone_model, zone_routes = zone_json['Model'], zone_json['Routes']
+
+        # Local location index -> index in the full problem: ending depot, starting locations, orders, then catchment areas (multi-ends)
+        catchment_locations = np.arange(num_catchments) + num_locations if num_catchments > 1 else np.empty(0, dtype=int)
+        to_global = np.concatenate([[0], 1 + zone_phlebs, 1 + num_phlebs + zone_orders, catchment_locations]).astype(int)
+
+        for phleb_route in zone_routes:
+            phleb_idx = int(zone_phlebs[phleb_route['Phlebotomist Index']])
+            phleb_route['Phlebotomist Index'] = phleb_idx
+            phleb_route['Locations Sequence'] = to_global[np.asarray(phleb_route['Locations Sequence'], dtype=int)].tolist()
+            phleb_route['Printable Route'] = MA.printable_route(phleb_route)
+            routes[phleb_idx] = phleb_route
+
+        model['Zone Objectives Sum'] += zone_model['Objective Number'] or 0
+        model['Total Revenue Lost'] += zone_model['Total Revenue Lost']
+        model['Total Number of Nodes Dropped'] += zone_model['Total Number of Nodes Dropped']
+        model['Nodes Dropped'].extend(to_global[np.asarray(zone_model['Nodes Dropped'], dtype=int)].tolist())
+        model['Revenues Dropped'].extend(zone_model['Revenues Dropped'])
+        model['Total Travel Time'] += zone_model['Total Travel Time']
+        model['Total Loads'] += zone_model['Total Loads']
+        model['Zones'].append({'Zone': int(zone), 'Orders': len(zone_orders), 'Phlebotomists': len(zone_phlebs),
+                               'Objective Number': zone_model['Objective Number'], 'Status': zone_model['Status'],
+                               'Total Number of Nodes Dropped': zone_model['Total Number of Nodes Dropped'],
+                               'Solve Time': solve_time})
+        statuses.append(zone_model['Status'])
+
+    model['Status'] = statuses[0] if len(set(statuses)) == 1 else statuses
+    model['Zones'].sort(key=lambda zone_stats: zone_stats['Zone'])
+    return {'Metadata': features.metadata, 'Model': model, 'Routes': routes}
+
+
+def repair_boundaries(json_object, orders_df, features, provider):
+    """
+    Boundary-repair pass: orders dropped by their zone (e.g. no phlebotomist of that zone had the expertise or the time)
+    are inserted into the cheapest feasible gap of any phlebotomist, typically one of a neighbouring zone.
+    Returns the number of orders repaired.
+    """
+    model = json_object['Model']
+    locations = json_object['Metadata']['Locations']
+    first_order = 1 + features.num_phlebs
+    expertise_lists = required_expertises(orders_df)
+
+    repaired = 0
+    dropped = sorted(zip(model['Nodes Dropped'], model['Revenues Dropped']), key=lambda drop: -drop[1]) #most valuable orders first
+    for node, revenue in dropped:
+        order = orders_df.iloc[node - first_order]
+        phleb_idx = MA.commit_order_insertion(json_object, locations[node]['Coordinate'], int(features.servicing_times[node]),
+                                              expertise_lists[node - first_order], provider, order_start=order['order_start'],
+                                              order_capacity=int(order['capacity_needed']), location_idx=node)
+        if phleb_idx is None:
+            continue
+        position = model['Nodes Dropped'].index(node)
+        del model['Nodes Dropped'][position], model['Revenues Dropped'][position]
+        model['Total Number of Nodes Dropped'] -= 1
+        model['Total Revenue Lost'] -= revenue
+        repaired += 1
+    model['Orders Repaired'] = repaired
+    return repaired
+
+
+def relocate_boundary_orders(json_object, orders_df, features, order_zones, phleb_zones, provider, boundary_ratio = BOUNDARY_RATIO):
+    """
+    Relocate pass over the zone boundaries: every served order whose position is close to another zone (another zone's centre
+    is at most boundary_ratio times further than the centre of the zone serving it) is moved into the cheapest feasible gap of
+    that zone's phlebotomists when this lowers the total travel time, i.e. when taking it out of its route saves more travel time
+    than it adds to the other route. Every move strictly lowers the total travel time, so orders never move back and forth.
+    Returns the number of orders relocated.
+    """
+    model = json_object['Model']
+    locations = json_object['Metadata']['Locations']
+    first_order = 1 + features.num_phlebs
+    expertise_lists = required_expertises(orders_df)
+
+    # Distance of every order to the centre of every zone
+    order_coords = orders_df[['lat', 'long']].to_numpy(dtype=float)
+    centroids = np.array([order_coords[order_zones == zone].mean(axis=0) for zone in range(phleb_zones.max() + 1)])
+    distances = np.linalg.norm(order_coords[:, None, :] - centroids[None, :, :], axis=2)
+
+    relocated = 0
+    for phleb_idx, phleb_route in enumerate(json_object['Routes']):
+        zone = phleb_zones[phleb_idx]
+        position = 1
+        while position < len(phleb_route['Locations Sequence']) - 1:
+            node = phleb_route['Locations Sequence'][position]
+            order_idx = node - first_order
+            near_zones = np.flatnonzero(distances[order_idx] <= boundary_ratio * distances[order_idx, zone])
+            near_zones = near_zones[near_zones != zone]
+            removal = MA.order_removal(json_object, phleb_idx, position, provider) if len(near_zones) else None
+            if removal is not None and removal[0] > 0:
+                order = orders_df.iloc[order_idx]
+                near_phlebs = set(np.flatnonzero(np.isin(phleb_zones, near_zones)).tolist())
+                target = MA.commit_order_insertion(json_object, locations[node]['Coordinate'], int(features.servicing_times[node]),
+                                                   expertise_lists[order_idx], provider, order_start=order['order_start'],
+                                                   order_capacity=int(order['capacity_needed']), location_idx=node,
+                                                   phleb_indices=near_phlebs, max_added_travel_time=removal[0] - 1)
+                if target is not None:
+                    MA.commit_order_removal(json_object, phleb_idx, position, removal, int(order['capacity_needed']))
+                    relocated += 1
+                    continue #the next order is now at this position
+            position += 1
+    model['Orders Relocated'] = relocated
+    return relocated
+
+
+def required_expertises(orders_df):
+    """List of the expertises required by each order, e.g. ['expertise_regular', 'expertise_premium']."""
+    service_cols = orders_df.columns[orders_df.columns.str.contains('service')]
+    expertise_names = np.array(["expertise_{}".format(service.split("_")[1]) for service in service_cols])
+    return [expertise_names[row].tolist() for row in orders_df[service_cols].fillna(0).to_numpy() == 1]
+
+
+def run_algorithm_decomposed(orders_df, catchments_df, phlebs_df, api_key, n_zones = None, max_workers = None, cache = None, provider = None, profile = 'balanced', seed = 0):
+    """
+    Decomposition mode of run_algorithm for city-scale instances: orders and phlebotomists are clustered into zones (cluster_zones),
+    each zone is solved as an independent sub-problem in a process pool, then the zone routes are merged and orders dropped
+    at the zone boundaries are repaired by insertion into neighbouring zones (repair_boundaries). A zone without a solution does not
+    fail the whole run: its orders are dropped and repaired into other routes. Finally, served orders near a zone boundary are
+    moved into the routes of the neighbouring zone when this lowers the travel time (relocate_boundary_orders).
+
+    n_zones: Number of zones, defaults to one zone per ORDERS_PER_ZONE orders.
+
+    max_workers: Number of processes solving zones in parallel, defaults to the number of CPUs. 1 solves every zone in-process.
+
+    Returns the Optimal Routes in JSON format, in the same format as run_algorithm, with per-zone statistics under Model/Zones
+    (Model/Objective Number is None, see merge_zone_routes for Model/Zone Objectives Sum) and the number of orders repaired and relocated under Model/Orders Repaired and Model/Orders Relocated.
+    """
+    provider = MA.resolve_provider(provider, api_key, cache)
+    orders_df = orders_df.reset_index(drop=True)
+    phlebs_df = phlebs_df.reset_index(drop=True)
+    if n_zones is None:
+        n_zones = int(np.ceil(len(orders_df) / ORDERS_PER_ZONE))
+
+    order_zones, phleb_zones = cluster_zones(orders_df, phlebs_df, n_zones, seed)
+    zone_args = [(zone, orders_df[order_zones == zone].reset_index(drop=True), catchments_df,
+                  phlebs_df[phleb_zones == zone].reset_index(drop=True), api_key, provider, profile)
+                 for zone in np.unique(order_zones)]
+
+    if max_workers == 1 or len(zone_args) == 1:
+        zone_results = [_solve_zone(args) for args in zone_args]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            zone_results = list(executor.map(_solve_zone, zone_args))
+
+    features = FE.build_features(orders_df, catchments_df, phlebs_df)
+    json_object = merge_zone_routes([(zone, result if result.startswith('Routing Status') else json.loads(result), solve_time)
+                                     for zone, result, solve_time in zone_results], order_zones, phleb_zones, features, provider)
+    repair_boundaries(json_object, orders_df, features, provider)
+    relocate_boundary_orders(json_object, orders_df, features, order_zones, phleb_zones, provider)
+
+    return json.dumps(json_object, indent=2, cls=MA.npEncoder)
@@ -1,109 +1,171 @@
 import json
+import threading
+import time
 import urllib
+import urllib.error
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
 
-def create_time_matrix(address_list, api):
-    addresses = address_list
-    API_key = api
+# Defaults of the concurrent Distance Matrix fetcher, can be overridden per call of fetch_time_matrix
+MAX_WORKERS = 8
+ELEMENTS_PER_SECOND = 1000 # Distance Matrix API's default quota of elements per second
+MAX_RETRIES = 3
+RETRY_BACKOFF = 1.0 # seconds, doubled after every failed attempt
+REQUEST_TIMEOUT = (5, 30) # seconds to connect and to wait for the response, so that a stalled request is retried instead of hanging
+RETRYABLE_STATUSES = ('OVER_QUERY_LIMIT',) # Distance Matrix API statuses worth retrying, the others fail the same way every time
 
+def create_time_matrix(address_list, api, cache=None):
+    """
+    Builds the square Time Matrix (in minutes) between every pair of addresses in address_list.
+    If a TravelTimeCache is given, only the pairs missing from the cache are requested from the Distance Matrix API.
+    """
+    return get_time_matrix(address_list, address_list, api, cache=cache)
+
+
+def get_time_matrix(origin_addresses, dest_addresses, API_key, cache=None, bucket=None):
+    """
+    Builds the len(origin_addresses) x len(dest_addresses) Time Matrix (in minutes).
+
+    cache: Optional TravelTimeCache. Pairs found in the cache are reused, and only the missing pairs
+            are sent to the Distance Matrix API. The fetched pairs are then stored back into the cache.
+    bucket: Optional time-of-day bucket of the cache (see TravelTimeCache.time_bucket), defaults to the single bucket
+            used when no departure time is sent to the API.
+    """
+    if cache is None:
+        return fetch_time_matrix(origin_addresses, dest_addresses, API_key)
+
+    bucket = cache.time_bucket() if bucket is None else bucket
+    time_matrix, found = cache.get_many(origin_addresses, dest_addresses, bucket)
+    if found.all():
+        return time_matrix
+
+    # Group the origins by which destinations they are missing, so that e.g. a single new address only costs
+    # one new row and one new column instead of re-fetching the whole matrix
+    missing_groups = {}
+    for i in np.where(~found.all(axis=1))[0]:
+        missing_groups.setdefault(tuple(np.where(~found[i])[0]), []).append(i)
+
+    for missing_cols, missing_rows in missing_groups.items():
+        missing_origins = [origin_addresses[i] for i in missing_rows]
+        missing_dests = [dest_addresses[j] for j in missing_cols]
+        fetched = fetch_time_matrix(missing_origins, missing_dests, API_key)
+        time_matrix[np.ix_(missing_rows, missing_cols)] = fetched
+        cache.put_many(missing_origins, missing_dests, fetched, bucket)
+    return time_matrix
+
+
+def fetch_time_matrix(origin_addresses, dest_addresses, API_key, max_workers=MAX_WORKERS, elements_per_second=ELEMENTS_PER_SECOND,
+                      max_retries=MAX_RETRIES, retry_backoff=RETRY_BACKOFF):
     '''
-    Distance Matrix API only accepts 100 elements per request, so we need to get rows in multiple requests.
-    Maximum number of rows that can be computed per request is 9 (9 * 9 = 81).
+    Distance Matrix API only accepts 100 elements per request, so we need to get the matrix in multiple requests.
+    Maximum number of rows/columns that can be computed per request is 9 (9 * 9 = 81).
 
-    Below shows the toy example of a complete 2-D array (Time Matrix) that we are aiming for.
+    Below shows the toy example of a complete 2-D array (Time Matrix) that we are aiming for,
+    where every 9 x 9 block (and the remaining r rows/columns at the edges) is fetched by a single request.
     1 ... 9 r ... n*r
     .
     .
     9 ... 9 r ... n*r
-    r ... 9 r ... n*r    
-    
+    r ... 9 r ... n*r
+
+    All blocks are scheduled at once on a pool of max_workers threads sharing one pooled HTTP session,
+    while keeping under elements_per_second. A block that fails with a transient error (see is_transient) is retried
+    up to max_retries times, waiting retry_backoff seconds (doubled after every attempt) in between; other errors are raised straight away.
+    Each block is written straight into its place of the preallocated Time Matrix.
     '''
     max_rows = 9
-    num_addresses = len(addresses)  
-    # Formula: num_addresses = q * max_rows + r 
-    q, r = divmod(num_addresses, max_rows)
-    dest_addresses = addresses
-    time_matrix = []
-    for i in range(q):
-        '''
-        This is where we are computing the Top Left Square of the 2-D Time Matrix:
-        ----------
-        |1 ... 9 |r ... n*r
-        |.       |
-        |.       |
-        |9 ... 9 |r ... n*r
-        ----------
-        r ... 9 r ... n*r 
-
-        '''
-        row_time_matrix = []
-        origin_addresses = addresses[i * max_rows: (i + 1) * max_rows]
-        for j in range(q):
-            dest_addresses = addresses[j * max_rows: (j + 1) * max_rows]
-            response = send_request(origin_addresses, dest_addresses, API_key)
-            if len(row_time_matrix) == 0:
-                row_time_matrix += build_time_matrix(response)
-            else:
-                for numRow  in range(len(row_time_matrix)):
-                    row_time_matrix[numRow] += build_time_matrix(response)[numRow]
-        if r > 0:
-            '''
-            This is where we are computing the Top Right Square of the 2-D Time Matrix:
-                    -----------
-            1 ... 9 |r ... n*r|
-            .       |         |
-            .       |         |
-            9 ... 9 |r ... n*r|
-                    -----------
-            r ... 9 r ... n*r 
-            
-            '''
-            dest_addresses_r = addresses[(q * max_rows): (q * max_rows) + r]
-            response = send_request(origin_addresses, dest_addresses_r, API_key)
-            for numRow  in range(len(row_time_matrix)):
-                    row_time_matrix[numRow] += build_time_matrix(response)[numRow]
+    time_matrix = np.zeros((len(origin_addresses), len(dest_addresses)), dtype=np.int64)
+    blocks = [(i, j) for i in range(0, len(origin_addresses), max_rows) for j in range(0, len(dest_addresses), max_rows)]
+    if len(blocks) == 0:
+        return time_matrix
 
-        time_matrix += row_time_matrix
+    rate_limiter = RateLimiter(elements_per_second)
 
-    if r > 0:
-        '''
-            This is where we are computing the Bottom of the 2-D Time Matrix:
-            
-            1 ... 9 r ... n*r
-            .                
-            .                
-            9 ... 9 r ... n*r
-            -------------------
-           | r ... 9 r ... n*r |
-            -------------------
-        '''
-        row_time_matrix = []
-        origin_addresses = addresses[q * max_rows: q * max_rows + r]
-        for j in range(q):
-            dest_addresses = dest_addresses = addresses[j * max_rows: (j + 1) * max_rows]
-            response = send_request(origin_addresses, dest_addresses, API_key)
-            if len(row_time_matrix) == 0:
-                row_time_matrix += build_time_matrix(response)
-            else:
-                for numRow  in range(len(row_time_matrix)):
-                    row_time_matrix[numRow] += build_time_matrix(response)[numRow]
-        
-        dest_addresses_r = addresses[(q * max_rows): (q * max_rows) + r]
-        response = send_request(origin_addresses, dest_addresses_r, API_key)
-        if len(row_time_matrix) == 0:
-                row_time_matrix += build_time_matrix(response)
-        else:
-            for numRow in range(len(row_time_matrix)):
-                row_time_matrix[numRow] += build_time_matrix(response)[numRow]
+    def fetch_block(i, j):
+        origins = origin_addresses[i: i + max_rows]
+        dests = dest_addresses[j: j + max_rows]
+        for attempt in range(max_retries + 1):
+            rate_limiter.acquire(len(origins) * len(dests))
+            try:
+                response = send_request(origins, dests, API_key, session)
+                if response.get('status', 'OK') != 'OK':
+                    raise DistanceMatrixError(response['status'], response.get('error_message'))
+                return i, j, build_time_matrix(response)
+            except Exception as e:
+                if attempt == max_retries or not is_transient(e):
+                    raise
+                time.sleep(retry_backoff * 2 ** attempt)
 
-        time_matrix += row_time_matrix
-        
+    with create_session(max_workers) as session:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(blocks))) as executor:
+            futures = [executor.submit(fetch_block, i, j) for i, j in blocks]
+            for future in as_completed(futures):
+                i, j, block = future.result()
+                block = np.array(block, dtype=np.int64)
+                time_matrix[i: i + block.shape[0], j: j + block.shape[1]] = block
     return time_matrix
 
 
-def send_request(origin_addresses, dest_addresses, API_key):
-    """ Build and send request for the given origin and destination addresses."""
+class DistanceMatrixError(RuntimeError):
+    """ Request rejected by the Distance Matrix API, along with the status it returned (e.g. REQUEST_DENIED)."""
+    def __init__(self, status, message=None):
+        super().__init__('Distance Matrix API returned status {}{}'.format(status, ': ' + message if message else ''))
+        self.status = status
+
+
+def is_transient(error):
+    """ Whether a failed request may succeed when retried: connection errors, timeouts, 5xx responses and OVER_QUERY_LIMIT."""
+    if isinstance(error, DistanceMatrixError):
+        return error.status in RETRYABLE_STATUSES
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, TimeoutError)):
+        return True
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code >= 500
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code >= 500
+    return isinstance(error, urllib.error.URLError) #connection errors of urllib
+
+
+def create_session(pool_size=MAX_WORKERS):
+    """ HTTP session keeping up to pool_size connections alive, so that concurrent requests reuse them."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    return session
+
+
+class RateLimiter:
+    """ Thread-safe token bucket allowing at most `rate` elements per second (no limit if rate is None)."""
+    def __init__(self, rate):
+        self.rate = rate
+        self._allowance = rate
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, elements):
+        if self.rate is None:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                # A single request larger than the rate is let through once the bucket is full
+                self._allowance = min(max(self.rate, elements), self._allowance + (now - self._last) * self.rate)
+                self._last = now
+                if self._allowance >= elements:
+                    self._allowance -= elements
+                    return
+                wait = (elements - self._allowance) / self.rate
+            time.sleep(wait)
+
+
+def send_request(origin_addresses, dest_addresses, API_key, session=None, timeout=REQUEST_TIMEOUT):
+    """
+    Build and send request for the given origin and destination addresses, through the HTTP session if given.
+    timeout: (connect, read) timeouts in seconds; without a session, the read timeout bounds every socket operation.
+    """
     def build_address_str(addresses):
         # Build a pipe-separated string of addresses
         address_str = ''
@@ -121,8 +183,13 @@ def send_request(origin_addresses, dest_addresses, API_key):
     dest_address_str = build_address_str(dest_addresses)
     request = request + '&origins=' + origin_address_str + '&destinations=' + \
         dest_address_str + '&key=' + API_key
-    
-    with urllib.request.urlopen(request) as url:
+
+    if session is not None:
+        response = session.get(request, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+    with urllib.request.urlopen(request, timeout=timeout[1]) as url:
         jsonResult = url.read()
         response = json.loads(jsonResult)
         return response
@@ -143,6 +210,122 @@ def build_time_matrix(response):
 Other Preprocessing Codes
 '''
 
+class FeatureBundle:
+    """
+    All the inputs of the Matching Algorithm, built in a single pass over the 3 dataframes by build_features.
+    Per-location arrays follow the locations of the Time Matrix: ending depot (Index 0), phlebotomists' starting locations, then orders.
+
+    addresses: Coordinates of every location, same as get_coordinates_list.
+
+    time_windows: int32 array of shape (number of locations, 2), same as get_timeWindows_list.
+
+    servicing_times, demands: int32 arrays, same as get_servicingTimes_list and get_orderCapacities_list.
+
+    revenues: float array, same as get_orderRevenues_list.
+
+    vehicle_capacities, cost_rating_weight: Arrays with one value per phlebotomist, same as get_phlebCapacities_list and get_weightedRatingCost_list.
+
+    eligible: Boolean matrix of shape (number of orders, number of phlebotomists), see get_serviceExpertiseConstraint_matrix.
+
+    expertises: The same constraints as (indptr, indices) arrays, see get_serviceExpertiseConstraint_list(..., as_csr=True).
+
+    metadata: Same dictionary as get_metadata, only built the first time it is accessed (i.e. when the Optimal Routes are serialized).
+    """
+    def __init__(self, num_catchments, addresses, time_windows, servicing_times, revenues, demands, vehicle_capacities,
+                 cost_rating_weight, eligible, order_ids, phleb_ids, phleb_expertises):
+        self.num_catchments = num_catchments
+        self.num_phlebs = len(phleb_ids)
+        self.num_orders = len(order_ids)
+        self.addresses = addresses
+        self.time_windows = time_windows
+        self.servicing_times = servicing_times
+        self.revenues = revenues
+        self.demands = demands
+        self.vehicle_capacities = vehicle_capacities
+        self.cost_rating_weight = cost_rating_weight
+        self.eligible = eligible
+
+        indptr = np.zeros(self.num_phlebs + 1 + self.num_orders + 1, dtype=np.int32)
+        np.cumsum(np.concatenate([np.full(self.num_phlebs + 1, self.num_phlebs), eligible.sum(axis=1)]), out=indptr[1:])
+        indices = np.concatenate([np.tile(np.arange(self.num_phlebs, dtype=np.int32), self.num_phlebs + 1),
+                                  np.nonzero(eligible)[1].astype(np.int32)])
+        self.expertises = (indptr, indices)
+
+        self.order_ids = order_ids
+        self.phleb_ids = phleb_ids
+        self.phleb_expertises = phleb_expertises
+        self._metadata = None
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self._metadata = self.build_metadata()
+        return self._metadata
+
+    def build_metadata(self):
+        if self.num_catchments == 1:
+            order_ids = ["Ending Location"]
+            addresses_list = self.addresses[:1]
+        else:
+            order_ids = ["Placeholder"]
+            addresses_list = ["Placeholder"]
+        order_ids.extend(["Starting Location" for _ in range(self.num_phlebs)])
+        order_ids.extend(self.order_ids)
+        addresses_list.extend(self.addresses[self.num_catchments:])
+        if self.num_catchments > 1:
+            order_ids.extend(["Ending Location" for _ in range(self.num_catchments)])
+            addresses_list.extend(self.addresses[:self.num_catchments])
+
+        metadata = {'Locations': [{"Location Index": idx, "Coordinate": address, "Order Id": str(order_id)}
+                                  for idx, (address, order_id) in enumerate(zip(addresses_list, order_ids))]}
+        metadata['Phlebotomists'] = [{"Phlebotomist Index": idx, "Id": phleb_id, "Expertise": expertise, "Capacity": capacity}
+                                     for idx, (phleb_id, expertise, capacity) in enumerate(zip(self.phleb_ids, self.phleb_expertises, self.vehicle_capacities.tolist()))]
+        return metadata
+
+
+def build_features(orders_df, catchments_df, phlebs_df, rating_weight = 1, cost_weight = 1):
+    """
+    Reads the 3 dataframes once and returns a FeatureBundle with every input of the Matching Algorithm as typed NumPy arrays,
+    replacing the separate get_* functions (which are kept for reference and give the same values).
+    """
+    numPhleb = phlebs_df.shape[0]
+    numOrder = orders_df.shape[0]
+    numFixed = numPhleb + 1 #ending depot and starting locations
+
+    def addresses(df):
+        return (df['lat'].astype(str) + ',' + df['long'].astype(str)).tolist()
+    address_list = addresses(catchments_df) + addresses(phlebs_df) + addresses(orders_df)
+
+    time_windows = np.empty((numFixed + numOrder, 2), dtype=np.int32)
+    time_windows[0] = (6 * 60, 18 * 60) #ending depot
+    shift_start = phlebs_df['shift_start'].to_numpy()
+    time_windows[1:numFixed, 0] = shift_start.astype(np.int64) * 60
+    time_windows[1:numFixed, 1] = (shift_start.astype(np.int64) + 1) * 60
+    order_start = orders_df['order_start'].to_numpy()
+    time_windows[numFixed:, 0] = order_start.astype(np.int64) * 60
+    time_windows[numFixed:, 1] = (order_start + 1).astype(np.int64) * 60
+
+    servicing_times = np.zeros(numFixed + numOrder, dtype=np.int32)
+    servicing_times[numFixed:] = (orders_df['duration'] + orders_df['buffer']).to_numpy()
+
+    revenues = np.ones(numFixed + numOrder, dtype=float)
+    revenues[numFixed:] = orders_df['price'].to_numpy()
+
+    demands = np.zeros(numFixed + numOrder, dtype=np.int32)
+    demands[numFixed:] = orders_df['capacity_needed'].to_numpy()
+
+    vehicle_capacities = phlebs_df['capacity'].to_numpy().astype(np.int32)
+    cost_rating_weight = get_weightedRatingCost_list(phlebs_df, rating_weight, cost_weight).to_numpy(dtype=float)
+
+    expertise_cols = phlebs_df.columns[phlebs_df.columns.str.contains('expertise')]
+    has_expertise = phlebs_df[expertise_cols].to_numpy() == 1
+    phleb_expertises = [expertise_cols[row].tolist() for row in has_expertise]
+
+    return FeatureBundle(catchments_df.shape[0], address_list, time_windows, servicing_times, revenues, demands,
+                         vehicle_capacities, cost_rating_weight, get_serviceExpertiseConstraint_matrix(orders_df, phlebs_df),
+                         orders_df['order_id'].tolist(), phlebs_df['phleb_id'].tolist(), phleb_expertises)
+
+
 def get_coordinates_list(orders_df, catchments_df, phlebs_df):
     orders_df = orders_df.astype({'long': str, 'lat': str})
     catchments_df = catchments_df.astype({'long': str, 'lat': str})
@@ -204,33 +387,44 @@ def get_orderCapacities_list(orders_df, catchments_df, phlebs_df):
 def get_phlebCapacities_list(orders_df, catchments_df, phlebs_df):
     return phlebs_df['capacity'].tolist() 
 
-def get_serviceExpertiseConstraint_list(orders_df, catchments_df, phlebs_df):
-    orders_df_copy = orders_df.copy().reset_index()
-    phlebs_df_copy = phlebs_df.copy().reset_index()
-
-    def find_applicable_exp(row):
-        args = np.empty(0)
-        for val in row:
-            args = np.append(args, val)
-        idx = [args == 1]
-        service_needs = service_cols[idx[0]]
-
-        expertiseName = "expertise_{}".format(service_needs[0].split("_")[1])
-        temp = phlebs_df_copy.loc[(phlebs_df_copy[expertiseName] == 1)]
-
-        if len(service_needs) > 1:
-            for service in service_needs[1:]:
-                expertiseName = "expertise_{}".format(service.split("_")[1])
-                temp = temp.loc[(temp[expertiseName] == 1)]  
-        return temp.index.to_list()
-    
-    numPhleb = phlebs_df_copy.shape[0]
-    all_columns = orders_df_copy.columns
+def get_serviceExpertiseConstraint_matrix(orders_df, phlebs_df):
+    """
+    Boolean matrix of shape (number of orders, number of phlebotomists), True where the phlebotomist holds every expertise
+    required by the order's services. Computed with a single product of the order x service matrix against the phlebotomist x expertise matrix.
+    """
+    all_columns = orders_df.columns
     service_cols = all_columns[all_columns.str.contains('service')]
-    orders_df_copy['Acceptable Phleb Indices'] = orders_df_copy[service_cols].apply(find_applicable_exp, axis=1)
+    expertise_cols = ["expertise_{}".format(service.split("_")[1]) for service in service_cols]
+
+    required = (orders_df[service_cols].fillna(0).to_numpy() == 1).astype(np.int32) #orders x services
+    lacking = np.ones((phlebs_df.shape[0], len(expertise_cols)), dtype=np.int32) #phlebs x services, 1 where the expertise is missing
+    for col_idx, expertise in enumerate(expertise_cols):
+        if expertise in phlebs_df.columns:
+            lacking[:, col_idx] = phlebs_df[expertise].fillna(0).to_numpy() != 1
+
+    #A phlebotomist is eligible when none of the required services is lacking
+    return (required @ lacking.T) == 0
+
+def get_serviceExpertiseConstraint_list(orders_df, catchments_df, phlebs_df, as_csr = False):
+    """
+    For each location, the list of phlebotomist indices that can service it (trivially 1 for the ending depot and starting locations).
+    If as_csr is True, the constraints are returned in compressed sparse row format instead, as a tuple of (indptr, indices) int32 arrays
+    covering every location, where the phlebotomists allowed at location i are indices[indptr[i]:indptr[i+1]]
+    (all phlebotomists for the ending depot and the starting locations).
+    """
+    numPhleb = phlebs_df.shape[0]
+    eligible = get_serviceExpertiseConstraint_matrix(orders_df, phlebs_df)
+
+    if as_csr:
+        eligible = np.vstack([np.ones((numPhleb + 1, numPhleb), dtype=bool), eligible]) #ending depot and starting locations
+        indptr = np.zeros(len(eligible) + 1, dtype=np.int32)
+        np.cumsum(eligible.sum(axis=1), out=indptr[1:])
+        indices = np.nonzero(eligible)[1].astype(np.int32)
+        return indptr, indices
+
     expertises = [1] #ending depot
     expertises.extend([1 for _ in range(numPhleb)])
-    expertises.extend(orders_df_copy['Acceptable Phleb Indices'])
+    expertises.extend(np.flatnonzero(row).tolist() for row in eligible)
     return expertises
 
 def get_metadata(orders_df, catchments_df, phlebs_df):
@@ -250,9 +444,9 @@ def get_metadata(orders_df, catchments_df, phlebs_df):
         addresses_list = get_coordinates_list(orders_df, catchments_df, phlebs_df)
         locations_metadata = zip(addresses_list, order_ids)
 
-        phlebs_metadata = zip(phlebs_df['phleb_id'], phlebs_df['Expertises Unpivoted'])
+        phlebs_metadata = zip(phlebs_df['phleb_id'], phlebs_df['Expertises Unpivoted'], phlebs_df['capacity'])
         metadata = {'Locations': [{"Location Index": idx, "Coordinate": metadata[0], "Order Id": str(metadata[1])}for idx, metadata in enumerate(locations_metadata)]}
-        metadata['Phlebotomists'] = [{"Phlebotomist Index": idx, "Id": fields[0], "Expertise": fields[1].tolist()}for idx, fields in enumerate(phlebs_metadata)]
+        metadata['Phlebotomists'] = [{"Phlebotomist Index": idx, "Id": fields[0], "Expertise": fields[1].tolist(), "Capacity": fields[2]}for idx, fields in enumerate(phlebs_metadata)]
     else:
     #If there more than 1 catchment area, index 0 will just be a trivial placeholder, so not to disrupt other inputs' format, 
     # and we will add ending catchments to the End instead
@@ -260,12 +454,15 @@ def get_metadata(orders_df, catchments_df, phlebs_df):
         order_ids.extend(["Starting Location" for _ in range(numPhleb)])
         order_ids.extend(orders_df['order_id'])
         order_ids.extend(["Ending Location" for _ in range(numCatchment)]) #catchment areas
+        #Coordinates in the same order as the Order Ids: Placeholder, phlebotomists, orders, then catchment areas
+        coordinates_list = get_coordinates_list(orders_df, catchments_df, phlebs_df)
         addresses_list = ["Placeholder"]
-        addresses_list.extend(get_coordinates_list(orders_df, catchments_df, phlebs_df))
+        addresses_list.extend(coordinates_list[numCatchment:])
+        addresses_list.extend(coordinates_list[:numCatchment])
         locations_metadata = zip(addresses_list, order_ids)
 
-        phlebs_metadata = zip(phlebs_df['phleb_id'], phlebs_df['Expertises Unpivoted'])
+        phlebs_metadata = zip(phlebs_df['phleb_id'], phlebs_df['Expertises Unpivoted'], phlebs_df['capacity'])
         metadata = {'Locations': [{"Location Index": idx, "Coordinate": metadata[0], "Order Id": str(metadata[1])}for idx, metadata in enumerate(locations_metadata)]}
-        metadata['Phlebotomists'] = [{"Phlebotomist Index": idx, "Id": fields[0], "Expertise": fields[1].tolist()}for idx, fields in enumerate(phlebs_metadata)]
+        metadata['Phlebotomists'] = [{"Phlebotomist Index": idx, "Id": fields[0], "Expertise": fields[1].tolist(), "Capacity": fields[2]}for idx, fields in enumerate(phlebs_metadata)]
     
     return metadata
\ No newline at end of file
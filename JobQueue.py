@@ -0,0 +1,309 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor
+
+MAX_WORKERS_ENV = 'ROUTES_MAX_WORKERS' # environment variable setting the number of concurrent solves of the API
+
+MAX_FINISHED_JOBS = 1000 # finished jobs kept for their results, the oldest ones are forgotten first
+
+
+def max_workers_from_env(default=None):
+    """Number of concurrent solves from the ROUTES_MAX_WORKERS environment variable, defaults to the number of CPUs."""
+    value = os.environ.get(MAX_WORKERS_ENV)
+    if value:
+        return max(1, int(value))
+    return default if default is not None else os.cpu_count()
+
+
+def _run_with_progress(fn, progress_queue, stop_event, args, kwargs):
+    # Runs in a worker process: fn reports each improving solution to the queue and stops once the event is set
+    if stop_event.is_set(): #cancelled before the worker picked it up
+        raise CancelledError()
+    return fn(*args, progress_callback=progress_queue.put, cancel_event=stop_event, **kwargs)
+
+
+class Job:
+    """
+    A function call submitted to a JobQueue, along with its future, timestamps and progress (if tracked).
+    The future is the JobQueue's own: it is pending while the job waits in the queue, and running once the job is sent to a worker.
+    """
+    def __init__(self, job_id, future, description=None, progress_queue=None, stop_event=None, key=None, call=None):
+        self.id = job_id
+        self.future = future
+        self.call = call # (fn, args, kwargs) until the job is sent to a worker
+        self.description = description
+        self.key = key
+        self.cached = False
+        self.submitted = time.time()
+        self.finished = None
+        self.cancelled = False
+        self.stopped = False
+        self.progress_queue = progress_queue
+        self.stop_event = stop_event
+        self.progress = []
+
+    def drain_progress(self):
+        # Moves the solutions reported by the worker so far into self.progress
+        if self.progress_queue is None:
+            return
+        while True:
+            try:
+                self.progress.append(self.progress_queue.get_nowait())
+            except queue.Empty:
+                return
+
+    @property
+    def status(self):
+        if self.cancelled or self.future.cancelled():
+            return 'cancelled'
+        if not self.future.done():
+            return 'running' if self.future.running() else 'queued'
+        return 'failed' if self.future.exception() is not None else 'done'
+
+    def to_dict(self):
+        status = self.status
+        job = {'id': self.id, 'status': status, 'submitted': self.submitted, 'finished': self.finished,
+               'elapsed': (self.finished or time.time()) - self.submitted}
+        if self.description is not None:
+            job['description'] = self.description
+        if self.cached:
+            job['cached'] = True
+        if self.progress_queue is not None:
+            job['solutions'] = len(self.progress)
+            job['best'] = self.progress[-1] if self.progress else None
+            job['stopped'] = self.stopped
+        if status == 'failed':
+            job['error'] = repr(self.future.exception())
+        return job
+
+
+class JobQueue:
+    """
+    Local job queue of the API: solves are submitted as jobs and run in a bounded process pool, so that the request threads
+    return straight away with a job id instead of holding a server worker for the whole solve. Jobs beyond max_workers wait
+    in the JobQueue, in submission order, and are only sent to the pool once a worker is free, so that they can still be
+    cancelled. Only finished jobs are ever forgotten, the oldest first beyond max_finished.
+
+    max_workers: Number of concurrent solves, defaults to ROUTES_MAX_WORKERS or the number of CPUs (see max_workers_from_env).
+
+    max_finished: Number of finished (done, failed or cancelled) jobs whose status and result are kept.
+
+    result_cache: Optional ResultCache, where the results of the jobs submitted with a key are stored once they are done.
+    """
+    def __init__(self, max_workers=None, max_finished=MAX_FINISHED_JOBS, result_cache=None):
+        self.max_workers = max_workers if max_workers is not None else max_workers_from_env()
+        self.max_finished = max_finished
+        self.result_cache = result_cache
+        self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        self.manager = None # started with the first job tracking its progress
+        self.jobs = OrderedDict()
+        self.pending = deque() # jobs waiting for a free worker
+        self.running = 0 # jobs sent to the pool and not finished yet
+        self.in_flight = {} # key -> id of the queued or running job solving it
+        self.lock = threading.RLock() # reentrant, as the callback of a job already done runs straight away in submit
+
+    def submit(self, fn, *args, description=None, track_progress=False, key=None, **kwargs):
+        """
+        Queues fn(*args, **kwargs) to run in the process pool (fn must be picklable, e.g. a module-level function), returns the job id.
+
+        track_progress: fn also takes progress_callback and cancel_event (as run_algorithm does): each improving solution is
+                then reported to the job (see progress), and the job can be stopped early with its best solution so far (see stop).
+
+        key: Identifies the problem solved by fn, e.g. its problem_fingerprint. If a job with the same key is already queued or
+                running, its id is returned instead of queuing the same solve twice; if the result is in the result cache,
+                a job already done with that result is returned.
+        """
+        with self.lock:
+            if key is not None:
+                if key in self.in_flight:
+                    return self.in_flight[key]
+                result = self.result_cache.get(key) if self.result_cache is not None else None
+                if result is not None:
+                    return self.add_finished(result, description, key)
+
+            job_id = uuid.uuid4().hex
+            progress_queue = stop_event = None
+            call = (fn, args, kwargs)
+            if track_progress:
+                if self.manager is None:
+                    self.manager = multiprocessing.Manager()
+                progress_queue, stop_event = self.manager.Queue(), self.manager.Event()
+                call = (_run_with_progress, (fn, progress_queue, stop_event, args, kwargs), {})
+            future = Future()
+            job = Job(job_id, future, description, progress_queue, stop_event, key, call)
+            future.add_done_callback(lambda _: self.on_done(job))
+            self.jobs[job_id] = job
+            if key is not None:
+                self.in_flight[key] = job_id
+            self.pending.append(job)
+            self.forget_finished()
+            self.dispatch()
+        return job_id
+
+    def dispatch(self):
+        # Sends the pending jobs to the pool while workers are free, skipping the ones cancelled while they waited
+        with self.lock:
+            while self.pending and self.running < self.max_workers:
+                job = self.pending.popleft()
+                if not job.future.set_running_or_notify_cancel():
+                    continue
+                fn, args, kwargs = job.call
+                job.call = None
+                self.running += 1
+                pool_future = self.executor.submit(fn, *args, **kwargs)
+                pool_future.add_done_callback(lambda pool_future, job=job: self.on_worker_done(job, pool_future))
+
+    def on_worker_done(self, job, pool_future):
+        # Hands the outcome of the worker to the job's future, then frees the worker for the next pending job
+        if pool_future.cancelled():
+            job.future.set_exception(CancelledError())
+        elif pool_future.exception() is not None:
+            job.future.set_exception(pool_future.exception())
+        else:
+            job.future.set_result(pool_future.result())
+        with self.lock:
+            self.running -= 1
+            self.dispatch()
+
+    def add_finished(self, result, description=None, key=None):
+        # Job already done with a cached result
+        future = Future()
+        future.set_result(result)
+        job = Job(uuid.uuid4().hex, future, description, key=key)
+        job.cached = True
+        job.finished = job.submitted
+        self.jobs[job.id] = job
+        self.forget_finished()
+        return job.id
+
+    def on_done(self, job):
+        if job.finished is None: #not already set by cancel
+            job.finished = time.time()
+        # Only complete solves with a solution are cached, not the plans accepted early with stop nor the 'Routing Status: ...'
+        # of solves without a solution (e.g. a time limit too short for the instance), which may succeed when retried.
+        # The result is cached before the key is released, so that an identical submission never misses both.
+        if (self.result_cache is not None and job.key is not None and not (job.cancelled or job.stopped)
+                and not job.future.cancelled() and job.future.exception() is None):
+            result = job.future.result()
+            if not (isinstance(result, str) and result.startswith('Routing Status')):
+                self.result_cache.put(job.key, result)
+        with self.lock:
+            self.release(job)
+
+    def release(self, job):
+        # Later submissions of the same key start a new job instead of joining this one
+        if job.key is not None and self.in_flight.get(job.key) == job.id:
+            del self.in_flight[job.key]
+
+    def forget_finished(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.future.done() or job.cancelled]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id):
+        """The Job of job_id, None if it is unknown (or was forgotten)."""
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def status(self, job_id):
+        """
+        Status of the job as a dictionary (id, status, timestamps, and error if it failed), None if it is unknown.
+        Jobs tracking their progress also have the number of solutions found so far and the best one.
+        """
+        job = self.get(job_id)
+        if job is None:
+            return None
+        with self.lock:
+            job.drain_progress()
+            return job.to_dict()
+
+    def progress(self, job_id, start=0):
+        """
+        Improving solutions reported by the job from the start-th one (objective, number of nodes dropped and elapsed seconds),
+        None if the job is unknown. Empty for jobs not tracking their progress.
+        """
+        job = self.get(job_id)
+        if job is None:
+            return None
+        with self.lock:
+            job.drain_progress()
+            return job.progress[start:]
+
+    def stop(self, job_id):
+        """
+        Accepts the best solution found so far: the solve of a running job tracking its progress stops at its next solution,
+        and the job finishes with that plan as its result. Returns False if the job is unknown, not running or not tracking its progress.
+        """
+        job = self.get(job_id)
+        if job is None or job.stop_event is None or not job.future.running() or job.cancelled:
+            return False
+        job.stopped = True
+        job.stop_event.set()
+        with self.lock:
+            self.release(job)
+        return True
+
+    def result(self, job_id):
+        """
+        Result of a finished job. Raises KeyError if the job is unknown, CancelledError if it was cancelled,
+        TimeoutError if it is not finished yet, and the job's exception if it failed.
+        """
+        job = self.get(job_id)
+        if job is None:
+            raise KeyError(job_id)
+        if job.cancelled:
+            raise CancelledError()
+        return job.future.result(timeout=0)
+
+    def wait(self, job_id, timeout=None):
+        """
+        Waits for the job to finish and returns its result. Raises KeyError if the job is unknown, CancelledError if it was
+        cancelled, TimeoutError if it is not finished within timeout seconds, and the job's exception if it failed.
+        """
+        job = self.get(job_id)
+        if job is None:
+            raise KeyError(job_id)
+        result = job.future.result(timeout=timeout)
+        if job.cancelled:
+            raise CancelledError()
+        return result
+
+    def cancel(self, job_id):
+        """
+        Cancels the job. A queued job is removed from the queue and never reaches a worker; a running one is marked cancelled
+        and its result discarded (its solve is also stopped at its next solution if it tracks its progress, freeing the worker).
+        Returns False if the job is unknown or already finished.
+        """
+        job = self.get(job_id)
+        if job is None or job.future.done() or job.cancelled:
+            return False
+        with self.lock:
+            self.release(job)
+            if job.future.cancel(): #still waiting for a worker
+                self.pending.remove(job)
+                job.call = None
+                return True
+        job.cancelled = True
+        job.finished = time.time()
+        if job.stop_event is not None:
+            job.stop_event.set()
+        return True
+
+    def list(self):
+        """Status of every job known to the queue, in submission order."""
+        with self.lock:
+            jobs = list(self.jobs.values())
+        return [job.to_dict() for job in jobs]
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            while self.pending:
+                self.pending.popleft().future.cancel()
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+        if self.manager is not None:
+            self.manager.shutdown()
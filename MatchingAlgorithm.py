@@ -1,9 +1,26 @@
 from ortools.constraint_solver import routing_enums_pb2
 from ortools.constraint_solver import pywrapcp
 import FeatureEngineering as FE
+import TravelTimeCache as TTC
+import TravelTimeProviders as TTP
 import numpy as np
+import hashlib
 import json
+import os
+import time
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+try:
+    import orjson # optional, faster serialisation of the compact JSON output
+except ImportError:
+    orjson = None
+try:
+    import pyarrow as pa # optional, Arrow and Parquet formats of RouteTable
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+MAX_TIME = 10000 # arbitrarily large maximum slack and ending time of the Time dimension
 
 def create_data_model(time_matrix, time_window, revenues, num_vehicles, servicing_times, expertiseConstraints, orders_capacities, phlebs_capacities,  cost_rating_weight, metadata):
     """
@@ -42,38 +59,455 @@ def create_data_model(time_matrix, time_window, revenues, num_vehicles, servicin
     cost_rating_weight: A 1-d array for each phlebotomist's "cost" - weighted by Service Rating and Cost to represent as cost for the matching algorithm.
 
     metadata: A dictionary containing important information of the Orders and Phlebotomists (e.g. Order ID, Phleb ID, etc).
+            May be None when the data model is built by build_data_model, see data_metadata.
     
     """
     data = {}
 
     data['metadata'] = metadata
 
-    data['cost_rating_weight'] = [int(inv * 1) for inv in cost_rating_weight]   #ensure the value is integer as the algorithm only accepts integer
+    data['cost_rating_weight'] = np.asarray(cost_rating_weight, dtype=float).astype(np.int32)   #ensure the value is integer as the algorithm only accepts integer
+
+    time_matrix_np = np.asarray(time_matrix)
 
     #Important! To ensure Revenue Lost is larger than the overall transit time in order to ensure the "penalty" is effective during routing optimization
-    data['revenue_potential'] = [int(revenue * np.sum(time_matrix[1])) for revenue in revenues] 
-    
-    time_matrix_np = np.array(time_matrix)
-    # Take into account of servicing times
-    for col_idx in range(len(servicing_times)):
-        time_matrix_np[:, col_idx] += servicing_times[col_idx]
-    
-    data['time_matrix'] = time_matrix_np
+    #The scale is computed once and kept, so that the actual Revenue Lost can be recovered from the penalties afterwards
+    data['revenue_scale'] = int(np.sum(time_matrix_np[1]))
+    data['revenue_potential'] = (np.asarray(revenues, dtype=float) * data['revenue_scale']).astype(np.int64)
+
+    # Take into account of servicing times, added to every column at once
+    servicing_times = np.asarray(servicing_times, dtype=np.int32)
+    data['time_matrix'] = (time_matrix_np + servicing_times[np.newaxis, :]).astype(np.int32)
 
-    data['time_windows'] = time_window
+    data['time_windows'] = np.asarray(time_window, dtype=np.int32)
 
     data['num_vehicles'] = num_vehicles
     data['starts'] = [i for i in range(1, num_vehicles+1)] #start locations
     data['ends'] = [0 for _ in range(num_vehicles)] #end location
     
-    data['demands'] = orders_capacities
-    data['vehicle_capacities'] = phlebs_capacities
+    data['demands'] = np.asarray(orders_capacities, dtype=np.int32)
+    data['vehicle_capacities'] = np.asarray(phlebs_capacities, dtype=np.int32)
     data['servicing_times'] = servicing_times
 
     data['expertises'] = expertiseConstraints
 
     return data
 
+def build_data_model(orders_df, catchments_df, phlebs_df, time_matrix, features=None):
+    """
+    Generates all the features from the 3 dataframes in a single pass (FeatureEngineering.build_features, unless a FeatureBundle
+    is given as features), and returns the dictionary of create_data_model. The metadata is only built when the output is serialized.
+    """
+    if features is None:
+        features = FE.build_features(orders_df, catchments_df, phlebs_df)
+
+    data = create_data_model(time_matrix, features.time_windows, features.revenues, features.num_phlebs, features.servicing_times, features.expertises,
+                             features.demands, features.vehicle_capacities, features.cost_rating_weight, None)
+    data['features'] = features
+    return data
+
+def data_metadata(data):
+    """Metadata of the dictionary of create_data_model, built from its FeatureBundle the first time it is needed."""
+    if data['metadata'] is None and 'features' in data:
+        data['metadata'] = data['features'].metadata
+    return data['metadata']
+
+def register_transit_matrix(routing, manager, time_matrix):
+    """
+    Registers the Time Matrix as the transit callback. OR-tools calls it millions of times during the search,
+    so the matrix is handed over to C++ when possible, instead of calling back into Python for every arc.
+    """
+    if hasattr(routing, 'RegisterTransitMatrix'):
+        return routing.RegisterTransitMatrix(time_matrix.tolist())
+    # Older OR-tools: precompute the matrix in routing index space, so the callback is a plain lookup without IndexToNode
+    index_to_node = [manager.IndexToNode(index) for index in range(routing.Size() + routing.vehicles())]
+    index_matrix = time_matrix[np.ix_(index_to_node, index_to_node)].tolist()
+    routing.transit_lookup = lambda from_index, to_index: index_matrix[from_index][to_index] # kept alive with the model
+    return routing.RegisterTransitCallback(routing.transit_lookup)
+
+def register_demand_vector(routing, manager, demands):
+    """Same as register_transit_matrix, for the demand of each node."""
+    if hasattr(routing, 'RegisterUnaryTransitVector'):
+        return routing.RegisterUnaryTransitVector(demands.tolist())
+    index_demands = demands[[manager.IndexToNode(index) for index in range(routing.Size() + routing.vehicles())]].tolist()
+    routing.demand_lookup = lambda from_index: index_demands[from_index] # kept alive with the model
+    return routing.RegisterUnaryTransitCallback(routing.demand_lookup)
+
+# Named solver profiles, from sub-second answers for the dispatcher UI to long overnight batch runs.
+# time_limit, lns_time_limit and stagnation_time are in seconds; solution_limit and stagnation_time can be None (no limit).
+# stagnation_time stops the search early once the best objective has not improved for that long.
+SOLVER_PROFILES = {
+    'interactive': {
+        'time_limit': 0.8,
+        'solution_limit': None,
+        'first_solution_strategy': 'PARALLEL_CHEAPEST_INSERTION', # far better than Path Cheapest Arc when there is little time to improve
+        'metaheuristic': 'GUIDED_LOCAL_SEARCH',
+        'lns_time_limit': 0.05,
+        'stagnation_time': 0.3,
+        'log_search': False,
+    },
+    'balanced': {
+        'time_limit': 30,
+        'solution_limit': None,
+        'first_solution_strategy': 'PATH_CHEAPEST_ARC',
+        'metaheuristic': 'GUIDED_LOCAL_SEARCH',
+        'lns_time_limit': 0.1,
+        'stagnation_time': 10,
+        'log_search': False,
+    },
+    'overnight': {
+        'time_limit': 600,
+        'solution_limit': None,
+        'first_solution_strategy': 'PARALLEL_CHEAPEST_INSERTION',
+        'metaheuristic': 'GUIDED_LOCAL_SEARCH',
+        'lns_time_limit': 1,
+        'stagnation_time': 120,
+        'log_search': False,
+    },
+}
+
+def get_solver_profile(profile='balanced', **overrides):
+    """
+    Returns the settings of a solver profile. profile is either the name of one of SOLVER_PROFILES,
+    or a dictionary of settings completing the 'balanced' profile. Keyword arguments override single settings.
+    """
+    if isinstance(profile, str):
+        if profile not in SOLVER_PROFILES:
+            raise ValueError("Unknown solver profile '{}', expected one of {}".format(profile, list(SOLVER_PROFILES)))
+        settings = dict(SOLVER_PROFILES[profile])
+    else:
+        settings = dict(SOLVER_PROFILES['balanced'], **profile)
+    settings.update(overrides)
+    return settings
+
+def create_search_parameters(settings):
+    """Builds OR-tools search parameters from the settings of get_solver_profile."""
+    search_parameters = pywrapcp.DefaultRoutingSearchParameters()
+    search_parameters.first_solution_strategy = getattr(
+        routing_enums_pb2.FirstSolutionStrategy, settings['first_solution_strategy'])
+    search_parameters.local_search_metaheuristic = getattr(
+        routing_enums_pb2.LocalSearchMetaheuristic, settings['metaheuristic'])
+    search_parameters.time_limit.FromMilliseconds(int(settings['time_limit'] * 1000))
+    search_parameters.lns_time_limit.FromMilliseconds(int(settings['lns_time_limit'] * 1000))
+    if settings['solution_limit'] is not None:
+        search_parameters.solution_limit = settings['solution_limit']
+    search_parameters.log_search = settings['log_search']
+    if settings.get('gls_lambda') is not None:
+        search_parameters.guided_local_search_lambda_coefficient = settings['gls_lambda']
+    return search_parameters
+
+def default_search_parameters(time_limit=30):
+    """Search parameters of the Matching Algorithm: Path Cheapest Arc, improved by Guided Local Search for time_limit seconds."""
+    return create_search_parameters(get_solver_profile('balanced', time_limit=time_limit))
+
+
+# Search configurations run side by side by solve_portfolio, as overrides of the solver profile
+PORTFOLIO_CONFIGS = [
+    {'first_solution_strategy': 'PARALLEL_CHEAPEST_INSERTION', 'metaheuristic': 'GUIDED_LOCAL_SEARCH'},
+    {'first_solution_strategy': 'PATH_CHEAPEST_ARC', 'metaheuristic': 'GUIDED_LOCAL_SEARCH'},
+    {'first_solution_strategy': 'LOCAL_CHEAPEST_INSERTION', 'metaheuristic': 'GUIDED_LOCAL_SEARCH'},
+    {'first_solution_strategy': 'PARALLEL_CHEAPEST_INSERTION', 'metaheuristic': 'SIMULATED_ANNEALING'},
+    {'first_solution_strategy': 'PATH_CHEAPEST_ARC', 'metaheuristic': 'TABU_SEARCH'},
+    {'first_solution_strategy': 'SAVINGS', 'metaheuristic': 'GUIDED_LOCAL_SEARCH'},
+    {'first_solution_strategy': 'GLOBAL_CHEAPEST_ARC', 'metaheuristic': 'GUIDED_LOCAL_SEARCH'},
+    {'first_solution_strategy': 'LOCAL_CHEAPEST_INSERTION', 'metaheuristic': 'GENERIC_TABU_SEARCH'},
+]
+
+def get_portfolio_settings(n_workers, profile='balanced', seed=0):
+    """
+    Settings of each solve of the portfolio: the profile itself first, then the other configurations of PORTFOLIO_CONFIGS in turn.
+    OR-tools routing has no random seed parameter, so beyond that the Guided Local Search configurations are repeated
+    with a penalty factor (lambda) drawn from the seed instead.
+    """
+    rng = np.random.default_rng(seed)
+    base = get_solver_profile(profile, log_search=False)
+    configs = [{}] + [config for config in PORTFOLIO_CONFIGS
+                      if (config['first_solution_strategy'], config['metaheuristic']) != (base['first_solution_strategy'], base['metaheuristic'])]
+    gls_configs = [config for config in configs[1:] if config['metaheuristic'] == 'GUIDED_LOCAL_SEARCH']
+    portfolio = []
+    for worker in range(n_workers):
+        if worker < len(configs):
+            config = configs[worker]
+        else:
+            config = dict(gls_configs[worker % len(gls_configs)], gls_lambda=float(rng.uniform(0.05, 0.5)))
+        portfolio.append(dict(base, **config))
+    return portfolio
+
+def _solve_portfolio_member(member_args):
+    # Runs in a worker process: builds the model from the data model and solves it with one configuration
+    data, settings, enforce_end_window, initial_routes, catchments_coordinates, provider = member_args
+    start = time.monotonic()
+    engine = RoutingEngine(data, enforce_end_window)
+    solution = engine.solve(create_search_parameters(settings), settings['stagnation_time'], initial_routes)
+    stats = {'First Solution Strategy': settings['first_solution_strategy'], 'Metaheuristic': settings['metaheuristic'],
+             'GLS Lambda': settings.get('gls_lambda'), 'Status': engine.routing.status(), 'Solve Time': time.monotonic() - start,
+             'Objective Number': solution.ObjectiveValue() if solution else None, 'Warm Start Ignored': engine.warm_start_ignored}
+    if not solution:
+        return stats, None
+    if catchments_coordinates is not None:
+        return stats, output_jsonify_verMultiEnds(data, engine.manager, engine.routing, solution, catchments_coordinates, None, provider=provider, compact=True)
+    return stats, engine.output_jsonify(solution, compact=True)
+
+def solve_portfolio(data, n_workers, profile='balanced', seed=0, enforce_end_window=False, initial_routes=None, catchments_coordinates=None, provider=None):
+    """
+    Portfolio solving: n_workers solves of the same data model run in a process pool, each with different search settings
+    (see get_portfolio_settings) and the time limit of the profile, so the spare cores search different parts of the solution space
+    within the same wall-clock time. Returns the Optimal Routes of the best objective, with the statistics of every worker under
+    Model/Portfolio. catchments_coordinates and provider are only needed for the Multi-catchment output.
+    As the time limit is in wall-clock time, n_workers should not exceed the number of CPUs (True uses all of them).
+    """
+    if n_workers is True:
+        n_workers = os.cpu_count()
+    portfolio = get_portfolio_settings(n_workers, profile, seed)
+    member_args = [(data, settings, enforce_end_window, initial_routes, catchments_coordinates, provider) for settings in portfolio]
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        results = list(executor.map(_solve_portfolio_member, member_args))
+
+    solved = [(stats['Objective Number'], worker) for worker, (stats, result) in enumerate(results) if result is not None]
+    if not solved:
+        return 'Routing Status: ' + str([stats['Status'] for stats, _ in results])
+
+    best = min(solved)[1]
+    json_object = json.loads(results[best][1])
+    json_object['Model']['Portfolio'] = [dict(stats, Worker=worker, Best=(worker == best)) for worker, (stats, _) in enumerate(results)]
+    return json.dumps(json_object, indent=2, cls=npEncoder)
+
+
+def allowed_vehicles(expertises, location_idx):
+    """Phlebotomists allowed at a location, from either format of FeatureEngineering.get_serviceExpertiseConstraint_list."""
+    if isinstance(expertises, tuple):
+        indptr, indices = expertises
+        return indices[indptr[location_idx]:indptr[location_idx + 1]]
+    return expertises[location_idx]
+
+def initial_routes_from_json(routes_json, data):
+    """
+    Converts previously generated Optimal Routes (JSON string or dictionary in the format of output_jsonify) into
+    the initial routes of RoutingEngine.solve, for the nodes of the new data model.
+    Orders and Phlebotomists are matched by their Ids, as their indices may have changed. Orders that no longer exist
+    (or that the phlebotomist is no longer allowed to service) are dropped, and new orders are left for the search to insert.
+    """
+    previous = json.loads(routes_json) if isinstance(routes_json, str) else routes_json
+    previous_locations = previous['Metadata']['Locations']
+    previous_phlebs = previous['Metadata']['Phlebotomists']
+    metadata = data_metadata(data)
+    num_vehicles = data['num_vehicles']
+    num_nodes = len(data['time_matrix'])
+
+    order_nodes = {metadata['Locations'][node]['Order Id']: node for node in range(num_vehicles + 1, num_nodes)}
+    vehicles = {phleb['Id']: idx for idx, phleb in enumerate(metadata['Phlebotomists'])}
+
+    initial_routes = [[] for _ in range(num_vehicles)]
+    assigned = set()
+    for route in previous['Routes']:
+        vehicle_id = vehicles.get(previous_phlebs[route['Phlebotomist Index']]['Id'])
+        if vehicle_id is None:
+            continue
+        for location_idx in route['Locations Sequence'][1:-1]: #Starting and Ending Locations are not part of the routes
+            node = order_nodes.get(previous_locations[location_idx]['Order Id'])
+            if node is None or node in assigned or vehicle_id not in allowed_vehicles(data['expertises'], node):
+                continue
+            initial_routes[vehicle_id].append(node)
+            assigned.add(node)
+    return initial_routes
+
+class RoutingEngine:
+    """
+    OR-tools routing model of the Matching Algorithm, built once from the dictionary of create_data_model.
+    The same model can then be solved several times, e.g. with different search parameters or time limits, without being rebuilt.
+    Note that OR-tools closes the model with the parameters of the first solve, so later solves can only change
+    the search itself (strategies, metaheuristics, limits).
+
+    data: Dictionary of features generated by create_data_model.
+
+    enforce_end_window: If True, phlebotomists must reach the ending location (Index 0) by the end of its time window.
+    """
+    def __init__(self, data, enforce_end_window=False):
+        self.data = data
+        self.solution = None
+        self.warm_start_ignored = False # set by solve when the initial routes were infeasible
+        self.closed = False # the model is closed by the first solve, and can only be closed once
+        self.stagnation_time = None
+        self.best_cost = float('inf')
+        self.last_improvement = time.monotonic()
+        self.solve_start = self.last_improvement
+        self.progress = []
+        self.progress_callback = None
+        self.cancel_event = None
+
+        # Create the routing index manager.
+        self.manager = pywrapcp.RoutingIndexManager(len(data['time_matrix']),
+                                                    data['num_vehicles'],
+                                                    data['starts'],
+                                                    data['ends']
+                                                    )
+        manager = self.manager
+
+        # Create Routing Model.
+        self.routing = pywrapcp.RoutingModel(manager)
+        routing = self.routing
+
+        # Create and register a transit callback, evaluated natively by OR-tools.
+        transit_callback_index = register_transit_matrix(routing, manager, data['time_matrix'])
+
+        # Define cost of each arc.
+        routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
+
+        '''Add demand_callback '''
+        demand_callback_index = register_demand_vector(routing, manager, data['demands'])
+        routing.AddDimensionWithVehicleCapacity(
+            demand_callback_index,
+            0,  # null capacity slack
+            data['vehicle_capacities'].tolist(),  # vehicle maximum capacities
+            True,  # start cumul to zero
+            'Capacity')
+
+        routing.AddDimension(
+            transit_callback_index,
+            MAX_TIME,  # arbitratrily large maximum Slack time 
+            MAX_TIME,  # arbitratrily large maximum ending time per vehicle 
+            False,  # Don't force start cumul to zero.
+            'Time')
+        time_dimension = routing.GetDimensionOrDie('Time')
+        self.time_dimension = time_dimension
+
+        #Add preference to phlebotomists with better service quality and/or lower cost
+        for vehicle_id in range(data["num_vehicles"]):
+            time_dimension.SetSpanCostCoefficientForVehicle(int(data['cost_rating_weight'][vehicle_id]), int(vehicle_id))
+
+        # Add time window constraints for each location except depot
+        for location_idx, time_window in enumerate(data['time_windows']):
+            if location_idx == 0:
+                continue
+            index = manager.NodeToIndex(location_idx)
+            time_dimension.CumulVar(index).SetRange(int(time_window[0] + data['servicing_times'][location_idx]), int(time_window[1] + data['servicing_times'][location_idx]))
+            routing.AddToAssignment(time_dimension.SlackVar(index))
+
+        # Add time window constraints for each vehicle start node (and end node if enforced).
+        for vehicle_id in range(data["num_vehicles"]):
+            index_start = routing.Start(vehicle_id)
+            time_dimension.CumulVar(index_start).SetRange(
+                int(data["time_windows"][0][0]), int(data["time_windows"][0][1]))
+            if enforce_end_window:
+                index_end = routing.End(vehicle_id)
+                time_dimension.CumulVar(index_end).SetMax(int(data["time_windows"][0][1]))
+            routing.AddToAssignment(time_dimension.SlackVar(index_start))
+
+        # Allow to drop nodes.
+        for node in range(data['num_vehicles'] + 1, len(data['time_matrix'])): #Starting Location should be omitted
+            penalty = int(data['revenue_potential'][node])
+            routing.AddDisjunction([manager.NodeToIndex(node)], penalty)
+
+        for i in range(data["num_vehicles"]):
+            routing.AddVariableMinimizedByFinalizer(
+                time_dimension.CumulVar(routing.Start(i))
+            )
+            routing.AddVariableMinimizedByFinalizer(
+                time_dimension.CumulVar(routing.End(i))
+            )
+
+        #Add Service-Expertise Constraints
+        for location_idx in range(data['num_vehicles'] + 1, len(data['time_matrix'])):
+            expConstraints = allowed_vehicles(data['expertises'], location_idx)
+            if len(expConstraints) == data['num_vehicles']:
+                continue #every phlebotomist can service this location, nothing to restrict
+
+            index = manager.NodeToIndex(location_idx)
+            vehicles = [-1]
+            vehicles.extend(int(vehicle) for vehicle in expConstraints)
+            routing.VehicleVar(index).SetValues(vehicles)
+
+        # Called by OR-tools for every solution accepted during the search, to stop early when it stagnates.
+        routing.AddAtSolutionCallback(self.on_solution)
+
+    def on_solution(self):
+        cost = self.routing.CostVar().Max()
+        now = time.monotonic()
+        if cost < self.best_cost:
+            self.best_cost = cost
+            self.last_improvement = now
+            if self.progress_callback is not None:
+                self.record_progress(cost, now)
+        elif self.stagnation_time is not None and now - self.last_improvement > self.stagnation_time:
+            self.routing.solver().FinishCurrentSearch()
+
+        # Stops the search, keeping the best solution found so far, e.g. once the caller accepts a good enough plan
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            self.routing.solver().FinishCurrentSearch()
+
+    def record_progress(self, cost, now):
+        # Called for every improving solution, while the variables hold the values of that solution
+        routing = self.routing
+        dropped = sum(1 for index in range(routing.Size()) if not routing.IsStart(index) and routing.NextVar(index).Value() == index)
+        entry = {'Objective Number': cost, 'Total Number of Nodes Dropped': dropped, 'Elapsed': now - self.solve_start}
+        self.progress.append(entry)
+        self.progress_callback(entry)
+
+    def solve(self, search_parameters=None, stagnation_time=None, initial_routes=None, progress_callback=None, cancel_event=None):
+        """
+        Solves the model with the given search parameters (default_search_parameters() if None) and returns the solution.
+        If stagnation_time is given, the search stops once the best objective has not improved for that many seconds.
+        If initial_routes is given (one list of node indices per vehicle, without start and end, see initial_routes_from_json),
+        the search starts from these routes instead of building a first solution from scratch. If they are not feasible anymore,
+        the model is solved from scratch and engine.warm_start_ignored is set (also reported as 'Warm Start Ignored' in the Model of the output).
+
+        progress_callback: Called with each improving solution's objective, number of nodes dropped and elapsed seconds
+                (also kept in engine.progress), e.g. to stream the progress of long solves.
+
+        cancel_event: threading or multiprocessing Event; once it is set, the search stops at the next solution and returns the best one so far.
+        """
+        if search_parameters is None:
+            search_parameters = default_search_parameters()
+        self.stagnation_time = stagnation_time
+        self.best_cost = float('inf')
+        self.last_improvement = time.monotonic()
+        self.solve_start = self.last_improvement
+        self.progress = []
+        self.progress_callback = progress_callback
+        self.cancel_event = cancel_event
+
+        initial_assignment = None
+        if initial_routes is not None:
+            if not self.closed:
+                self.routing.CloseModelWithParameters(search_parameters)
+                self.closed = True
+            initial_indices = [[self.manager.NodeToIndex(node) for node in route] for route in initial_routes]
+            initial_assignment = self.routing.ReadAssignmentFromRoutes(initial_indices, True)
+        self.warm_start_ignored = initial_routes is not None and initial_assignment is None
+        self.data['warm_start_ignored'] = self.warm_start_ignored
+
+        if initial_assignment is not None:
+            self.solution = self.routing.SolveFromAssignmentWithParameters(initial_assignment, search_parameters)
+        else:
+            self.solution = self.routing.SolveWithParameters(search_parameters)
+        self.closed = True
+        return self.solution
+
+    def solve_with_profile(self, profile='balanced', initial_routes=None, progress_callback=None, cancel_event=None, **overrides):
+        """Solves the model with one of SOLVER_PROFILES (or custom settings, see get_solver_profile)."""
+        settings = get_solver_profile(profile, **overrides)
+        return self.solve(create_search_parameters(settings), settings['stagnation_time'], initial_routes, progress_callback, cancel_event)
+
+    def output_jsonify(self, solution=None, printable=True, compact=False):
+        """Optimal Routes of the given (or last) solution in the JSON format of output_jsonify."""
+        solution = self.solution if solution is None else solution
+        return output_jsonify(self.data, self.manager, self.routing, solution, printable, compact)
+
+
+def resolve_cache(cache):
+    # None means the on-disk cache shared across runs, False disables caching
+    if cache is None:
+        return TTC.get_default_cache()
+    if cache is False:
+        return None
+    return cache
+
+def resolve_provider(provider, api_key, cache):
+    # Without an explicit provider, travel times are fetched live from Google Distance Matrix API
+    if provider is None:
+        return TTP.GoogleMapsProvider(api_key, resolve_cache(cache))
+    return provider
+
 class npEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, np.int32):
@@ -82,642 +516,1016 @@ class npEncoder(json.JSONEncoder):
             return int(obj)
         return json.JSONEncoder.default(self, obj)
 
-def output_jsonify(data, manager, routing, solution):
-    
-    output = {}
-    metadata = data['metadata']
-    output['Metadata'] = metadata
+def dumps_output(output, compact = False):
+    """
+    Serialises the Optimal Routes: indented JSON by default, or compact JSON (no whitespace, with orjson when it is installed)
+    for responses and intermediate results, which is both faster and several times smaller on large solutions.
+    """
+    if not compact:
+        return json.dumps(output, indent=2, cls=npEncoder)
+    if orjson is not None:
+        return orjson.dumps(output, option=orjson.OPT_SERIALIZE_NUMPY).decode('utf-8')
+    return json.dumps(output, separators=(',', ':'), cls=npEncoder)
 
+def extract_solution(data, manager, routing, solution):
+    """
+    Model and Routes (without 'Printable Route') of a solution, in the format of output_jsonify.
+    Each cumul and slack variable is read once into preallocated arrays, from which the sequences are derived.
+    """
     model = {}
-    routes = []
-
     model['Objective Number'] = solution.ObjectiveValue()
     model['Status'] = routing.status()
+    if data.get('warm_start_ignored'): #the initial routes were infeasible, see RoutingEngine.solve
+        model['Warm Start Ignored'] = True
 
     # Dropped Nodes/Customers
-    total_revenue_lost = 0
-    total_node_drops = 0
-    dropped_nodes = []
-    dropped_revenues = []
-    for node in range(routing.Size()):
-        if routing.IsStart(node) or routing.IsEnd(node):
-            continue
-        if solution.Value(routing.NextVar(node)) == node:
-            dropped_nodes.append(manager.IndexToNode(node))
-            dropped_revenues.append(data['revenue_potential'][manager.IndexToNode(node)] / sum(data['time_matrix'][0]))  #Get back the actual Revenue Lost
-            total_revenue_lost += data['revenue_potential'][manager.IndexToNode(node)] / sum(data['time_matrix'][0])
-            total_node_drops += 1
-    
-    model['Total Revenue Lost'] = total_revenue_lost
-    model["Total Number of Nodes Dropped"] = total_node_drops
+    dropped_nodes = [manager.IndexToNode(index) for index in range(routing.Size())
+                     if not routing.IsStart(index) and solution.Value(routing.NextVar(index)) == index]
+    dropped_revenues = (data['revenue_potential'][dropped_nodes] / data['revenue_scale']).tolist() #Get back the actual Revenue Lost
+
+    model['Total Revenue Lost'] = sum(dropped_revenues)
+    model["Total Number of Nodes Dropped"] = len(dropped_nodes)
     model["Nodes Dropped"] = dropped_nodes
     model["Revenues Dropped"] = dropped_revenues
-    
 
     # Routes
     time_dimension = routing.GetDimensionOrDie('Time')
+    time_matrix = data['time_matrix']
+    servicing_times = np.asarray(data['servicing_times'], dtype=np.int64)
+    demands = np.asarray(data['demands'], dtype=np.int64)
+    routes = []
     total_time = 0
     total_load = 0
     for vehicle_id in range(data['num_vehicles']):
-        index = routing.Start(vehicle_id)
-        prev_index = 0
+        indices = [routing.Start(vehicle_id)]
+        while not routing.IsEnd(indices[-1]):
+            indices.append(solution.Value(routing.NextVar(indices[-1])))
+
+        num_stops = len(indices)
+        nodes = np.empty(num_stops, dtype=np.int64)
+        end_times = np.empty((num_stops, 2), dtype=np.int64)
+        time_windows = np.empty((num_stops, 2), dtype=np.int64)
+        slack_times = np.empty((num_stops - 1, 2), dtype=np.int64)
+        for pos, index in enumerate(indices):
+            time_var = time_dimension.CumulVar(index)
+            nodes[pos] = manager.IndexToNode(index)
+            end_times[pos] = solution.Min(time_var), solution.Max(time_var)
+            time_windows[pos] = time_var.Min(), time_var.Max() #bounds of the model itself, not of the solution
+            if pos < num_stops - 1:
+                slack_var = time_dimension.SlackVar(index)
+                slack_times[pos] = solution.Min(slack_var), solution.Max(slack_var)
+
+        start_times = end_times.copy()
+        start_times[:-1] -= servicing_times[nodes[:-1], np.newaxis] #no servicing at the end of the route
+        travel_times = time_matrix[nodes[:-1], nodes[1:]] - servicing_times[nodes[1:]]
 
         phleb_route = {}
-        route_locations = []
-        route_startTimes =[]
-        route_endTimes = []
-        route_slackTimes = []
         phleb_route['Phlebotomist Index'] = vehicle_id
-
-        plan_output = 'Route for Phlebotomist {}:\n'.format(vehicle_id)
-
-        route_load = 0
-        total_transit_time = 0 
-        while not routing.IsEnd(index):
-            time_var = time_dimension.CumulVar(index)
-            slack_var = time_dimension.SlackVar(index)
-
-            node_index = manager.IndexToNode(index)
-            route_load += data['demands'][node_index]
-
-            plan_output += 'Location {0} Start({1},{2}) End({3}, {4}) -> Slack({5}, {6}) -> '.format(
-                manager.IndexToNode(index), 
-                solution.Min(time_var) - data['servicing_times'][node_index], solution.Max(time_var) - data['servicing_times'][node_index],
-                solution.Min(time_var) , solution.Max(time_var),
-                solution.Min(slack_var), solution.Max(slack_var))
-            
-            route_locations.append(manager.IndexToNode(index))
-            route_startTimes.append((solution.Min(time_var) - data['servicing_times'][node_index], solution.Max(time_var) - data['servicing_times'][node_index]))
-            route_endTimes.append((solution.Min(time_var) , solution.Max(time_var)))
-            route_slackTimes.append((solution.Min(slack_var), solution.Max(slack_var)))
-            
-            prev_index = index
-            index = solution.Value(routing.NextVar(index))
-      
-            total_transit_time = total_transit_time + data['time_matrix'][manager.IndexToNode(prev_index)][manager.IndexToNode(index)] - data['servicing_times'][manager.IndexToNode(index)]
-
-        total_time += total_transit_time
-        time_var = time_dimension.CumulVar(index)
-
-        plan_output += 'Location {0} Time({1},{2})\n'.format(manager.IndexToNode(index),
-                                                    solution.Min(time_var),
-                                                    solution.Max(time_var))
-        
-        route_locations.append(manager.IndexToNode(index))
-        route_startTimes.append((solution.Min(time_var),  solution.Max(time_var)))
-        route_endTimes.append((solution.Min(time_var) , solution.Max(time_var)))
-
-        phleb_route['Printable Route'] = plan_output
-        phleb_route['Total Travel Time'] = total_transit_time
-        phleb_route['Total Loads'] = route_load
-        phleb_route['Locations Sequence'] = route_locations
-        phleb_route['Start Times Sequence'] = route_startTimes
-        phleb_route['End Times Sequence'] = route_endTimes
-        phleb_route['Slack Times Sequence'] = route_slackTimes
-
+        phleb_route['Total Travel Time'] = int(travel_times.sum())
+        phleb_route['Total Loads'] = int(demands[nodes[:-1]].sum())
+        phleb_route['Locations Sequence'] = nodes.tolist()
+        phleb_route['Start Times Sequence'] = start_times.tolist()
+        phleb_route['End Times Sequence'] = end_times.tolist()
+        phleb_route['Slack Times Sequence'] = slack_times.tolist()
+        phleb_route['Travel Times Sequence'] = travel_times.tolist()
+        phleb_route['Time Windows Sequence'] = time_windows.tolist()
         routes.append(phleb_route)
 
-        total_load += route_load
-    
+        total_time += phleb_route['Total Travel Time']
+        total_load += phleb_route['Total Loads']
+
     model['Total Travel Time'] = total_time
     model['Total Loads'] = total_load
+    return model, routes
 
-    output['Model'] = model
-    output['Routes'] = routes
-
-    return json.dumps(output, indent=2, cls=npEncoder)
-
-
-def output_jsonify_verMultiEnds(data, manager, routing, solution, catchments_coordinates, api_key):
-    
-    output = {}
-    metadata = data['metadata']
-    output['Metadata'] = metadata
-
-    model = {}
-    routes = []
-
-    model['Objective Number'] = solution.ObjectiveValue()
-    model['Status'] = routing.status()
-
-    # Dropped Nodes/Customers
-    total_revenue_lost = 0
-    total_node_drops = 0
-    dropped_nodes = []
-    dropped_revenues = []
-    for node in range(routing.Size()):
-        if routing.IsStart(node) or routing.IsEnd(node):
-            continue
-        if solution.Value(routing.NextVar(node)) == node:
-            dropped_nodes.append(manager.IndexToNode(node))
-            dropped_revenues.append(data['revenue_potential'][manager.IndexToNode(node)] / sum(data['time_matrix'][1]))  #Get back the actual Revenue Lost
-            total_revenue_lost += data['revenue_potential'][manager.IndexToNode(node)] / sum(data['time_matrix'][0])
-            total_node_drops += 1
-    
-    model['Total Revenue Lost'] = total_revenue_lost
-    model["Total Number of Nodes Dropped"] = total_node_drops
-    model["Nodes Dropped"] = dropped_nodes
-    model["Revenues Dropped"] = dropped_revenues
-    
-
-    # Routes
-    time_dimension = routing.GetDimensionOrDie('Time')
-    total_time = 0
-    total_load = 0
-    for vehicle_id in range(data['num_vehicles']):
-        index = routing.Start(vehicle_id)
-        prev_index = 0
-
-        phleb_route = {}
-        route_locations = []
-        route_startTimes =[]
-        route_endTimes = []
-        route_slackTimes = []
-        phleb_route['Phlebotomist Index'] = vehicle_id
+def with_printable_route(phleb_route):
+    # 'Printable Route' goes right after 'Phlebotomist Index', as in the original output
+    return {'Phlebotomist Index': phleb_route['Phlebotomist Index'], 'Printable Route': printable_route(phleb_route), **phleb_route}
 
-        plan_output = 'Route for Phlebotomist {}:\n'.format(vehicle_id)
+def output_jsonify(data, manager, routing, solution, printable = True, compact = False):
+    """
+    Optimal Routes of the solution in JSON format. printable=False leaves out the 'Printable Route' text of each route,
+    compact=True gives compact JSON instead of indented JSON (see dumps_output).
+    """
+    model, routes = extract_solution(data, manager, routing, solution)
+    if printable:
+        routes = [with_printable_route(phleb_route) for phleb_route in routes]
+    return dumps_output({'Metadata': data_metadata(data), 'Model': model, 'Routes': routes}, compact)
 
-        route_load = 0
-        total_transit_time = 0 
-        while not routing.IsEnd(index):
-            time_var = time_dimension.CumulVar(index)
-            slack_var = time_dimension.SlackVar(index)
-
-            node_index = manager.IndexToNode(index)
-            route_load += data['demands'][node_index]
-
-            plan_output += 'Location {0} Start({1},{2}) End({3}, {4}) -> Slack({5}, {6}) -> '.format(
-                manager.IndexToNode(index), 
-                solution.Min(time_var) - data['servicing_times'][node_index], solution.Max(time_var) - data['servicing_times'][node_index],
-                solution.Min(time_var) , solution.Max(time_var),
-                solution.Min(slack_var), solution.Max(slack_var))
-            
-            route_locations.append(manager.IndexToNode(index))
-            route_startTimes.append((solution.Min(time_var) - data['servicing_times'][node_index], solution.Max(time_var) - data['servicing_times'][node_index]))
-            route_endTimes.append((solution.Min(time_var) , solution.Max(time_var)))
-            route_slackTimes.append((solution.Min(slack_var), solution.Max(slack_var)))
-            
-            prev_index = index
-            index = solution.Value(routing.NextVar(index))
-      
-            total_transit_time = total_transit_time + data['time_matrix'][manager.IndexToNode(prev_index)][manager.IndexToNode(index)] - data['servicing_times'][manager.IndexToNode(index)]
-
-        # Get the last location's coordinates 
-        last_location_idx = route_locations[-1]
-        last_location_coord = metadata['Locations'][last_location_idx]['Coordinate']
-
-        # Choose catchment with the lowest distance from the last location 
-        response = FE.send_request([last_location_coord], np.array(catchments_coordinates), api_key)
-        catchment_time_matrix = FE.build_time_matrix(response)[0]
-        selected_catchment_idx = np.argmin(catchment_time_matrix)
-        selected_catchment_idx_in_metadata =  selected_catchment_idx + len(data['time_matrix'])
-
-        reach_time = int(route_endTimes[-1][1]) + catchment_time_matrix[selected_catchment_idx]
-
-        plan_output += 'Location {0} Time({1},{2})\n'.format(selected_catchment_idx_in_metadata,
-                                                    reach_time,
-                                                    reach_time)
-        
-        total_transit_time += catchment_time_matrix[selected_catchment_idx]
-        total_time += total_transit_time
-        
-        route_locations.append(selected_catchment_idx_in_metadata)
-        route_startTimes.append((reach_time, reach_time))
-        route_endTimes.append((reach_time, reach_time))
-
-        phleb_route['Printable Route'] = plan_output
-        phleb_route['Total Travel Time'] = total_transit_time
-        phleb_route['Total Loads'] = route_load
-        phleb_route['Locations Sequence'] = route_locations
-        phleb_route['Start Times Sequence'] = route_startTimes
-        phleb_route['End Times Sequence'] = route_endTimes
-        phleb_route['Slack Times Sequence'] = route_slackTimes
 
-        routes.append(phleb_route)
+def multi_ends_time_matrix(orders_time_matrix, catchments_time_matrix):
+    """
+    Time Matrix of the Multi-catchment model. Index 0 is a dummy sink standing for every catchment area: the arc from a location
+    to the sink costs the travel time to the catchment area closest to that location, so the optimizer accounts for the drop-off
+    at the lab and chooses it along with the routes.
 
-        total_load += route_load
-    
-    model['Total Travel Time'] = total_time
-    model['Total Loads'] = total_load
+    orders_time_matrix: Time Matrix between the phlebotomists' starting locations and the orders.
 
-    output['Model'] = model
-    output['Routes'] = routes
+    catchments_time_matrix: Travel times from each of these locations to each catchment area.
 
-    return json.dumps(output, indent=2, cls=npEncoder)
+    Output is a tuple of (time_matrix, end_catchments), end_catchments being the catchment area reached from each location
+    through the sink (0 for the sink itself).
+    """
+    catchments_time_matrix = np.asarray(catchments_time_matrix, dtype=np.int64)
+    time_matrix = np.zeros((len(catchments_time_matrix) + 1, len(catchments_time_matrix) + 1), dtype=np.int64)
+    time_matrix[1:, 1:] = orders_time_matrix
+    time_matrix[1:, 0] = catchments_time_matrix.min(axis=1)
+    end_catchments = np.zeros(len(time_matrix), dtype=np.int64)
+    end_catchments[1:] = catchments_time_matrix.argmin(axis=1)
+    return time_matrix, end_catchments
+
+def extract_solution_verMultiEnds(data, manager, routing, solution, catchments_coordinates, api_key, cache=None, provider=None):
+    """
+    Same as extract_solution, with each route ending at its catchment area. The catchment area of each route is the one chosen by
+    the optimizer through data['end_catchments'] (see multi_ends_time_matrix); data models without it (sink reached at no cost)
+    get the catchment area closest to the last location of each route, with a single call to the provider for every route.
+    """
+    model, routes = extract_solution(data, manager, routing, solution)
+    last_locations = np.array([phleb_route['Locations Sequence'][-2] for phleb_route in routes], dtype=np.int64)
 
+    if 'end_catchments' in data:
+        selected_catchments = data['end_catchments'][last_locations]
+    else:
+        # Choose catchment with the lowest distance from the last location
+        metadata = data_metadata(data)
+        provider = resolve_provider(provider, api_key, cache)
+        last_coords = [metadata['Locations'][location]['Coordinate'] for location in last_locations.tolist()]
+        unique_coords = list(dict.fromkeys(last_coords))
+        catchment_time_matrix = np.asarray(provider.get_time_matrix(unique_coords, catchments_coordinates), dtype=np.int64)
+        positions = np.array([unique_coords.index(coord) for coord in last_coords], dtype=np.int64)
+        selected_catchments = catchment_time_matrix[positions].argmin(axis=1)
+        catchment_times = catchment_time_matrix[positions, selected_catchments]
+
+    for route_idx, phleb_route in enumerate(routes):
+        phleb_route['Locations Sequence'][-1] = int(selected_catchments[route_idx]) + len(data['time_matrix'])
+        if 'end_catchments' in data:
+            continue #the leg to the catchment area and the arrival there are already part of the solution
+
+        catchment_time = int(catchment_times[route_idx])
+        reach_time = phleb_route['End Times Sequence'][-2][1] + catchment_time
+        phleb_route['Total Travel Time'] += catchment_time
+        model['Total Travel Time'] += catchment_time
+        phleb_route['Travel Times Sequence'][-1] = catchment_time
+        phleb_route['Start Times Sequence'][-1] = [reach_time, reach_time]
+        phleb_route['End Times Sequence'][-1] = [reach_time, reach_time]
+
+    return model, routes
+
+def output_jsonify_verMultiEnds(data, manager, routing, solution, catchments_coordinates, api_key, cache=None, provider=None, printable = True, compact = False):
+    """Same as output_jsonify, with each route ending at its catchment area (see extract_solution_verMultiEnds)."""
+    model, routes = extract_solution_verMultiEnds(data, manager, routing, solution, catchments_coordinates, api_key, cache, provider)
+    if printable:
+        routes = [with_printable_route(phleb_route) for phleb_route in routes]
+    return dumps_output({'Metadata': data_metadata(data), 'Model': model, 'Routes': routes}, compact)
+
+
+class RouteTable:
+    """
+    Columnar form of the Optimal Routes, an alternative to the JSON string for large plans: one row per stop of every route
+    in flat NumPy arrays (see STOP_COLUMNS), with the stops of route r at rows route_offsets[r] to route_offsets[r+1].
+    The Metadata and Model blocks are kept once as dictionaries. Consumers such as SlotIndex, reverse_getVacancy_algorithm,
+    visualise_routes and the Prescriptive Analysis accept it in place of the JSON, so the plan is not re-parsed by each of them.
 
-def run_algorithm(orders_df, catchments_df, phlebs_df, api_key, isMultiEnds = False):
-    
+    The last stop of a route has no slack and no travel time to a next stop, their columns hold -1 there.
+    """
+    STOP_COLUMNS = ('phleb_idx', 'position', 'location_idx', 'order_id', 'start_min', 'start_max', 'end_min', 'end_max',
+                    'slack_min', 'slack_max', 'travel_time', 'window_min', 'window_max')
+
+    def __init__(self, metadata, model, route_offsets, route_travel_times, route_loads, stops):
+        self.metadata = metadata
+        self.model = model
+        self.route_offsets = np.asarray(route_offsets, dtype=np.int64)
+        self.route_travel_times = np.asarray(route_travel_times, dtype=np.int64)
+        self.route_loads = np.asarray(route_loads, dtype=np.int64)
+        self.stops = stops
+
+    @classmethod
+    def from_routes(cls, metadata, model, routes):
+        """From the Metadata, Model and Routes blocks of the Optimal Routes, e.g. from extract_solution."""
+        lengths = np.array([len(phleb_route['Locations Sequence']) for phleb_route in routes], dtype=np.int64)
+        route_offsets = np.concatenate([[0], np.cumsum(lengths)])
+
+        def pairs(key, pad):
+            # Every route's (min, max) pairs stacked into one N x 2 array, padded with (-1, -1) for sequences without the last stop
+            rows = []
+            for phleb_route in routes:
+                rows.extend(phleb_route[key])
+                rows.extend([(-1, -1)] * pad)
+            return np.array(rows, dtype=np.int64).reshape(-1, 2)
+
+        locations = np.array([location for phleb_route in routes for location in phleb_route['Locations Sequence']], dtype=np.int64)
+        start_times, end_times, slack_times, time_windows = pairs('Start Times Sequence', 0), pairs('End Times Sequence', 0), pairs('Slack Times Sequence', 1), pairs('Time Windows Sequence', 0)
+        stops = {
+            'phleb_idx': np.repeat([phleb_route['Phlebotomist Index'] for phleb_route in routes], lengths).astype(np.int64),
+            'position': np.arange(len(locations), dtype=np.int64) - np.repeat(route_offsets[:-1], lengths),
+            'location_idx': locations,
+            'order_id': np.array([metadata['Locations'][location]['Order Id'] for location in locations.tolist()], dtype=str),
+            'start_min': start_times[:, 0], 'start_max': start_times[:, 1],
+            'end_min': end_times[:, 0], 'end_max': end_times[:, 1],
+            'slack_min': slack_times[:, 0], 'slack_max': slack_times[:, 1],
+            'travel_time': np.array([travel_time for phleb_route in routes for travel_time in phleb_route['Travel Times Sequence'] + [-1]], dtype=np.int64),
+            'window_min': time_windows[:, 0], 'window_max': time_windows[:, 1],
+        }
+        return cls(metadata, model, route_offsets, [phleb_route['Total Travel Time'] for phleb_route in routes],
+                   [phleb_route['Total Loads'] for phleb_route in routes], stops)
+
+    @classmethod
+    def from_solution(cls, data, manager, routing, solution, catchments_coordinates=None, provider=None):
+        """From a solution of the model, as output_jsonify (or output_jsonify_verMultiEnds if catchments_coordinates is given)."""
+        if catchments_coordinates is not None:
+            model, routes = extract_solution_verMultiEnds(data, manager, routing, solution, catchments_coordinates, None, provider=provider)
+        else:
+            model, routes = extract_solution(data, manager, routing, solution)
+        return cls.from_routes(data_metadata(data), model, routes)
+
+    @classmethod
+    def from_json(cls, algo_routes_json):
+        """From the Optimal Routes in JSON format (or the already parsed dictionary)."""
+        json_object = json.loads(algo_routes_json) if isinstance(algo_routes_json, str) else algo_routes_json
+        return cls.from_routes(json_object['Metadata'], json_object['Model'], json_object['Routes'])
+
+    def __len__(self):
+        return len(self.stops['location_idx'])
+
+    @property
+    def num_routes(self):
+        return len(self.route_offsets) - 1
+
+    def used_phlebs(self):
+        """Indices of the phlebotomists with at least one order, i.e. more stops than their start and end."""
+        return self.stops['phleb_idx'][self.route_offsets[:-1]][np.diff(self.route_offsets) > 2]
+
+    def route(self, route_idx):
+        """Route of the route_idx-th phlebotomist, in the format of the Routes of output_jsonify (without 'Printable Route')."""
+        start, end = self.route_offsets[route_idx], self.route_offsets[route_idx + 1]
+        stops = {column: values[start:end] for column, values in self.stops.items()}
+        return {'Phlebotomist Index': int(stops['phleb_idx'][0]),
+                'Total Travel Time': int(self.route_travel_times[route_idx]),
+                'Total Loads': int(self.route_loads[route_idx]),
+                'Locations Sequence': stops['location_idx'].tolist(),
+                'Start Times Sequence': np.column_stack([stops['start_min'], stops['start_max']]).tolist(),
+                'End Times Sequence': np.column_stack([stops['end_min'], stops['end_max']]).tolist(),
+                'Slack Times Sequence': np.column_stack([stops['slack_min'], stops['slack_max']])[:-1].tolist(),
+                'Travel Times Sequence': stops['travel_time'][:-1].tolist(),
+                'Time Windows Sequence': np.column_stack([stops['window_min'], stops['window_max']]).tolist()}
+
+    def to_dict(self, printable=True):
+        """Optimal Routes as the dictionary of the JSON format."""
+        routes = [self.route(route_idx) for route_idx in range(self.num_routes)]
+        if printable:
+            routes = [with_printable_route(phleb_route) for phleb_route in routes]
+        return {'Metadata': self.metadata, 'Model': self.model, 'Routes': routes}
+
+    def to_json(self, printable=True, compact=False):
+        """Optimal Routes in the JSON format of output_jsonify."""
+        return dumps_output(self.to_dict(printable), compact)
+
+    def to_dataframe(self):
+        """One row per stop, with the columns of STOP_COLUMNS."""
+        return pd.DataFrame(self.stops, columns=list(self.STOP_COLUMNS))
+
+    def header(self):
+        # Everything but the stop columns, stored as JSON alongside them by the file formats
+        return {'metadata': self.metadata, 'model': self.model, 'route_offsets': self.route_offsets.tolist(),
+                'route_travel_times': self.route_travel_times.tolist(), 'route_loads': self.route_loads.tolist()}
+
+    @classmethod
+    def from_header(cls, header, stops):
+        return cls(header['metadata'], header['model'], header['route_offsets'], header['route_travel_times'], header['route_loads'], stops)
+
+    def to_npz(self, path):
+        """Saves the table as a compressed NumPy .npz archive."""
+        np.savez_compressed(path, header=np.array(dumps_output(self.header(), compact=True)), **self.stops)
+
+    @classmethod
+    def from_npz(cls, path):
+        with np.load(path) as archive:
+            return cls.from_header(json.loads(str(archive['header'])), {column: archive[column] for column in cls.STOP_COLUMNS})
+
+    def to_arrow(self):
+        """Stop columns as a pyarrow Table (numeric columns without copy), with the header in the schema metadata."""
+        if pa is None:
+            raise ImportError('pyarrow is required for the Arrow and Parquet formats of RouteTable')
+        table = pa.table({column: self.stops[column] for column in self.STOP_COLUMNS})
+        return table.replace_schema_metadata({'route_table': dumps_output(self.header(), compact=True)})
+
+    @classmethod
+    def from_arrow(cls, table):
+        header = json.loads(table.schema.metadata[b'route_table'])
+        stops = {column: table.column(column).to_numpy() for column in cls.STOP_COLUMNS}
+        stops['order_id'] = stops['order_id'].astype(str)
+        return cls.from_header(header, stops)
+
+    def to_parquet(self, path):
+        """Saves the table as a Parquet file (requires pyarrow)."""
+        pq.write_table(self.to_arrow(), path)
+
+    @classmethod
+    def from_parquet(cls, path):
+        if pa is None:
+            raise ImportError('pyarrow is required for the Arrow and Parquet formats of RouteTable')
+        return cls.from_arrow(pq.read_table(path))
+
+
+def check_portfolio_hooks(portfolio, progress_callback, cancel_event):
+    # Portfolio workers run in their own processes, where the callback and the event of the caller cannot be reached
+    if portfolio and (progress_callback is not None or cancel_event is not None):
+        raise ValueError('progress_callback and cancel_event are not supported with portfolio')
+
+
+def run_algorithm(orders_df, catchments_df, phlebs_df, api_key, isMultiEnds = False, cache = None, provider = None, profile = 'balanced', initial_routes_json = None, portfolio = None, seed = 0, as_table = False,
+                  progress_callback = None, cancel_event = None):
+    check_portfolio_hooks(portfolio, progress_callback, cancel_event)
+    provider = resolve_provider(provider, api_key, cache)
     numCatchments = catchments_df.shape[0]
-    numPhleb = phlebs_df.shape[0]
 
     if (numCatchments > 1) & (isMultiEnds == False):
         isMultiEnds = True
         print("Multi-Ending Catchments is detected in the input file, algorithm has switched to Multi-ends version accordingly!")
 
-    coordinates_list = FE.get_coordinates_list(orders_df, catchments_df, phlebs_df)
+    features = FE.build_features(orders_df, catchments_df, phlebs_df)
+    coordinates_list = features.addresses
 
     if isMultiEnds:
         catchments_coordinates = coordinates_list[0:numCatchments]
         orders_coordinates = coordinates_list[numCatchments:]
 
-        orders_time_matrix = FE.create_time_matrix(orders_coordinates, api_key)
-    
-        # Modify Time Matrix to make the Ending points arbitrary
-        col_zeros = np.zeros((len(orders_time_matrix),1))
-        row_zeros = np.zeros((1, len(orders_time_matrix)+1))
-        orders_time_matrix = np.array(orders_time_matrix)
-        orders_time_matrix = np.hstack((col_zeros, orders_time_matrix))
-        orders_time_matrix = np.vstack((row_zeros, orders_time_matrix))
+        # Catchment areas are reached through a dummy sink at Index 0, see multi_ends_time_matrix
+        orders_time_matrix, end_catchments = multi_ends_time_matrix(provider.create_time_matrix(orders_coordinates),
+                                                                    provider.get_time_matrix(orders_coordinates, catchments_coordinates))
     else:
-        time_matrix = FE.create_time_matrix(coordinates_list, api_key) #normal time_matrix with index 0 being the single ending catchment
-    
-    orders_capacities = FE.get_orderCapacities_list(orders_df, catchments_df, phlebs_df)
-    phlebs_capacities = FE.get_phlebCapacities_list(orders_df, catchments_df, phlebs_df)
-    order_window = FE.get_timeWindows_list(orders_df, catchments_df, phlebs_df)
-    revenues  = FE.get_orderRevenues_list(orders_df, catchments_df, phlebs_df)
-    servicing_times =  FE.get_servicingTimes_list(orders_df, catchments_df, phlebs_df)
-    expertiseConstraints = FE.get_serviceExpertiseConstraint_list(orders_df, catchments_df, phlebs_df)
-    cost_rating_weight = FE.get_weightedRatingCost_list(phlebs_df)
-    metadata = FE.get_metadata(orders_df, catchments_df, phlebs_df)
+        time_matrix = provider.create_time_matrix(coordinates_list) #normal time_matrix with index 0 being the single ending catchment
     
     if isMultiEnds:
-        data = create_data_model(orders_time_matrix, order_window, revenues, numPhleb, servicing_times, expertiseConstraints, orders_capacities, phlebs_capacities, cost_rating_weight, metadata)
+        data = build_data_model(orders_df, catchments_df, phlebs_df, orders_time_matrix, features)
+        data['end_catchments'] = end_catchments
     else:
-        data = create_data_model(time_matrix, order_window, revenues, numPhleb, servicing_times, expertiseConstraints, orders_capacities, phlebs_capacities, cost_rating_weight, metadata)
-
-    # Create the routing index manager.
-    manager = pywrapcp.RoutingIndexManager(len(data['time_matrix']),
-                                           data['num_vehicles'],
-                                           data['starts'],
-                                           data['ends']
-                                           )
-
-    # Create Routing Model.
-    routing = pywrapcp.RoutingModel(manager)
-
-    # Create and register a transit callback.
-    def time_callback(from_index, to_index):
-        """Returns the travel time between the two nodes."""
-        # Convert from routing variable Index to time matrix NodeIndex.
-        from_node = manager.IndexToNode(from_index)
-        to_node = manager.IndexToNode(to_index)
-        return data['time_matrix'][from_node][to_node]
-
-    transit_callback_index = routing.RegisterTransitCallback(time_callback)
-
-    # Define cost of each arc.
-    routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
-
-    '''Add demand_callback '''
-    def demand_callback(from_index):
-        """Returns the demand of the node."""
-        # Convert from routing variable Index to demands NodeIndex.
-        from_node = manager.IndexToNode(from_index)
-        return data['demands'][from_node]
-
-    demand_callback_index = routing.RegisterUnaryTransitCallback(
-        demand_callback)
-    routing.AddDimensionWithVehicleCapacity(
-        demand_callback_index,
-        0,  # null capacity slack
-        data['vehicle_capacities'],  # vehicle maximum capacities
-        True,  # start cumul to zero
-        'Capacity')
-
-    time = 'Time'
-    routing.AddDimension(
-        transit_callback_index,
-        10000,  # arbitratrily large maximum Slack time 
-        10000,  # arbitratrily large maximum ending time per vehicle 
-        False,  # Don't force start cumul to zero.
-        time)
-    time_dimension = routing.GetDimensionOrDie(time)
-
-    #Add preference to phlebotomists with better service quality and/or lower cost
-    for vehicle_id in range(data["num_vehicles"]):
-        time_dimension.SetSpanCostCoefficientForVehicle(data['cost_rating_weight'][vehicle_id], int(vehicle_id))
-
-    # Add time window constraints for each location except depot
-    for location_idx, time_window in enumerate(data['time_windows']):
-        if location_idx == 0:
-            continue
-        index = manager.NodeToIndex(location_idx)
-        time_dimension.CumulVar(index).SetRange(time_window[0] + data['servicing_times'][location_idx], time_window[1] + data['servicing_times'][location_idx])
-        routing.AddToAssignment(time_dimension.SlackVar(index))
-
-    # Add time window constraints for each vehicle start node.
-    for vehicle_id in range(data["num_vehicles"]):
-        index = routing.Start(vehicle_id)
-        time_dimension.CumulVar(index).SetRange(
-            int(data["time_windows"][0][0]), int(data["time_windows"][0][1]))
-        routing.AddToAssignment(time_dimension.SlackVar(index))
-    
-    # Allow to drop nodes.
-    for node in range(numPhleb + 1, len(data['time_matrix'])): #Starting Location should be omitted
-        penalty = data['revenue_potential'][node]
-        routing.AddDisjunction([manager.NodeToIndex(node)], penalty)
-
-    for i in range(data["num_vehicles"]):
-        routing.AddVariableMinimizedByFinalizer(
-            time_dimension.CumulVar(routing.Start(i))
-        )
-        routing.AddVariableMinimizedByFinalizer(
-            time_dimension.CumulVar(routing.End(i))
-        )
-
-    #Add Service-Expertise Constraints
-    for location_idx, expConstraints in enumerate(data['expertises']):
-        if location_idx < numPhleb + 1:
-            continue
+        data = build_data_model(orders_df, catchments_df, phlebs_df, time_matrix, features)
 
-        index = manager.NodeToIndex(location_idx)
-        vehicles = [-1]
-        vehicles.extend(expConstraints)
-        routing.VehicleVar(index).SetValues(vehicles)
-    
-
-    # Setting first solution heuristic.
-    search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-    search_parameters.first_solution_strategy = (
-        routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC)
-    search_parameters.local_search_metaheuristic = (
-        routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH)
-    search_parameters.time_limit.seconds = 30
-    search_parameters.log_search = True
+    initial_routes = None if initial_routes_json is None else initial_routes_from_json(initial_routes_json, data)
+    if portfolio:
+        result = solve_portfolio(data, portfolio, profile, seed, initial_routes=initial_routes,
+                                 catchments_coordinates=catchments_coordinates if isMultiEnds else None, provider=provider)
+        return RouteTable.from_json(result) if as_table and not result.startswith('Routing Status') else result
 
-    # Solve the problem.
-    solution = routing.SolveWithParameters(search_parameters)
+    # Build the routing model once, and solve it.
+    engine = RoutingEngine(data)
+    solution = engine.solve_with_profile(profile, initial_routes, progress_callback, cancel_event)
+    manager, routing = engine.manager, engine.routing
 
     if solution:
+        if as_table:
+            return RouteTable.from_solution(data, manager, routing, solution, catchments_coordinates if isMultiEnds else None, provider)
         if isMultiEnds:
-            return output_jsonify_verMultiEnds(data, manager, routing, solution, catchments_coordinates, api_key)
+            return output_jsonify_verMultiEnds(data, manager, routing, solution, catchments_coordinates, api_key, provider=provider)
         else:
             return output_jsonify(data, manager, routing, solution)
     else:
-         return 'Routing Status: ' + routing.status
+         return 'Routing Status: ' + str(routing.status())
 
 
-def run_algorithm_version_timeMatrix(orders_df, catchments_df, phlebs_df, time_matrix):
-    
-    numPhleb = phlebs_df.shape[0]
+def run_algorithm_version_timeMatrix(orders_df, catchments_df, phlebs_df, time_matrix, profile = 'balanced', initial_routes_json = None, portfolio = None, seed = 0, as_table = False,
+                                     progress_callback = None, cancel_event = None):
+    check_portfolio_hooks(portfolio, progress_callback, cancel_event)
     numCatchments = catchments_df.shape[0]
 
     if (numCatchments > 1):
         return "More than 1 catchment detected, not applicable for this function, please use run_algorithm() instead"
 
-    time_matrix = time_matrix
-    
-    orders_capacities = FE.get_orderCapacities_list(orders_df, catchments_df, phlebs_df)
-    phlebs_capacities = FE.get_phlebCapacities_list(orders_df, catchments_df, phlebs_df)
-    order_window = FE.get_timeWindows_list(orders_df, catchments_df, phlebs_df)
-    revenues  = FE.get_orderRevenues_list(orders_df, catchments_df, phlebs_df)
-    servicing_times =  FE.get_servicingTimes_list(orders_df, catchments_df, phlebs_df)
-    expertiseConstraints = FE.get_serviceExpertiseConstraint_list(orders_df, catchments_df, phlebs_df)
-    cost_rating_weight = FE.get_weightedRatingCost_list(phlebs_df)
-    metadata = FE.get_metadata(orders_df, catchments_df, phlebs_df)
-    
-    data = create_data_model(time_matrix, order_window, revenues, numPhleb, servicing_times, expertiseConstraints, orders_capacities, phlebs_capacities, cost_rating_weight, metadata)
-
-    # Create the routing index manager.
-    manager = pywrapcp.RoutingIndexManager(len(data['time_matrix']),
-                                           data['num_vehicles'],
-                                           data['starts'],
-                                           data['ends']
-                                           )
-
-    # Create Routing Model.
-    routing = pywrapcp.RoutingModel(manager)
-
-    # Create and register a transit callback.
-    def time_callback(from_index, to_index):
-        """Returns the travel time between the two nodes."""
-        # Convert from routing variable Index to time matrix NodeIndex.
-        from_node = manager.IndexToNode(from_index)
-        to_node = manager.IndexToNode(to_index)
-        return data['time_matrix'][from_node][to_node]
-
-    transit_callback_index = routing.RegisterTransitCallback(time_callback)
-
-    # Define cost of each arc.
-    routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
-
-    '''Add demand_callback '''
-    def demand_callback(from_index):
-        """Returns the demand of the node."""
-        # Convert from routing variable Index to demands NodeIndex.
-        from_node = manager.IndexToNode(from_index)
-        return data['demands'][from_node]
-
-    demand_callback_index = routing.RegisterUnaryTransitCallback(
-        demand_callback)
-    routing.AddDimensionWithVehicleCapacity(
-        demand_callback_index,
-        0,  # null capacity slack
-        data['vehicle_capacities'],  # vehicle maximum capacities
-        True,  # start cumul to zero
-        'Capacity')
-
-    time = 'Time'
-    routing.AddDimension(
-        transit_callback_index,
-        10000,  # arbitratrily large maximum Slack time 
-        10000,  # arbitratrily large maximum ending time per vehicle 
-        False,  # Don't force start cumul to zero.
-        time)
-    time_dimension = routing.GetDimensionOrDie(time)
-
-    #Add preference to phlebotomists with better service quality and/or lower cost
-    for vehicle_id in range(data["num_vehicles"]):
-        time_dimension.SetSpanCostCoefficientForVehicle(data['cost_rating_weight'][vehicle_id], int(vehicle_id))
-
-    # Add time window constraints for each location except depot
-    for location_idx, time_window in enumerate(data['time_windows']):
-        if location_idx == 0:
-            continue
-        index = manager.NodeToIndex(location_idx)
-        time_dimension.CumulVar(index).SetRange(time_window[0] + data['servicing_times'][location_idx], time_window[1] + data['servicing_times'][location_idx])
-        routing.AddToAssignment(time_dimension.SlackVar(index))
-
-    # Add time window constraints for each vehicle start node.
-    for vehicle_id in range(data["num_vehicles"]):
-        index_start = routing.Start(vehicle_id)
-        time_dimension.CumulVar(index_start).SetRange(
-            int(data["time_windows"][0][0]), int(data["time_windows"][0][1]))
-        index_end = routing.End(vehicle_id)
-        time_dimension.CumulVar(index_end).SetMax(int(data["time_windows"][0][1]))
-        routing.AddToAssignment(time_dimension.SlackVar(index))
-    
-    # Allow to drop nodes.
-    for node in range(numPhleb + 1, len(data['time_matrix'])): #Starting Location should be omitted
-        penalty = data['revenue_potential'][node]
-        routing.AddDisjunction([manager.NodeToIndex(node)], penalty)
-
-    for i in range(data["num_vehicles"]):
-        routing.AddVariableMinimizedByFinalizer(
-            time_dimension.CumulVar(routing.Start(i))
-        )
-        routing.AddVariableMinimizedByFinalizer(
-            time_dimension.CumulVar(routing.End(i))
-        )
-
-    #Add Service-Expertise Constraints
-    for location_idx, expConstraints in enumerate(data['expertises']):
-        if location_idx < numPhleb + 1:
-            continue
-
-        index = manager.NodeToIndex(location_idx)
-        vehicles = [-1]
-        vehicles.extend(expConstraints)
-        routing.VehicleVar(index).SetValues(vehicles)
-    
+    data = build_data_model(orders_df, catchments_df, phlebs_df, time_matrix)
 
-    # Setting first solution heuristic.
-    search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-    search_parameters.first_solution_strategy = (
-        routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC)
-    search_parameters.local_search_metaheuristic = (
-        routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH)
-    search_parameters.time_limit.seconds = 30
-    search_parameters.log_search = True
+    initial_routes = None if initial_routes_json is None else initial_routes_from_json(initial_routes_json, data)
+    if portfolio:
+        result = solve_portfolio(data, portfolio, profile, seed, enforce_end_window=True, initial_routes=initial_routes)
+        return RouteTable.from_json(result) if as_table and not result.startswith('Routing Status') else result
 
-    # Solve the problem.
-    solution = routing.SolveWithParameters(search_parameters)
+    # Build the routing model once, and solve it. Phlebotomists must reach the catchment area by the end of its time window.
+    engine = RoutingEngine(data, enforce_end_window=True)
+    solution = engine.solve_with_profile(profile, initial_routes, progress_callback, cancel_event)
+    manager, routing = engine.manager, engine.routing
 
     if solution:
+        if as_table:
+            return RouteTable.from_solution(data, manager, routing, solution)
         return output_jsonify(data, manager, routing, solution)
     else:
-         return 'Routing Status: ' + routing.status
+         return 'Routing Status: ' + str(routing.status())
     
 
-def reverse_getVacancy_algorithm(order_coord, required_servicing_time, required_expertise_list, algo_routes_json, api_key):
+VACANCY_COLUMNS = ['PhlebotomistIndex', 'TotalTravelTime', 'TimeWindowStart', 'TimeWindowEnd',
+                   'FromLocIdx', 'ToLocIdx', 'FromLocCoordinates', 'ToLocCoordinates']
+
+class SlotIndex:
+    """
+    Availability index of published Optimal Routes, built once per plan (the plan only changes when it is re-optimized)
+    and then queried for every booking request, instead of re-parsing and re-scanning all the routes each time.
+
+    The gaps between consecutive locations of every route are kept in flat arrays sorted by their earliest start
+    (the minimum end time of the location before), along with the expertise set of the phlebotomist as a bitmask,
+    the latest start of the next location and the maximum slack. A query first narrows down the candidate gaps with
+    searchsorted and vectorized masks, so travel times only need to be fetched for these candidates.
+
+    algo_routes_json: Optimal Routes in JSON format, the already parsed dictionary, or a RouteTable.
+    """
+    def __init__(self, algo_routes_json):
+        table = algo_routes_json if isinstance(algo_routes_json, RouteTable) else RouteTable.from_json(algo_routes_json)
+        metadata = table.metadata
+        stops = table.stops
+
+        expertise_names = sorted({expertise for phleb in metadata['Phlebotomists'] for expertise in phleb['Expertise']})
+        self.expertise_bits = {expertise: 1 << bit for bit, expertise in enumerate(expertise_names)}
+        phleb_expertises = np.array([self.expertise_mask(phleb['Expertise']) for phleb in metadata['Phlebotomists']], dtype=np.int64)
+
+        # One gap per pair of consecutive stops of a route, i.e. every stop but the last of each route
+        gaps = np.ones(len(table), dtype=bool)
+        gaps[table.route_offsets[1:] - 1] = False
+        gaps = np.flatnonzero(gaps)
+
+        # Sorted by earliest start, ties kept in route order so that results come out in the same order as the routes
+        order = np.argsort(stops['end_min'][gaps], kind='stable')
+        gaps = gaps[order]
+        self.gap_ids = order
+        self.phlebs = stops['phleb_idx'][gaps]
+        self.from_locs = stops['location_idx'][gaps]
+        self.to_locs = stops['location_idx'][gaps + 1]
+        self.min_ends = stops['end_min'][gaps]
+        self.max_starts_next = stops['start_max'][gaps + 1]
+        self.max_slacks = stops['slack_max'][gaps]
+        self.expertises = phleb_expertises[self.phlebs]
+        self.start_hours = self.min_ends // 60
+        self.from_coords = np.array([metadata['Locations'][location]['Coordinate'] for location in self.from_locs.tolist()], dtype=object)
+        self.to_coords = np.array([metadata['Locations'][location]['Coordinate'] for location in self.to_locs.tolist()], dtype=object)
+
+    def expertise_mask(self, expertise_list):
+        """Bitmask of a set of expertises, None if one of them is not held by any phlebotomist."""
+        if not set(expertise_list).issubset(self.expertise_bits):
+            return None
+        return sum(self.expertise_bits[expertise] for expertise in set(expertise_list))
+
+    def __len__(self):
+        return len(self.gap_ids)
+
+    def candidates(self, required_servicing_time, required_expertise_list, earliest_hour=None, latest_hour=None):
+        """
+        Positions of the gaps that can fit the order before travel times are known: phlebotomist holding all the required expertises,
+        slack longer than the servicing time, and (optionally) a start within [earliest_hour, latest_hour].
+        """
+        required = self.expertise_mask(required_expertise_list)
+        if required is None:
+            return np.empty(0, dtype=np.int64)
+
+        # Gaps are sorted by their earliest start, so the ones starting after latest_hour are never scanned
+        end = len(self) if latest_hour is None else np.searchsorted(self.start_hours, latest_hour, side='right')
+        max_slacks = self.max_slacks[:end]
+
+        #Max Slack Time is 0, or required servicing time is more than or equal to Slack Time, nothing to do
+        mask = ((self.expertises[:end] & required) == required) & (max_slacks != 0) & (required_servicing_time < max_slacks)
+        mask &= self.min_ends[:end] + required_servicing_time <= self.max_starts_next[:end]
+        if earliest_hour is not None:
+            mask &= self.max_starts_next[:end] - required_servicing_time >= earliest_hour * 60
+
+        positions = np.flatnonzero(mask)
+        return positions[np.argsort(self.gap_ids[positions], kind='stable')]
+
+    def vacancies(self, order_coord, required_servicing_time, required_expertise_list, provider, earliest_hour=None, latest_hour=None):
+        """
+        Available phlebotomists and time windows for a new order, same as reverse_getVacancy_algorithm but as a DataFrame.
+        Travel times are only fetched for the candidate gaps, in a single 1 x K and K x 1 call to the provider.
+        """
+        positions = self.candidates(required_servicing_time, required_expertise_list, earliest_hour, latest_hour)
+
+        output = []
+        if len(positions) > 0:
+            coords_from, coords_to = self.from_coords[positions].tolist(), self.to_coords[positions].tolist()
+            to_order, from_order = get_order_travel_times(order_coord, coords_from + coords_to, provider)
+            total_transit_time = to_order[:len(positions)] + from_order[len(positions):]
+
+            min_endTime_cur = self.min_ends[positions]
+            proposed_start = (min_endTime_cur + total_transit_time) // 60
+            available = min_endTime_cur + total_transit_time + required_servicing_time <= self.max_starts_next[positions]
+            if earliest_hour is not None:
+                available &= proposed_start >= earliest_hour
+            if latest_hour is not None:
+                available &= proposed_start <= latest_hour
+
+            for gap in np.flatnonzero(available).tolist():
+                position = positions[gap]
+                output.append([int(self.phlebs[position]), #Available Phlebotomist Index
+                               int(total_transit_time[gap]), #Total Travel Time for sorting later
+                               int(proposed_start[gap]), #Proposed Time Window Start
+                               int(proposed_start[gap]) + 1, #Proposed Time Window End
+                               int(self.from_locs[position]), int(self.to_locs[position]),
+                               coords_from[gap], coords_to[gap]])
+
+        vacant = pd.DataFrame(columns=VACANCY_COLUMNS, data=output)
+        return vacant.sort_values(by=['TotalTravelTime'])
+
+
+def reverse_getVacancy_algorithm(order_coord, required_servicing_time, required_expertise_list, algo_routes_json, api_key, cache=None, provider=None, slot_index=None):
+    """
+    Available phlebotomists and time windows for a new order, in JSON format (see VACANCY_COLUMNS).
+    algo_routes_json can also be a RouteTable. When the same Optimal Routes are queried many times, build SlotIndex(algo_routes_json) once and pass it as slot_index.
+    """
+    provider = resolve_provider(provider, api_key, cache)
+    slot_index = SlotIndex(algo_routes_json) if slot_index is None else slot_index
+    vacant = slot_index.vacancies(order_coord, required_servicing_time, required_expertise_list, provider)
+    return vacant.to_json(orient="columns")
+
+
+def get_order_travel_times(order_coord, coordinates, provider):
+    """
+    Travel times between a new order and a list of route coordinates, with a single 1 x K and K x 1 call to the provider
+    for the unique coordinates. Output is a tuple of (to_order, from_order) arrays aligned with coordinates.
+    """
+    unique_coords = list(dict.fromkeys(coordinates))
+    unique_positions = {coord: pos for pos, coord in enumerate(unique_coords)}
+    positions = np.array([unique_positions[coord] for coord in coordinates], dtype=np.int64)
+    to_order = np.asarray(provider.get_time_matrix(unique_coords, [order_coord]), dtype=np.int64)[:, 0]
+    from_order = np.asarray(provider.get_time_matrix([order_coord], unique_coords), dtype=np.int64)[0]
+    return to_order[positions], from_order[positions]
+
+
+def get_route_travel_times(phleb_route, metadata, provider):
+    """
+    Travel time of each leg of a route. Optimal Routes generated before 'Travel Times Sequence' was part of the output
+    are completed with one call to the provider.
+    """
+    if 'Travel Times Sequence' in phleb_route:
+        return np.asarray(phleb_route['Travel Times Sequence'], dtype=np.int64)
+    coords = [metadata['Locations'][location]['Coordinate'] for location in phleb_route['Locations Sequence']]
+    unique_coords = list(dict.fromkeys(coords))
+    positions = {coord: pos for pos, coord in enumerate(unique_coords)}
+    route_matrix = np.asarray(provider.get_time_matrix(unique_coords, unique_coords), dtype=np.int64)
+    return np.array([route_matrix[positions[cur]][positions[nxt]] for cur, nxt in zip(coords[:-1], coords[1:])], dtype=np.int64)
+
+
+def schedule_route(earliest_bounds, latest_bounds, servicing_times, travel_times):
+    """
+    Forward and backward passes over a route: earliest and latest end-of-service time of every location, given the bounds
+    of each location, the servicing times and the travel time of each leg. These are the Min and Max of the Time dimension's
+    cumul variables printed by output_jsonify, along with the Min and Max of the slack between consecutive locations.
+    """
+    earliest = np.array(earliest_bounds, dtype=np.int64)
+    latest = np.array(latest_bounds, dtype=np.int64)
+    servicing_times = np.asarray(servicing_times, dtype=np.int64)
+    travel_times = np.asarray(travel_times, dtype=np.int64)
+    for pos in range(1, len(earliest)):
+        earliest[pos] = max(earliest[pos], earliest[pos-1] + travel_times[pos-1] + servicing_times[pos])
+    for pos in range(len(latest) - 2, -1, -1):
+        latest[pos] = min(latest[pos], latest[pos+1] - travel_times[pos] - servicing_times[pos+1])
+    slack_min = np.maximum(0, earliest[1:] - servicing_times[1:] - travel_times - latest[:-1])
+    slack_max = np.minimum(MAX_TIME, latest[1:] - servicing_times[1:] - travel_times - earliest[:-1])
+    return earliest, latest, slack_min, slack_max
+
+
+def route_bounds(phleb_route, is_multi_ends):
+    """
+    Earliest/latest end-of-service bounds (time windows) and servicing times of every location of a route from the Optimal Routes.
+    Optimal Routes generated before 'Time Windows Sequence' was part of the output only have the times of the solution,
+    which are then kept as they are, so that the order can only be inserted where the route was already waiting.
+    """
+    end_times = np.asarray(phleb_route['End Times Sequence'], dtype=np.int64)
+    start_times = np.asarray(phleb_route['Start Times Sequence'], dtype=np.int64)
+    if 'Time Windows Sequence' in phleb_route:
+        time_windows = np.asarray(phleb_route['Time Windows Sequence'], dtype=np.int64)
+        earliest_bounds, latest_bounds = time_windows[:, 0].copy(), time_windows[:, 1].copy()
+    else:
+        earliest_bounds, latest_bounds = end_times[:, 0].copy(), end_times[:, 1].copy()
+        if is_multi_ends:
+            #The catchment area is picked after solving, so its time is only the reach time and not a constraint
+            latest_bounds[-1] = MAX_TIME
+    return earliest_bounds, latest_bounds, end_times[:, 0] - start_times[:, 0]
+
+
+def printable_route(phleb_route):
+    """Same text as the 'Printable Route' of output_jsonify, from the sequences of the route."""
+    locations = phleb_route['Locations Sequence']
+    lines = ['Route for Phlebotomist {}:\n'.format(phleb_route['Phlebotomist Index'])]
+    for location, start_time, end_time, slack_time in zip(locations[:-1], phleb_route['Start Times Sequence'], phleb_route['End Times Sequence'], phleb_route['Slack Times Sequence']):
+        lines.append('Location {0} Start({1},{2}) End({3}, {4}) -> Slack({5}, {6}) -> '.format(
+            location, start_time[0], start_time[1], end_time[0], end_time[1], slack_time[0], slack_time[1]))
+    lines.append('Location {0} Time({1},{2})\n'.format(locations[-1], phleb_route['End Times Sequence'][-1][0], phleb_route['End Times Sequence'][-1][1]))
+    return ''.join(lines)
+
+
+def insert_order(order_coord, required_servicing_time, required_expertise_list, algo_routes_json, api_key, order_start = None, order_capacity = 1, order_id = None, cache = None, provider = None):
+    """
+    Commits a new order into the Optimal Routes at its cheapest feasible position, without re-running the optimization,
+    e.g. to confirm a booking straight away while the full re-optimization runs in the background.
+
+    Every gap of every phlebotomist with the required expertise and enough spare capacity is evaluated against the time windows
+    of the route, and the order is inserted where it adds the least travel time. The times and slacks of that route are then
+    recomputed, so the output can be given again to insert_order, reverse_getVacancy_algorithm or run_algorithm(initial_routes_json=...).
+
+    order_start: Hour at which the order's 1-hour time window starts (same as 'order_start' in orders_df).
+                If None, the order is placed at the cheapest position at any time, and its time window is the hour it starts in.
+
+    order_capacity: Carrying capacity needed by the order (same as 'capacity_needed' in orders_df).
+
+    order_id: Order Id stored in the Metadata of the new location.
+
+    Returns the updated Optimal Routes in JSON format, or None if the order cannot be inserted anywhere.
+    """
+    provider = resolve_provider(provider, api_key, cache)
     json_object = json.loads(algo_routes_json)
+    if commit_order_insertion(json_object, order_coord, required_servicing_time, required_expertise_list, provider,
+                              order_start, order_capacity, order_id) is None:
+        return None
+    return json.dumps(json_object, indent=2, cls=npEncoder)
+
+
+def commit_order_insertion(json_object, order_coord, required_servicing_time, required_expertise_list, provider,
+                           order_start = None, order_capacity = 1, order_id = None, location_idx = None,
+                           phleb_indices = None, max_added_travel_time = None):
+    """
+    Same as insert_order, on the already parsed Optimal Routes, which are updated in place.
+    If location_idx is given, the order is an existing (dropped or relocated) location of the Metadata instead of a new one.
+
+    phleb_indices: If given, only the routes of these phlebotomists are considered.
+
+    max_added_travel_time: If given, the order is only inserted where it adds at most this travel time.
+
+    Returns the index of the phlebotomist that takes the order, or None if the order cannot be inserted anywhere.
+    """
     metadata = json_object['Metadata']
     routes = json_object['Routes']
+    is_multi_ends = metadata['Locations'][0]['Order Id'] == 'Placeholder'
 
-    output = []
-    
-    for phleb_idx in range(len(routes)):
-        phleb_route = routes[phleb_idx]
+    if order_start is None:
+        time_window = (0, MAX_TIME)
+    else:
+        time_window = (int(order_start) * 60, (int(order_start) + 1) * 60)
 
-        if set(required_expertise_list).issubset(set(metadata['Phlebotomists'][phleb_idx]['Expertise'])) == False:
+    # Gather every gap of the phlebotomists able to take the order
+    gap_phlebs, gap_positions = [], []
+    gap_from, gap_to, gap_legs, gap_earliest, gap_latest_next = [], [], [], [], []
+    for phleb_idx, phleb_route in enumerate(routes):
+        if phleb_indices is not None and phleb_idx not in phleb_indices:
+            continue
+        phleb = metadata['Phlebotomists'][phleb_idx]
+        if set(required_expertise_list).issubset(set(phleb['Expertise'])) == False:
+            continue
+        if ('Capacity' in phleb) and (phleb_route['Total Loads'] + order_capacity > phleb['Capacity']):
             continue
 
-        for idx in range(len(phleb_route['Locations Sequence']) - 1):
+        locations = phleb_route['Locations Sequence']
+        travel_times = get_route_travel_times(phleb_route, metadata, provider)
+        earliest_bounds, latest_bounds, servicing_times = route_bounds(phleb_route, is_multi_ends)
+        earliest, latest, _, _ = schedule_route(earliest_bounds, latest_bounds, servicing_times, travel_times)
+
+        gap_phlebs.extend([phleb_idx] * (len(locations) - 1))
+        gap_positions.extend(range(len(locations) - 1))
+        gap_from.extend(metadata['Locations'][location]['Coordinate'] for location in locations[:-1])
+        gap_to.extend(metadata['Locations'][location]['Coordinate'] for location in locations[1:])
+        gap_legs.append(travel_times)
+        gap_earliest.append(earliest[:-1])
+        gap_latest_next.append(latest[1:] - servicing_times[1:]) #latest start of the next location
+
+    if len(gap_phlebs) == 0:
+        return None
+
+    to_order, from_order = get_order_travel_times(order_coord, gap_from + gap_to, provider)
+    travel_to_order, travel_from_order = to_order[:len(gap_from)], from_order[len(gap_from):]
+    gap_legs, gap_earliest, gap_latest_next = np.concatenate(gap_legs), np.concatenate(gap_earliest), np.concatenate(gap_latest_next)
+
+    # Earliest end of service at the new order for every gap, and whether the next location can still be reached in time
+    order_end = np.maximum(gap_earliest + travel_to_order + required_servicing_time, time_window[0] + required_servicing_time)
+    feasible = (order_end <= time_window[1] + required_servicing_time) & (order_end + travel_from_order <= gap_latest_next)
+    added_travel_time = travel_to_order + travel_from_order - gap_legs
+    if max_added_travel_time is not None:
+        feasible &= added_travel_time <= max_added_travel_time
+    if not feasible.any():
+        return None
+
+    candidates = np.flatnonzero(feasible)
+    best = candidates[np.lexsort((order_end[candidates], added_travel_time[candidates]))[0]]
+    phleb_idx, pos = gap_phlebs[best], gap_positions[best]
+
+    if order_start is None:
+        start_hour = (int(order_end[best]) - required_servicing_time) // 60
+        time_window = (start_hour * 60, (start_hour + 1) * 60)
+
+    # Commit the order, and recompute the times of its route
+    if location_idx is None:
+        new_location = len(metadata['Locations'])
+        metadata['Locations'].append({"Location Index": new_location, "Coordinate": order_coord,
+                                      "Order Id": str(order_id) if order_id is not None else 'Booking {}'.format(new_location)})
+    else:
+        new_location = location_idx
 
-            max_slack_time = phleb_route['Slack Times Sequence'][idx][1]
+    phleb_route = routes[phleb_idx]
+    earliest_bounds, latest_bounds, servicing_times = route_bounds(phleb_route, is_multi_ends)
+    travel_times = get_route_travel_times(phleb_route, metadata, provider)
 
+    earliest_bounds = np.insert(earliest_bounds, pos + 1, time_window[0] + required_servicing_time)
+    latest_bounds = np.insert(latest_bounds, pos + 1, time_window[1] + required_servicing_time)
+    servicing_times = np.insert(servicing_times, pos + 1, required_servicing_time)
+    travel_times = np.concatenate([travel_times[:pos], [travel_to_order[best], travel_from_order[best]], travel_times[pos+1:]])
 
-            if (idx + 1) != len(phleb_route['Locations Sequence']):
-                #Slack time at the last edge (from last order location to ending catchment area) is always zero
-                if (max_slack_time == 0) | (required_servicing_time >= max_slack_time): 
-                    #Max Slack Time is 0, or required servicing time is more than or equal to Slack Time, nothing to do
-                    continue
+    phleb_route['Locations Sequence'].insert(pos + 1, new_location)
+    set_route_times(phleb_route, earliest_bounds, latest_bounds, servicing_times, travel_times,
+                    schedule_route(earliest_bounds, latest_bounds, servicing_times, travel_times))
+    phleb_route['Total Travel Time'] += int(added_travel_time[best])
+    phleb_route['Total Loads'] += order_capacity
 
-            location_cur = phleb_route['Locations Sequence'][idx]
-            location_next = phleb_route['Locations Sequence'][idx + 1]
-            min_endTime_cur = phleb_route['End Times Sequence'][idx][0]
-            max_startTime_next = phleb_route['Start Times Sequence'][idx+1][1]
+    json_object['Model']['Total Travel Time'] += int(added_travel_time[best])
+    json_object['Model']['Total Loads'] += order_capacity
 
-            coord_cur = metadata['Locations'][location_cur]['Coordinate']
-            coord_next = metadata['Locations'][location_next]['Coordinate']
+    return phleb_idx
 
-            response_cur = FE.send_request([coord_cur], [order_coord], api_key)
-            transit_time_first_part = FE.build_time_matrix(response_cur)[0][0]
-            response_next = FE.send_request([order_coord], [coord_next], api_key)
-            transit_time_second_part = FE.build_time_matrix(response_next)[0][0]
 
-            total_transit_time = transit_time_first_part + transit_time_second_part
+def set_route_times(phleb_route, earliest_bounds, latest_bounds, servicing_times, travel_times, schedule):
+    # Writes the sequences of a route from its bounds, servicing and travel times, and its schedule from schedule_route
+    earliest, latest, slack_min, slack_max = schedule
+    phleb_route['Start Times Sequence'] = np.stack([earliest - servicing_times, latest - servicing_times], axis=1).tolist()
+    phleb_route['End Times Sequence'] = np.stack([earliest, latest], axis=1).tolist()
+    phleb_route['Slack Times Sequence'] = np.stack([slack_min, slack_max], axis=1).tolist()
+    phleb_route['Travel Times Sequence'] = np.asarray(travel_times).tolist()
+    phleb_route['Time Windows Sequence'] = np.stack([earliest_bounds, latest_bounds], axis=1).tolist()
+    phleb_route['Printable Route'] = printable_route(phleb_route)
 
-            if (min_endTime_cur + total_transit_time + required_servicing_time <= max_startTime_next):
-                temp = []
-                temp.append(phleb_idx) #Available Phlebotomist Index
-                temp.append(total_transit_time) #Total Travel Time for sorting later
-                temp.append((min_endTime_cur + total_transit_time) // 60 ) #Proposed Time Window Start
-                temp.append((min_endTime_cur + total_transit_time) // 60 + 1) #Proposed Time Window End
-                temp.append(location_cur)
-                temp.append(location_next)
-                temp.append(coord_cur)
-                temp.append(coord_next)
 
-                output.append(temp)
-        
-    vacant = pd.DataFrame(columns=['PhlebotomistIndex', 'TotalTravelTime', 'TimeWindowStart', 'TimeWindowEnd',
-                                            'FromLocIdx', 'ToLocIdx', 'FromLocCoordinates', 'ToLocCoordinates'],
-                        data=output)
+def order_removal(json_object, phleb_idx, position, provider):
+    """
+    Evaluates taking the order at the given position out of a phlebotomist's route, with one call to the provider for the
+    travel time between its neighbours. Returns the travel time saved and the new times of the route, to be given to
+    commit_order_removal, or None if the rest of the route would no longer be feasible (travel times may not satisfy
+    the triangle inequality).
+    """
+    metadata = json_object['Metadata']
+    phleb_route = json_object['Routes'][phleb_idx]
+    is_multi_ends = metadata['Locations'][0]['Order Id'] == 'Placeholder'
+    locations = phleb_route['Locations Sequence']
 
-    vacant = vacant.sort_values(by=['TotalTravelTime'])   
+    travel_times = get_route_travel_times(phleb_route, metadata, provider)
+    earliest_bounds, latest_bounds, servicing_times = route_bounds(phleb_route, is_multi_ends)
+    shortcut = int(np.asarray(provider.get_time_matrix([metadata['Locations'][locations[position-1]]['Coordinate']],
+                                                       [metadata['Locations'][locations[position+1]]['Coordinate']]))[0][0])
+    saved_travel_time = int(travel_times[position-1] + travel_times[position]) - shortcut
 
-    return vacant.to_json(orient="columns")
+    travel_times = np.concatenate([travel_times[:position-1], [shortcut], travel_times[position+1:]])
+    earliest_bounds, latest_bounds = np.delete(earliest_bounds, position), np.delete(latest_bounds, position)
+    servicing_times = np.delete(servicing_times, position)
+    schedule = schedule_route(earliest_bounds, latest_bounds, servicing_times, travel_times)
+    if (schedule[0] > schedule[1]).any():
+        return None
+    return saved_travel_time, (earliest_bounds, latest_bounds, servicing_times, travel_times, schedule)
+
+
+def commit_order_removal(json_object, phleb_idx, position, removal, order_capacity = 1):
+    """Takes the order at the given position out of a phlebotomist's route, with the removal evaluated by order_removal."""
+    saved_travel_time, route_times = removal
+    phleb_route = json_object['Routes'][phleb_idx]
+    del phleb_route['Locations Sequence'][position]
+    set_route_times(phleb_route, *route_times)
+    phleb_route['Total Travel Time'] -= saved_travel_time
+    phleb_route['Total Loads'] -= order_capacity
 
+    json_object['Model']['Total Travel Time'] -= saved_travel_time
+    json_object['Model']['Total Loads'] -= order_capacity
 
-def run_prescriptive_analysis(orders_df, catchments_df, phlebs_df, time_matrix, regular_ratio, premium_ratio, special_ratio):
 
-    numOrders = len(orders_df)
-    numRegularOrder = regular_ratio * numOrders
-    numSpecialOrder = special_ratio * numOrders
+PHLEB_COSTS = {'regular': 800, 'premium': 900, 'special': 1000} # cost of a phlebotomist by highest expertise, used by the Prescriptive Analysis
 
-    serviceTypes = np.ones(numOrders)
+DEFAULT_SWEEP_CACHE_DIR = os.path.join('Cache', 'prescriptive_sweep')
+
+def generate_service_scenarios(num_orders, regular_ratio, premium_ratio, special_ratio, n_iterations = 10, seed = None):
+    """
+    Service type of every order for each scenario of the Prescriptive Analysis (0 Regular, 1 Premium, 2 Special),
+    shuffled without violating the demand ratios. The same seed always gives the same scenarios.
+    """
+    numRegularOrder = regular_ratio * num_orders
+    numSpecialOrder = special_ratio * num_orders
+
+    serviceTypes = np.ones(num_orders)
     serviceTypes[:int(numRegularOrder)] = 0 #Regular Order is 0
     serviceTypes[int(numRegularOrder):int(numRegularOrder+numSpecialOrder)] = 2 #Special Order is 2; Premium Order is then 1
 
-    list_of_ratios = []
-    list_of_total_transit_time = []
-    list_of_total_cost = []
-    list_of_numbers = []
-    list_of_jsons = []
-    list_of_chosen_phlebs = []
-
-    #Randomise it via shuffling
-    for _ in range(10):
-        np.random.shuffle(serviceTypes)
-
-        serviceRegular = [1 for _ in serviceTypes]
-        servicePremium = [1 if (int(type) == 1) | (int(type) == 2) else 0 for type in serviceTypes]
-        serviceSpecial = [1 if int(type) == 2 else 0 for type in serviceTypes]
-
-        #Generate new orders_df based on the randomised service types above
-        orders_df['service_regular'] = serviceRegular
-        orders_df['service_premium'] = servicePremium
-        orders_df['service_special'] = serviceSpecial
-
-        algo_routes_json = run_algorithm_version_timeMatrix(orders_df, catchments_df, phlebs_df, time_matrix)
-
-        json_object = json.loads(algo_routes_json)
-        metadata = json_object['Metadata']
-        routes = json_object['Routes']
-        model = json_object['Model']
-
-        total_travel_time = model['Total Travel Time']
-        list_of_total_transit_time.append(total_travel_time)
-
-        chosen_phleb = []
-        numSpecialPhleb = 0
-        numPremiumPhleb = 0
-        numRegularPhleb = 0
-        
-        for phleb_idx in range(len(routes)):
-            phleb_route = routes[phleb_idx]
-            if len(phleb_route['Locations Sequence']) == 2:
-                continue
-            else:
-                chosen_phleb.append(phleb_idx)
-                expertises = metadata['Phlebotomists'][phleb_idx]['Expertise']
-                if 'expertise_special' in expertises:
-                    numSpecialPhleb += 1
-                elif 'expertise_premium'  in expertises:
-                    numPremiumPhleb += 1
-                else:
-                    numRegularPhleb += 1
-        
-        total = numSpecialPhleb + numPremiumPhleb + numRegularPhleb
-        list_of_ratios.append([numRegularPhleb/total, numPremiumPhleb/total, numSpecialPhleb/total])
-        list_of_numbers.append([numRegularPhleb, numPremiumPhleb, numSpecialPhleb])
-        total_cost =  numSpecialPhleb * 1000 + numPremiumPhleb * 900 + numRegularPhleb * 800
-        list_of_total_cost.append(total_cost)
-        list_of_jsons.append(algo_routes_json)
-        list_of_chosen_phlebs.append(chosen_phleb)
+    rng = np.random.default_rng(seed)
+    return [rng.permutation(serviceTypes) for _ in range(n_iterations)]
+
+def apply_service_types(orders_df, serviceTypes):
+    """Copy of orders_df with the service columns generated from the service types of generate_service_scenarios."""
+    scenario_df = orders_df.copy()
+    scenario_df['service_regular'] = 1
+    scenario_df['service_premium'] = ((serviceTypes == 1) | (serviceTypes == 2)).astype(int)
+    scenario_df['service_special'] = (serviceTypes == 2).astype(int)
+    return scenario_df
+
+def summarise_prescriptive_routes(algo_routes_json):
+    """
+    Phlebotomists chosen by the Optimal Routes (JSON or RouteTable), their number and ratio by highest expertise,
+    their cost, and the total travel time.
+    """
+    table = algo_routes_json if isinstance(algo_routes_json, RouteTable) else RouteTable.from_json(algo_routes_json)
+
+    chosen_phleb = table.used_phlebs().tolist()
+    numbers = {'regular': 0, 'premium': 0, 'special': 0}
+    for phleb_idx in chosen_phleb:
+        expertises = table.metadata['Phlebotomists'][phleb_idx]['Expertise']
+        if 'expertise_special' in expertises:
+            numbers['special'] += 1
+        elif 'expertise_premium' in expertises:
+            numbers['premium'] += 1
+        else:
+            numbers['regular'] += 1
+
+    total = max(sum(numbers.values()), 1)
+    return {'Regular Phleb Ratio': numbers['regular'] / total, 'Premium Phleb Ratio': numbers['premium'] / total, 'Special Phleb Ratio': numbers['special'] / total,
+            'Regular Phlebs': numbers['regular'], 'Premium Phlebs': numbers['premium'], 'Special Phlebs': numbers['special'],
+            'Total Cost': sum(PHLEB_COSTS[expertise] * number for expertise, number in numbers.items()),
+            'Total Travel Time': table.model['Total Travel Time'], 'Chosen Phlebs': chosen_phleb}
+
+
+# Data model shared by the scenarios of each worker process, sent once through the pool initializer instead of with every scenario
+_scenario_data = None
+
+def _init_scenario_worker(data):
+    global _scenario_data
+    _scenario_data = data
+
+def _run_prescriptive_scenario(scenario):
+    """Solves one scenario: only the service-expertise constraints differ from the shared data model."""
+    start = time.monotonic()
+    settings = scenario.pop('settings')
+    data = dict(_scenario_data, expertises=scenario.pop('expertises'))
+    engine = RoutingEngine(data, enforce_end_window=True)
+    solution = engine.solve(create_search_parameters(settings), settings['stagnation_time'])
+    as_table = scenario.pop('as_table', False)
+    if solution:
+        table = RouteTable.from_solution(engine.data, engine.manager, engine.routing, solution)
+        scenario.update(summarise_prescriptive_routes(table))
+        routes = table if as_table else table.to_json(compact=True)
+    else:
+        routes = 'Routing Status: ' + str(engine.routing.status())
+    scenario['Route Table' if as_table else 'Routes JSON'] = routes
+    scenario['Solve Time'] = time.monotonic() - start
+    return scenario
+
+def prescriptive_settings(profile = 'balanced', time_limit = None):
+    """Solver settings of every scenario of the Prescriptive Analysis: the solver profile, with an optional time limit in seconds."""
+    settings = get_solver_profile(profile, log_search=False)
+    if time_limit is not None:
+        settings['time_limit'] = time_limit
+    return settings
+
+def prescriptive_scenarios(orders_df, catchments_df, phlebs_df, ratios, n_iterations, seed, settings):
+    """
+    Scenarios of one demand ratio (regular_ratio, premium_ratio, special_ratio), to be solved by solve_prescriptive_scenarios.
+    Each scenario only holds its service-expertise constraints, computed on its own copy of orders_df.
+    """
+    regular_ratio, premium_ratio, special_ratio = ratios
+    for iteration, serviceTypes in enumerate(generate_service_scenarios(len(orders_df), regular_ratio, premium_ratio, special_ratio, n_iterations, seed)):
+        scenario_df = apply_service_types(orders_df, serviceTypes)
+        yield {'Iteration': iteration, 'Regular Ratio': regular_ratio, 'Premium Ratio': premium_ratio, 'Special Ratio': special_ratio, 'Seed': seed,
+               'settings': settings, 'expertises': FE.get_serviceExpertiseConstraint_list(scenario_df, catchments_df, phlebs_df, as_csr=True)}
+
+def solve_prescriptive_scenarios(data, scenarios, max_workers = None, as_table = False):
+    """
+    Solves the scenarios against the shared data model in a process pool of max_workers processes (1 solves them in-process),
+    and yields the result of each scenario as soon as it is solved (in completion order).
+    as_table=True returns the Optimal Routes of each scenario as a RouteTable under 'Route Table' instead of JSON under 'Routes JSON'.
+    """
+    scenarios = (dict(scenario, as_table=as_table) for scenario in scenarios)
+    if max_workers == 1:
+        _init_scenario_worker(data)
+        for scenario in scenarios:
+            yield _run_prescriptive_scenario(scenario)
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_scenario_worker, initargs=(data,)) as executor:
+        futures = [executor.submit(_run_prescriptive_scenario, scenario) for scenario in scenarios]
+        for future in as_completed(futures):
+            yield future.result()
+
+def iter_prescriptive_scenarios(orders_df, catchments_df, phlebs_df, time_matrix, regular_ratio, premium_ratio, special_ratio,
+                                n_iterations = 10, seed = None, time_limit = None, max_workers = None, profile = 'balanced', as_table = False):
+    """
+    Runs the scenarios of the Prescriptive Analysis in a process pool of max_workers processes (1 runs them in-process),
+    and yields the result of each scenario as soon as it is solved (in completion order), as a dictionary with the
+    'Iteration', the demand ratios, the 'Seed', and the values of summarise_prescriptive_routes along with the 'Routes JSON' and 'Solve Time'.
+
+    The data model (time matrix, time windows, capacities...) is built once; each scenario only changes the services of the orders,
+    i.e. the service-expertise constraints, on its own copy of orders_df. The input dataframes are never modified.
+
+    n_iterations: Number of shuffles of the service types. seed: Seed of the shuffles, for reproducible analyses.
+
+    time_limit: Time limit of each scenario in seconds, defaults to the one of the solver profile.
+
+    as_table: Gives the Optimal Routes of each scenario as a RouteTable under 'Route Table' instead of JSON under 'Routes JSON'.
+    """
+    settings = prescriptive_settings(profile, time_limit)
+    data = build_data_model(orders_df, catchments_df, phlebs_df, time_matrix)
+    data_metadata(data) #built once here rather than in every scenario
+
+    scenarios = prescriptive_scenarios(orders_df, catchments_df, phlebs_df, (regular_ratio, premium_ratio, special_ratio), n_iterations, seed, settings)
+    yield from solve_prescriptive_scenarios(data, scenarios, max_workers, as_table)
+
+def run_prescriptive_scenarios(orders_df, catchments_df, phlebs_df, time_matrix, regular_ratio, premium_ratio, special_ratio,
+                               n_iterations = 10, seed = None, time_limit = None, max_workers = None, profile = 'balanced', callback = None, as_table = False):
+    """
+    Same as iter_prescriptive_scenarios, aggregated into a DataFrame with one row per scenario (sorted by iteration).
+    callback, if given, is called with the result of each scenario as soon as it is solved, e.g. to report progress.
+    """
+    results = []
+    for result in iter_prescriptive_scenarios(orders_df, catchments_df, phlebs_df, time_matrix, regular_ratio, premium_ratio, special_ratio,
+                                              n_iterations, seed, time_limit, max_workers, profile, as_table):
+        if callback is not None:
+            callback(result)
+        results.append(result)
+    return pd.DataFrame(results).sort_values(by=['Iteration']).reset_index(drop=True)
+
+def run_prescriptive_analysis(orders_df, catchments_df, phlebs_df, time_matrix, regular_ratio, premium_ratio, special_ratio,
+                              n_iterations = 10, seed = None, time_limit = None, max_workers = None, profile = 'balanced', as_table = False):
+    """
+    Prescriptive Analysis over n_iterations shuffles of the orders' services (see run_prescriptive_scenarios), returned as lists with one value per shuffle:
+    (ratios of Regular/Premium/Special phlebotomists chosen, total travel times, total costs, numbers of Regular/Premium/Special phlebotomists chosen,
+    Optimal Routes JSONs (RouteTables if as_table), indices of the phlebotomists chosen).
+    """
+    results = run_prescriptive_scenarios(orders_df, catchments_df, phlebs_df, time_matrix, regular_ratio, premium_ratio, special_ratio,
+                                         n_iterations, seed, time_limit, max_workers, profile, as_table=as_table)
+    results = results[results['Total Cost'].notna()] #scenarios without a solution have no summary
+
+    list_of_ratios = results[['Regular Phleb Ratio', 'Premium Phleb Ratio', 'Special Phleb Ratio']].values.tolist()
+    list_of_total_transit_time = results['Total Travel Time'].tolist()
+    list_of_total_cost = results['Total Cost'].tolist()
+    list_of_numbers = results[['Regular Phlebs', 'Premium Phlebs', 'Special Phlebs']].values.tolist()
+    list_of_jsons = results['Route Table' if as_table else 'Routes JSON'].tolist()
+    list_of_chosen_phlebs = results['Chosen Phlebs'].tolist()
 
     return list_of_ratios, list_of_total_transit_time, list_of_total_cost, list_of_numbers, list_of_jsons, list_of_chosen_phlebs
 
-    
\ No newline at end of file
+def make_ratio_grid(step = 0.1):
+    """Every (regular_ratio, premium_ratio, special_ratio) in multiples of step that sum to 1, e.g. for run_prescriptive_sweep."""
+    n = int(round(1 / step))
+    return [(round(regular * step, 6), round(premium * step, 6), round((n - regular - premium) * step, 6))
+            for regular in range(n + 1) for premium in range(n + 1 - regular)]
+
+def sweep_fingerprint(orders_df, catchments_df, phlebs_df, time_matrix, n_iterations, settings):
+    """Fingerprint of everything but the demand ratio and the seed that a sweep point depends on, used to key the cached points."""
+    digest = hashlib.sha1()
+    for df in (orders_df, catchments_df, phlebs_df):
+        digest.update(','.join(map(str, df.columns)).encode('utf-8'))
+        digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    digest.update(np.ascontiguousarray(time_matrix, dtype=np.int64).tobytes())
+    digest.update(json.dumps({'n_iterations': n_iterations, 'settings': settings}, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+def run_prescriptive_sweep(orders_df, catchments_df, phlebs_df, time_matrix, ratio_grid, n_iterations = 10, seed = 0, time_limit = None,
+                           max_workers = None, profile = 'balanced', cache_dir = DEFAULT_SWEEP_CACHE_DIR, callback = None):
+    """
+    Prescriptive Analysis over a grid of demand ratios against the same time matrix and phlebotomists, e.g. make_ratio_grid(0.1).
+    The data model is built once for the whole sweep, and every scenario of every ratio only changes the service-expertise constraints;
+    all the scenarios share one process pool of max_workers processes (see solve_prescriptive_scenarios).
+
+    Each completed point (all n_iterations scenarios of a ratio) is saved under cache_dir, keyed by (ratio, seed) and by a fingerprint
+    of the inputs and solver settings, so an interrupted sweep resumes from the points not completed yet. None disables the cache.
+
+    callback, if given, is called with the result of each scenario solved (not the cached ones) as soon as it is solved.
+
+    Returns a DataFrame with one row per scenario, in the format of run_prescriptive_scenarios, sorted by ratio and iteration.
+    """
+    settings = prescriptive_settings(profile, time_limit)
+    point_dir = None
+    if cache_dir is not None:
+        if seed is None:
+            raise ValueError('A seed is required to cache the sweep, or set cache_dir to None')
+        point_dir = os.path.join(cache_dir, sweep_fingerprint(orders_df, catchments_df, phlebs_df, time_matrix, n_iterations, settings))
+        os.makedirs(point_dir, exist_ok=True)
+
+    def point_path(ratios):
+        return os.path.join(point_dir, 'ratio_{:.4f}_{:.4f}_{:.4f}_seed_{}.json'.format(*ratios, seed))
+
+    results = []
+    pending = []
+    for ratios in dict.fromkeys(tuple(float(ratio) for ratio in ratios) for ratios in ratio_grid):
+        if point_dir is not None and os.path.exists(point_path(ratios)):
+            with open(point_path(ratios)) as f:
+                results.extend(json.load(f))
+        else:
+            pending.append(ratios)
+
+    if pending:
+        data = build_data_model(orders_df, catchments_df, phlebs_df, time_matrix)
+        data_metadata(data)
+        scenarios = (scenario for ratios in pending
+                     for scenario in prescriptive_scenarios(orders_df, catchments_df, phlebs_df, ratios, n_iterations, seed, settings))
+
+        completed = {ratios: [] for ratios in pending}
+        for result in solve_prescriptive_scenarios(data, scenarios, max_workers):
+            if callback is not None:
+                callback(result)
+            ratios = (result['Regular Ratio'], result['Premium Ratio'], result['Special Ratio'])
+            completed[ratios].append(result)
+            if len(completed[ratios]) < n_iterations:
+                continue
+            results.extend(completed[ratios])
+            if point_dir is not None:
+                temp_path = point_path(ratios) + '.tmp'
+                with open(temp_path, 'w') as f:
+                    json.dump(completed[ratios], f, cls=npEncoder)
+                os.replace(temp_path, point_path(ratios)) #a point is only ever cached complete
+
+    if not results:
+        return pd.DataFrame()
+    return pd.DataFrame(results).sort_values(by=['Regular Ratio', 'Premium Ratio', 'Special Ratio', 'Iteration']).reset_index(drop=True)
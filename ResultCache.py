@@ -0,0 +1,135 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+DEFAULT_RESULT_CACHE_DIR = os.path.join('Cache', 'routes')
+
+FINGERPRINT_DECIMALS = 9 # numbers are rounded before hashing, so that the same table sent as CSV or JSON has the same fingerprint
+
+
+def problem_fingerprint(orders_df, catchments_df, phlebs_df, profile='balanced', isMultiEnds=False, travel_time_source='google'):
+    """
+    Canonical hash of a /routes problem: the 3 tables, the solver profile, the multi-ends option and the source of the travel times
+    (e.g. the name of a TravelTimeProvider). The API key is left out, so the same problem sent with different keys shares its result.
+
+    Tables are normalised first: the index column written by DataFrame.to_csv() is dropped, the columns are sorted by name,
+    and numeric columns are compared as floats rounded to FINGERPRINT_DECIMALS. The rows are kept in their order, as the
+    Optimal Routes refer to orders and phlebotomists by their position in the tables.
+    """
+    digest = hashlib.sha1()
+    for df in (orders_df, catchments_df, phlebs_df):
+        df = df.drop(columns=['Unnamed: 0'], errors='ignore')
+        df = df[sorted(df.columns, key=str)]
+        numeric = [column for column in df.columns if pd.api.types.is_numeric_dtype(df[column])]
+        df = df.astype({column: 'float64' for column in numeric}).round({column: FINGERPRINT_DECIMALS for column in numeric})
+        digest.update(json.dumps(list(map(str, df.columns))).encode('utf-8'))
+        digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    options = {'profile': profile, 'isMultiEnds': bool(isMultiEnds), 'travel_time_source': travel_time_source}
+    digest.update(json.dumps(options, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Cache of solved problems, keyed by problem_fingerprint: the most recently used results are kept in memory, and every result
+    is also saved on disk (one gzip-compressed JSON file per key) so that it survives restarts of the API.
+
+    path: Folder of the cache files, created if needed. None keeps the results in memory only.
+
+    max_memory_entries: Number of results kept in memory, the least recently used ones are dropped first.
+
+    max_disk_bytes: Total size of the cache files. When exceeded, the least recently used files are deleted.
+
+    ttl: Number of seconds a result stays valid, as live travel times change over the day. Expired results are treated as missing.
+    """
+
+    def __init__(self, path=DEFAULT_RESULT_CACHE_DIR, max_memory_entries=64, max_disk_bytes=256 * 1024 * 1024, ttl=6 * 60 * 60):
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self.memory = OrderedDict() # key -> (created, result), most recently used last
+        self.lock = threading.Lock()
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def file_path(self, key):
+        return os.path.join(self.path, '{}.json.gz'.format(key))
+
+    def get(self, key):
+        """The cached result of key, None if it is missing or expired."""
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                if now - entry[0] <= self.ttl:
+                    self.memory.move_to_end(key)
+                    return entry[1]
+                del self.memory[key]
+
+        if self.path is None:
+            return None
+        file_path = self.file_path(key)
+        try:
+            with gzip.open(file_path, 'rt', encoding='utf-8') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError): #partially written or corrupted file
+            self.remove_file(file_path)
+            return None
+        if now - entry['created'] > self.ttl:
+            self.remove_file(file_path)
+            return None
+
+        os.utime(file_path) #the modification time of a file is its last use, for the eviction
+        self.remember(key, entry['created'], entry['result'])
+        return entry['result']
+
+    def put(self, key, result):
+        """Stores a result (anything JSON-serialisable, e.g. an Optimal Routes JSON string) in memory and on disk."""
+        created = time.time()
+        self.remember(key, created, result)
+        if self.path is None:
+            return
+
+        # Written to a temporary file first, so that a crash never leaves a partial file under the key
+        file_path = self.file_path(key)
+        tmp_path = '{}.{}.tmp'.format(file_path, threading.get_ident())
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump({'created': created, 'result': result}, f)
+        os.replace(tmp_path, file_path)
+        self.evict_files()
+
+    def remember(self, key, created, result):
+        with self.lock:
+            self.memory[key] = (created, result)
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_memory_entries:
+                self.memory.popitem(last=False)
+
+    def evict_files(self):
+        # Deletes the least recently used files until the cache fits in max_disk_bytes
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.json.gz'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, file_path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            self.remove_file(file_path)
+            total -= size
+
+    def remove_file(self, file_path):
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
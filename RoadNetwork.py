@@ -0,0 +1,184 @@
+import hashlib
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import networkx as nx
+import numpy as np
+import osmnx as ox
+
+from TravelTimeProviders import TravelTimeProvider, parse_coordinates
+
+DEFAULT_CACHE_DIR = os.path.join('Cache', 'road_network')
+
+UNREACHABLE_MINUTES = 24 * 60 # travel time used when there is no drivable path between two nodes
+
+
+def build_drive_graph(polygon):
+    """
+    Downloads the drivable road network covering the bounds of the geojson polygon (same graph as used by visualise_routes)
+    """
+    x_min, y_min, x_max, y_max = polygon.total_bounds
+    return ox.graph_from_bbox(north=y_max, south=y_min, east=x_max, west=x_min, network_type='drive')
+
+
+def snap_to_nodes(G, addresses):
+    """
+    Snaps a list of "lat,long" coordinates to their nearest graph nodes in a single vectorized call
+    """
+    coordinates = parse_coordinates(addresses)
+    return np.asarray(ox.distance.nearest_nodes(G, X=coordinates[:, 1], Y=coordinates[:, 0]))
+
+
+def graph_version(G):
+    """
+    Fingerprint of the graph's nodes, edges and edge travel times, used to key the cached travel times
+    """
+    digest = hashlib.sha1()
+    for node in sorted(G.nodes):
+        digest.update(str(node).encode('utf-8'))
+    for u, v, travel_time in sorted(G.edges(data='travel_time')):
+        digest.update('{}>{}:{:.1f}'.format(u, v, travel_time).encode('utf-8'))
+    return digest.hexdigest()
+
+
+# Graph of each worker process, sent once through the pool initializer instead of with every task
+_worker_graph = None
+_worker_index = None
+
+def _init_worker(G):
+    global _worker_graph, _worker_index
+    _worker_graph = G
+    _worker_index = node_index(G)
+
+def node_index(G):
+    """Position of every node of the graph in the rows of travel times"""
+    return {node: pos for pos, node in enumerate(sorted(G.nodes))}
+
+def _dijkstra_row(source):
+    """
+    Travel times (in whole minutes, see UNREACHABLE_MINUTES) from source to every node of the graph, in the order of node_index
+    """
+    lengths = nx.single_source_dijkstra_path_length(_worker_graph, source, weight='travel_time')
+    row = np.full(len(_worker_index), UNREACHABLE_MINUTES, dtype=np.uint16)
+    targets = np.fromiter((_worker_index[node] for node in lengths), dtype=np.int64, count=len(lengths))
+    row[targets] = np.fromiter(lengths.values(), dtype=float, count=len(lengths)) // 60
+    return row
+
+
+class RoadNetworkProvider(TravelTimeProvider):
+    """
+    Offline travel times computed on an OSMnx drive graph, e.g. the one from build_drive_graph(polygon).
+
+    All locations are snapped to their nearest node, then one Dijkstra search is run per unique origin node (in a process pool
+    when there are many), which gives the travel times from that node to every node of the graph at once, so a request for
+    N locations costs at most N shortest-path searches instead of N * N.
+    The row of travel times of each origin node is kept in memory (the max_memory_rows most recently used) and saved
+    as its own file under cache_dir, keyed by the graph version, so that later requests only search from the origin nodes
+    that have not been seen before. Only the new rows are written, and the least recently used files are deleted beyond max_disk_rows.
+
+    G: networkx MultiDiGraph from OSMnx. Edge speeds and travel times are added if missing.
+
+    n_workers: Number of processes of the Dijkstra pool, defaults to the number of CPUs. 1 runs everything in-process.
+
+    cache_dir: Folder of the cached rows, None to disable the on-disk cache.
+
+    max_memory_rows, max_disk_rows: Number of rows kept in memory and on disk. Each row takes 2 bytes per node of the graph.
+    """
+    name = 'road_network'
+
+    def __init__(self, G, n_workers=None, cache_dir=DEFAULT_CACHE_DIR, max_memory_rows=1000, max_disk_rows=20000):
+        if not all('travel_time' in data for _, _, data in G.edges(data=True)):
+            G = ox.add_edge_speeds(G)
+            G = ox.add_edge_travel_times(G)
+        self.G = G
+        self.n_workers = n_workers if n_workers is not None else os.cpu_count()
+        self.version = graph_version(G)
+        self.index = node_index(G)
+        self.max_memory_rows = max_memory_rows
+        self.max_disk_rows = max_disk_rows
+        self.rows = OrderedDict() # origin node -> row of travel times, most recently used last
+
+        self.cache_path = None
+        if cache_dir is not None:
+            self.cache_path = os.path.join(cache_dir, self.version)
+            os.makedirs(self.cache_path, exist_ok=True)
+
+    def run_dijkstras(self, sources):
+        if self.n_workers <= 1 or len(sources) < 2 * self.n_workers:
+            _init_worker(self.G)
+            return [_dijkstra_row(source) for source in sources]
+        with ProcessPoolExecutor(max_workers=self.n_workers, initializer=_init_worker, initargs=(self.G,)) as executor:
+            return list(executor.map(_dijkstra_row, sources, chunksize=max(1, len(sources) // (4 * self.n_workers))))
+
+    def row_path(self, node):
+        return os.path.join(self.cache_path, '{}.npy'.format(node))
+
+    def get_rows(self, nodes):
+        """
+        Rows of travel times of the given origin nodes, as a dictionary: from memory, then from the files of the cache,
+        and the remaining ones from new Dijkstra searches, which are saved to the cache.
+        """
+        rows, missing = {}, []
+        for node in dict.fromkeys(nodes):
+            if node in self.rows:
+                self.rows.move_to_end(node)
+                rows[node] = self.rows[node]
+            else:
+                row = self.load_row(node)
+                if row is None:
+                    missing.append(node)
+                else:
+                    rows[node] = row
+
+        if missing:
+            for node, row in zip(missing, self.run_dijkstras(missing)):
+                rows[node] = row
+                self.save_row(node, row)
+            if self.cache_path is not None:
+                self.evict_files()
+
+        for node, row in rows.items():
+            self.rows[node] = row
+            self.rows.move_to_end(node)
+        while len(self.rows) > self.max_memory_rows:
+            self.rows.popitem(last=False)
+        return rows
+
+    def load_row(self, node):
+        if self.cache_path is None:
+            return None
+        path = self.row_path(node)
+        try:
+            row = np.load(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError): #partially written or corrupted file
+            os.remove(path)
+            return None
+        if row.shape != (len(self.index),):
+            return None
+        os.utime(path) #the modification time of a file is its last use, for the eviction
+        return row
+
+    def save_row(self, node, row):
+        if self.cache_path is None:
+            return
+        # Written to a temporary file first, so that a crash never leaves a partial row under the node
+        path = self.row_path(node)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, row)
+        os.replace(tmp_path, path)
+
+    def evict_files(self):
+        # Deletes the least recently used rows beyond max_disk_rows
+        files = [(entry.stat().st_mtime, entry.path) for entry in os.scandir(self.cache_path) if entry.name.endswith('.npy')]
+        for _, path in sorted(files)[:max(0, len(files) - self.max_disk_rows)]:
+            os.remove(path)
+
+    def get_time_matrix(self, origin_addresses, dest_addresses):
+        origin_nodes = snap_to_nodes(self.G, origin_addresses).tolist()
+        dest_pos = np.array([self.index[node] for node in snap_to_nodes(self.G, dest_addresses).tolist()], dtype=np.int64)
+        rows = self.get_rows(origin_nodes)
+        return np.stack([rows[node][dest_pos] for node in origin_nodes]).astype(np.int64)
@@ -6,6 +6,8 @@ import osmnx as ox
 import folium
 import folium.plugins as plugins
 
+from RoadNetwork import build_drive_graph, snap_to_nodes
+
 def to_time(time_window):
     """
     Converts a time window into a presentable string format
@@ -25,20 +27,29 @@ def create_popup(text):
                         max_width=300)
     return popup
 
-def visualise_routes(json_result, polygon):
+def visualise_routes(json_result, polygon, G=None):
     """
     Visualise realistic routes for each phlebotomist and saves them to a .html file
 
     Arguments:
-        json_result: json output from Run Algorithm.ipynb (matching.json)
+        json_result: json output from Run Algorithm.ipynb (matching.json), or a MatchingAlgorithm.RouteTable
         polygon: geojson polygon provided by TATA
-        addressess_list: list of addressess compiled - refer to Run Algorithm.ipynb 
+        G: optional drive graph from RoadNetwork.build_drive_graph(polygon), e.g. the one already used by RoadNetworkProvider,
+            downloaded if not given
     """
+    if hasattr(json_result, 'to_dict'): # RouteTable, without importing the Matching Algorithm here
+        json_result = json_result.to_dict(printable=False)
     locations = json_result['Metadata']['Locations']
 
     # create base graph
-    x_min, y_min, x_max, y_max = polygon.total_bounds
-    G = ox.graph_from_bbox(north=y_max, south=y_min, east=x_max, west=x_min, network_type='drive')
+    if G is None:
+        G = build_drive_graph(polygon)
+
+    # snap every location to its nearest node at once, instead of once per leg
+    location_nodes = {}
+    coordinates = [location['Coordinate'] for location in locations if ',' in location['Coordinate']]
+    if coordinates:
+        location_nodes = dict(zip(coordinates, snap_to_nodes(G, coordinates).tolist()))
 
     # colour and opacity of routes and markers
     colours = [
@@ -82,14 +93,16 @@ def visualise_routes(json_result, polygon):
         sequence_counter = 0
         for i in range(len(locations_sequence)-1):
 
-            start = locations[locations_sequence[i]]['Coordinate'].split(',')
-            end = locations[locations_sequence[i+1]]['Coordinate'].split(',')
+            start_coord = locations[locations_sequence[i]]['Coordinate']
+            end_coord = locations[locations_sequence[i+1]]['Coordinate']
+            start = start_coord.split(',')
+            end = end_coord.split(',')
             start_lat, start_long = float(start[0]), float(start[1])
             end_lat, end_long = float(end[0]), float(end[1])
             print(f"Coords: {start_lat},{start_long}")
 
-            start_node = ox.distance.nearest_nodes(G, Y=start_lat, X=start_long)
-            end_node = ox.distance.nearest_nodes(G, Y=end_lat, X=end_long)
+            start_node = location_nodes[start_coord]
+            end_node = location_nodes[end_coord]
             print("Node: ", start_node, end_node)
 
             route = nx.shortest_path(G, start_node, end_node, weight='distance')
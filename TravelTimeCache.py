@@ -0,0 +1,150 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+DEFAULT_CACHE_PATH = os.path.join('Cache', 'travel_times.sqlite')
+
+# SQLite limits the number of bound parameters per statement, so lookups are done in chunks
+_SQL_CHUNK = 900
+
+
+class TravelTimeCache:
+    """
+    Persistent on-disk cache of travel times (in minutes) between pairs of coordinates.
+
+    Each entry is content-addressed by the origin and destination coordinates (rounded to `precision` decimals,
+    so that the same location written with slightly different floats maps to the same entry) and a time-of-day bucket.
+
+    path: Location of the SQLite file holding the cache. Parent folders are created if needed.
+
+    ttl: Number of seconds an entry stays valid. Expired entries are treated as missing and are purged on eviction.
+
+    max_entries: Maximum number of entries kept on disk. When exceeded, the least recently used entries are evicted.
+
+    precision: Number of decimals the latitude/longitude are rounded to when building the key (4 decimals ~ 11 meters).
+
+    bucket_minutes: Size of the time-of-day bucket in minutes, e.g. 60 stores a separate travel time for each hour of the day.
+            Only used when a departure time is given (see time_bucket): the Distance Matrix requests carry no departure time and
+            return the same traffic-free durations at any hour, so by default every travel time is stored in a single bucket.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl=7 * 24 * 60 * 60, max_entries=500000, precision=4, bucket_minutes=60):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.precision = precision
+        self.bucket_minutes = bucket_minutes
+
+        self._connect()
+
+    def _connect(self):
+        self._lock = threading.Lock()
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS travel_times (
+                                key TEXT PRIMARY KEY,
+                                minutes INTEGER NOT NULL,
+                                created REAL NOT NULL,
+                                accessed REAL NOT NULL)''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_travel_times_accessed ON travel_times (accessed)')
+        self._conn.commit()
+
+    def __getstate__(self):
+        # Connections cannot be pickled: worker processes reopen the same file
+        state = self.__dict__.copy()
+        del state['_conn'], state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._connect()
+
+    def time_bucket(self, when=None):
+        """Returns the time-of-day bucket of the given departure datetime, the single default bucket 0 if there is none."""
+        if when is None:
+            return 0
+        return (when.hour * 60 + when.minute) // self.bucket_minutes
+
+    def normalise_coordinate(self, coordinate):
+        """Rounds a "lat,long" string so that equivalent coordinates share the same key."""
+        lat, long = coordinate.split(',')
+        return '{0:.{2}f},{1:.{2}f}'.format(float(lat), float(long), self.precision)
+
+    def make_key(self, origin, destination, bucket):
+        pair = '{}|{}|{}'.format(self.normalise_coordinate(origin), self.normalise_coordinate(destination), bucket)
+        return hashlib.sha1(pair.encode('utf-8')).hexdigest()
+
+    def get_many(self, origin_addresses, dest_addresses, bucket=None):
+        """
+        Looks up the travel times of every origin/destination pair.
+        Output is a tuple of (time_matrix, found), both of shape len(origin_addresses) x len(dest_addresses),
+        where found is a boolean mask of the pairs that were present in the cache (missing pairs are 0 in time_matrix).
+        """
+        bucket = self.time_bucket() if bucket is None else bucket
+        keys = np.array([[self.make_key(origin, dest, bucket) for dest in dest_addresses] for origin in origin_addresses], dtype=object)
+        flat_keys = keys.ravel().tolist()
+
+        now = time.time()
+        hits = {}
+        with self._lock:
+            for i in range(0, len(flat_keys), _SQL_CHUNK):
+                chunk = flat_keys[i:i + _SQL_CHUNK]
+                rows = self._conn.execute(
+                    'SELECT key, minutes FROM travel_times WHERE created >= ? AND key IN ({})'.format(','.join('?' * len(chunk))),
+                    [now - self.ttl] + chunk).fetchall()
+                hits.update(rows)
+            if hits:
+                self._conn.executemany('UPDATE travel_times SET accessed = ? WHERE key = ?', [(now, key) for key in hits])
+                self._conn.commit()
+
+        found = np.array([key in hits for key in flat_keys], dtype=bool).reshape(keys.shape)
+        time_matrix = np.array([hits.get(key, 0) for key in flat_keys], dtype=np.int64).reshape(keys.shape)
+        return time_matrix, found
+
+    def put_many(self, origin_addresses, dest_addresses, time_matrix, bucket=None):
+        """Stores a len(origin_addresses) x len(dest_addresses) matrix of travel times (in minutes)."""
+        bucket = self.time_bucket() if bucket is None else bucket
+        now = time.time()
+        rows = [(self.make_key(origin, dest, bucket), int(time_matrix[i][j]), now, now)
+                for i, origin in enumerate(origin_addresses)
+                for j, dest in enumerate(dest_addresses)]
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO travel_times (key, minutes, created, accessed) VALUES (?, ?, ?, ?)', rows)
+            self._conn.commit()
+        self.evict()
+
+    def evict(self):
+        """Purges expired entries, then the least recently used ones until at most max_entries remain."""
+        with self._lock:
+            self._conn.execute('DELETE FROM travel_times WHERE created < ?', (time.time() - self.ttl,))
+            count = self._conn.execute('SELECT COUNT(*) FROM travel_times').fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute('''DELETE FROM travel_times WHERE key IN (
+                                        SELECT key FROM travel_times ORDER BY accessed ASC LIMIT ?)''',
+                                   (count - self.max_entries,))
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM travel_times')
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM travel_times').fetchone()[0]
+
+
+_default_cache = None
+
+def get_default_cache():
+    """Returns the cache shared by run_algorithm, reverse_getVacancy_algorithm and output_jsonify_verMultiEnds."""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = TravelTimeCache()
+    return _default_cache
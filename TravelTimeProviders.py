@@ -0,0 +1,125 @@
+import numpy as np
+
+import FeatureEngineering as FE
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def parse_coordinates(addresses):
+    """Converts a list of "lat,long" strings into an N x 2 float array of (lat, long)."""
+    return np.array([address.split(',') for address in addresses], dtype=float).reshape(-1, 2)
+
+
+def haversine_km(origin_coordinates, dest_coordinates):
+    """Great-circle distances (in km) between every origin and destination, as a len(origins) x len(dests) array."""
+    origin_rad = np.radians(origin_coordinates)[:, None, :]
+    dest_rad = np.radians(dest_coordinates)[None, :, :]
+    dlat = dest_rad[..., 0] - origin_rad[..., 0]
+    dlong = dest_rad[..., 1] - origin_rad[..., 1]
+    a = np.sin(dlat / 2) ** 2 + np.cos(origin_rad[..., 0]) * np.cos(dest_rad[..., 0]) * np.sin(dlong / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+class TravelTimeProvider:
+    """
+    Source of travel times for the Matching Algorithm. Subclasses implement get_time_matrix, which takes
+    a list of origin and a list of destination coordinates (in the "lat,long" format of get_coordinates_list)
+    and returns a len(origin_addresses) x len(dest_addresses) integer array of travel times in minutes.
+    """
+    name = 'base'
+
+    def get_time_matrix(self, origin_addresses, dest_addresses):
+        raise NotImplementedError
+
+    def create_time_matrix(self, address_list):
+        """Square Time Matrix between every pair of addresses, same format as FeatureEngineering.create_time_matrix."""
+        return self.get_time_matrix(address_list, address_list)
+
+
+class GoogleMapsProvider(TravelTimeProvider):
+    """Live travel times from the Google Distance Matrix API, optionally backed by a TravelTimeCache."""
+    name = 'google'
+
+    def __init__(self, api_key, cache=None):
+        self.api_key = api_key
+        self.cache = cache
+
+    def get_time_matrix(self, origin_addresses, dest_addresses):
+        return FE.get_time_matrix(origin_addresses, dest_addresses, self.api_key, self.cache)
+
+
+class HaversineProvider(TravelTimeProvider):
+    """
+    Offline travel times estimated from the great-circle distance, without any network call.
+
+    detour_factor: Ratio of the road distance to the straight-line distance. Use calibrate() to fit it on captured matrices.
+
+    speed_kmph: Average driving speed in km/h.
+    """
+    name = 'haversine'
+
+    def __init__(self, detour_factor=1.4, speed_kmph=25):
+        self.detour_factor = detour_factor
+        self.speed_kmph = speed_kmph
+
+    def get_time_matrix(self, origin_addresses, dest_addresses):
+        distances = haversine_km(parse_coordinates(origin_addresses), parse_coordinates(dest_addresses))
+        minutes = distances * self.detour_factor / self.speed_kmph * 60
+        return minutes.astype(np.int64) #truncated to minutes, same as FeatureEngineering.secondsToMinutes
+
+    @classmethod
+    def calibrate(cls, origin_addresses, dest_addresses, time_matrix, speed_kmph=25):
+        """
+        Fits the detour factor (least squares through the origin) so that the estimated travel times
+        best match a captured Time Matrix, e.g. one previously fetched from the Distance Matrix API.
+        """
+        distances = haversine_km(parse_coordinates(origin_addresses), parse_coordinates(dest_addresses)).ravel()
+        observed = np.asarray(time_matrix, dtype=float).ravel()
+        mask = distances > 0
+        minutes_per_km = np.dot(distances[mask], observed[mask]) / np.dot(distances[mask], distances[mask])
+        return cls(detour_factor=minutes_per_km * speed_kmph / 60, speed_kmph=speed_kmph)
+
+
+class ReplayProvider(TravelTimeProvider):
+    """
+    Travel times replayed from a previously captured Time Matrix, e.g. 'Simulated Data/timeMatrix.txt'.
+
+    time_matrix: A 2-d array, or the path of a file readable by np.loadtxt.
+
+    addresses: Optional list of the "lat,long" coordinates of each row/column of the matrix (or the path of a file with one per line).
+            Without it, only the full matrix can be requested, in its original order.
+    """
+    name = 'replay'
+
+    def __init__(self, time_matrix, addresses=None, precision=6):
+        if isinstance(time_matrix, str):
+            time_matrix = np.loadtxt(time_matrix)
+        self.time_matrix = np.asarray(time_matrix).astype(np.int64)
+        self.precision = precision
+
+        if isinstance(addresses, str):
+            with open(addresses) as f:
+                addresses = [line.strip() for line in f if line.strip()]
+        self.addresses = addresses
+        self.index = None
+        if addresses is not None:
+            if len(addresses) != len(self.time_matrix):
+                raise ValueError('{} addresses given for a Time Matrix of size {}'.format(len(addresses), len(self.time_matrix)))
+            self.index = {self.normalise_coordinate(address): idx for idx, address in enumerate(addresses)}
+
+    def normalise_coordinate(self, coordinate):
+        lat, long = coordinate.split(',')
+        return '{0:.{2}f},{1:.{2}f}'.format(float(lat), float(long), self.precision)
+
+    def lookup(self, addresses):
+        try:
+            return np.array([self.index[self.normalise_coordinate(address)] for address in addresses], dtype=np.int64)
+        except KeyError as e:
+            raise ValueError('Coordinate {} is not in the replayed Time Matrix'.format(e.args[0]))
+
+    def get_time_matrix(self, origin_addresses, dest_addresses):
+        if self.index is None:
+            if list(origin_addresses) == list(dest_addresses) and len(origin_addresses) == len(self.time_matrix):
+                return self.time_matrix.copy()
+            raise ValueError('ReplayProvider without addresses can only return the full Time Matrix')
+        return self.time_matrix[np.ix_(self.lookup(origin_addresses), self.lookup(dest_addresses))]